@@ -1,5 +1,17 @@
-from .analysis import base_prompt, processA, processB, processC
-from .common import custom_exceptions, logger
-from .config import config
+import importlib
+
+# submodules are imported on first access, so importing the package does not load langchain
+_SUBMODULES = {'base_prompt': '.analysis.base_prompt', 'processA': '.analysis.processA',
+               'processB': '.analysis.processB', 'processC': '.analysis.processC',
+               'custom_exceptions': '.common.custom_exceptions', 'logger': '.common.logger',
+               'config': '.config.config'}
 
 __all__ = ['base_prompt', 'processA', 'processB', 'processC', 'custom_exceptions', 'logger', 'config']
+
+
+def __getattr__(name: str):
+    if name not in _SUBMODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_SUBMODULES[name], __name__)
+    globals()[name] = module
+    return module
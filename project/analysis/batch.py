@@ -0,0 +1,136 @@
+"""This module provides functionality for analysing many advert/heatmap pairs at once.
+
+It includes functions for pairing image files by name, reading manifests and scheduling
+the pairs through the processing pipeline with bounded concurrency.
+"""
+
+import asyncio
+import csv
+import json
+import os
+from collections.abc import AsyncIterator, Iterable
+
+from analysis import process_main
+from analysis.request_image import RequestImage
+from common import LLMException
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+HEATMAP_SUFFIX = "_heatmap"
+
+
+def pair_files(names: Iterable[str]) -> list[tuple[str, str, str]]:
+    """Pairs advert images with their heatmaps by file name.
+
+    A heatmap is named like its advert with the "_heatmap" suffix, e.g. "ad1.jpg" and "ad1_heatmap.png".
+
+    Args:
+        names (Iterable[str]): File names or paths.
+
+    Returns:
+        list[tuple[str, str, str]]: Sorted (item id, advert name, heatmap name) tuples.
+
+    Raises:
+        ValueError: If an advert has no heatmap.
+    """
+    images = {}
+    for name in names:
+        stem, extension = os.path.splitext(name)
+        if extension.lower() in IMAGE_EXTENSIONS and not os.path.basename(stem).startswith("."):
+            images[stem] = name
+
+    pairs = []
+    for stem, name in sorted(images.items()):
+        if stem.endswith(HEATMAP_SUFFIX):
+            continue
+        heatmap = images.get(stem + HEATMAP_SUFFIX)
+        if heatmap is None:
+            raise ValueError(f"No heatmap found for {name}")
+        pairs.append((os.path.basename(stem), name, heatmap))
+    return pairs
+
+
+def read_manifest(file_path: str) -> list[tuple[str, str, str]]:
+    """Reads advert/heatmap pairs from a CSV or JSON lines manifest.
+
+    Each row has the "advert" and "heatmap" paths and optionally an "id". Relative paths are resolved
+    against the manifest folder.
+
+    Args:
+        file_path (str): Path to the .csv or .jsonl manifest.
+
+    Returns:
+        list[tuple[str, str, str]]: (item id, advert path, heatmap path) tuples.
+    """
+    with open(file_path, newline="") as file:
+        if file_path.endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+
+    base_dir = os.path.dirname(os.path.abspath(file_path))
+    return [(row.get("id") or os.path.splitext(os.path.basename(row["advert"]))[0],
+             os.path.join(base_dir, row["advert"]),
+             os.path.join(base_dir, row["heatmap"])) for row in rows]
+
+
+def read_file(file_path: str) -> bytes:
+    """Reads a file into bytes.
+
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        bytes: The file content.
+    """
+    with open(file_path, "rb") as file:
+        return file.read()
+
+
+async def arun_item(item_id: str, advert_image: bytes | RequestImage | str,
+                    advert_heatmap_image: bytes | RequestImage | str, semaphore: asyncio.Semaphore) -> dict:
+    """Analyses a single pair, converting failures into an error record.
+
+    Args:
+        item_id (str): Identifier of the pair reported in the record.
+        advert_image (bytes | RequestImage | str): Advert image or path to it.
+        advert_heatmap_image (bytes | RequestImage | str): Heatmap image or path to it.
+        semaphore (asyncio.Semaphore): Semaphore bounding the batch concurrency.
+
+    Returns:
+        dict: {"id", "status": "ok", "result"} or {"id", "status": "error", "error"}.
+    """
+    async with semaphore:
+        try:
+            if isinstance(advert_image, str):
+                advert_image = await asyncio.to_thread(read_file, advert_image)
+            if isinstance(advert_heatmap_image, str):
+                advert_heatmap_image = await asyncio.to_thread(read_file, advert_heatmap_image)
+            result = await process_main.arun(advert_image, advert_heatmap_image)
+        except LLMException as e:
+            return {"id": item_id, "status": "error", "error": f"temporary error with llm: {e}"}
+        except Exception as e:
+            return {"id": item_id, "status": "error", "error": f"{type(e).__name__}: {e}"}
+    return {"id": item_id, "status": "ok", "result": result}
+
+
+async def arun_batch(items: Iterable[tuple[str, bytes | RequestImage | str, bytes | RequestImage | str]],
+                     concurrency: int) -> AsyncIterator[dict]:
+    """Analyses many advert/heatmap pairs and yields a record per pair as soon as it finishes.
+
+    A failed pair produces an error record and does not stop the batch.
+
+    Args:
+        items (Iterable[tuple]): (item id, advert image, heatmap image) tuples; images are bytes, RequestImage or file paths.
+        concurrency (int): Maximum number of pairs analysed at the same time.
+
+    Yields:
+        dict: Result or error record of a pair, see arun_item.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.create_task(arun_item(item_id, advert, heatmap, semaphore)) for item_id, advert, heatmap in items]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
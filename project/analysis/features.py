@@ -0,0 +1,160 @@
+"""This module provides deterministic visual complexity features of adverts.
+
+The features are computed with vectorised NumPy operations on a batch of images resized to a common grid, so many
+images cost one pass: colour diversity and colourfulness, edge density, texture (edge orientation) and intensity
+entropy, and an estimate of the area covered by text. They ground the cognitive load judgement of process B and
+are cached in AppConfig.result_cache by the image digest.
+"""
+
+import io
+import math
+
+import numpy as np
+from PIL import Image
+
+from analysis.request_image import RequestImage
+from common import metrics
+from common.result_cache import make_key
+from config import AppConfig
+
+FEATURES_VERSION = "1"  # part of the cache key; bump it when the computation changes
+FEATURE_SIZE = 256  # side of the grid the images are resized to
+COLOUR_BITS = 4  # bits per channel of the quantised colours
+COLOUR_COVERAGE = 0.95
+INTENSITY_BINS = 64
+ORIENTATION_BINS = 8
+EDGE_THRESHOLD = 0.1  # gradient of an edge, in intensity units per pixel
+BLOCK_SIZE = 16
+TEXT_BLOCK_EDGE_DENSITY = 0.2
+TEXT_BLOCK_BALANCE = 0.3  # minimal ratio of the horizontal and vertical gradient energy of a text block
+GREY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+FEATURE_DESCRIPTIONS = {
+    "colour_count": f"number of distinct colours (quantised to {COLOUR_BITS} bits per channel) covering "
+                    f"{COLOUR_COVERAGE:.0%} of the image",
+    "colourfulness": "Hasler-Suesstrunk colourfulness; below 15 is nearly grey, above 80 very colourful",
+    "edge_density": "share of the pixels on an edge, from 0 to 1",
+    "texture_entropy": "entropy of the edge orientations normalised to 0-1; high values mean edges in many "
+                       "directions (patterns, textures)",
+    "intensity_entropy": f"entropy of the brightness histogram in bits, at most {math.log2(INTENSITY_BINS):.0f}",
+    "text_coverage": "estimated share of the image covered by text, from 0 to 1",
+}
+
+
+def _load(image: RequestImage) -> np.ndarray:
+    with Image.open(io.BytesIO(image.data)) as decoded:
+        decoded.draft("RGB", (FEATURE_SIZE, FEATURE_SIZE))  # JPEG is decoded at a reduced scale
+        return np.asarray(decoded.convert("RGB").resize((FEATURE_SIZE, FEATURE_SIZE), Image.BILINEAR))
+
+
+def _per_image_histogram(bins: np.ndarray, length: int, weights: np.ndarray | None = None) -> np.ndarray:
+    count = bins.shape[0]
+    offsets = (np.arange(count) * length).reshape((count,) + (1,) * (bins.ndim - 1))
+    flat_weights = None if weights is None else weights.ravel()
+    return np.bincount((bins + offsets).ravel(), weights=flat_weights, minlength=count * length).reshape(count, length)
+
+
+def _entropy(histogram: np.ndarray) -> np.ndarray:
+    totals = histogram.sum(axis=1, keepdims=True)
+    probabilities = np.divide(histogram, totals, out=np.zeros(histogram.shape), where=totals > 0)
+    logs = np.log2(probabilities, out=np.zeros(histogram.shape), where=probabilities > 0)
+    return 0.0 - (probabilities * logs).sum(axis=1)  # no negative zero
+
+
+def compute_features(images: list[RequestImage]) -> list[dict]:
+    """Computes the visual complexity features of a batch of images in one vectorised pass.
+
+    Args:
+        images (list[RequestImage]): The images.
+
+    Returns:
+        list[dict]: The features of every image, with the keys of FEATURE_DESCRIPTIONS.
+    """
+    if not images:
+        return []
+    pixels = np.stack([_load(image) for image in images])  # (images, height, width, rgb)
+    count = len(images)
+
+    # colour diversity: the fewest quantised colours covering most of the pixels
+    quantised = (pixels >> (8 - COLOUR_BITS)).astype(np.int64)
+    codes = (quantised[..., 0] << (2 * COLOUR_BITS)) | (quantised[..., 1] << COLOUR_BITS) | quantised[..., 2]
+    colour_histogram = -np.sort(-_per_image_histogram(codes, 1 << (3 * COLOUR_BITS)), axis=1)
+    coverage = np.cumsum(colour_histogram, axis=1) / codes[0].size
+    colour_count = (coverage < COLOUR_COVERAGE).sum(axis=1) + 1
+
+    rgb = pixels.astype(np.float32)
+    red_green = rgb[..., 0] - rgb[..., 1]
+    yellow_blue = 0.5 * (rgb[..., 0] + rgb[..., 1]) - rgb[..., 2]
+    colourfulness = (np.hypot(red_green.std(axis=(1, 2)), yellow_blue.std(axis=(1, 2)))
+                     + 0.3 * np.hypot(red_green.mean(axis=(1, 2)), yellow_blue.mean(axis=(1, 2))))
+
+    # Sobel gradients of the brightness, in intensity units per pixel
+    grey = rgb @ GREY_WEIGHTS / 255
+    padded = np.pad(grey, ((0, 0), (1, 1), (1, 1)), mode="edge")
+    columns = padded[:, :-2, :] + 2 * padded[:, 1:-1, :] + padded[:, 2:, :]
+    rows = padded[:, :, :-2] + 2 * padded[:, :, 1:-1] + padded[:, :, 2:]
+    gradient_x = (columns[:, :, 2:] - columns[:, :, :-2]) / 8
+    gradient_y = (rows[:, 2:, :] - rows[:, :-2, :]) / 8
+    magnitude = np.hypot(gradient_x, gradient_y)
+    edges = magnitude > EDGE_THRESHOLD
+    edge_density = edges.mean(axis=(1, 2))
+
+    orientation = np.mod(np.arctan2(gradient_y, gradient_x), np.pi)
+    orientation_bins = np.minimum((orientation / np.pi * ORIENTATION_BINS).astype(np.int64), ORIENTATION_BINS - 1)
+    orientation_histogram = _per_image_histogram(orientation_bins, ORIENTATION_BINS, np.where(edges, magnitude, 0))
+    texture_entropy = _entropy(orientation_histogram) / math.log2(ORIENTATION_BINS)
+
+    intensity_bins = np.minimum((grey * INTENSITY_BINS).astype(np.int64), INTENSITY_BINS - 1)
+    intensity_entropy = _entropy(_per_image_histogram(intensity_bins, INTENSITY_BINS))
+
+    # text: blocks with dense edges in both the horizontal and the vertical direction
+    blocks = FEATURE_SIZE // BLOCK_SIZE
+    shape = (count, blocks, BLOCK_SIZE, blocks, BLOCK_SIZE)
+    block_edges = edges.reshape(shape).mean(axis=(2, 4))
+    energy_x = np.where(edges, np.abs(gradient_x), 0).reshape(shape).sum(axis=(2, 4))
+    energy_y = np.where(edges, np.abs(gradient_y), 0).reshape(shape).sum(axis=(2, 4))
+    balance = np.minimum(energy_x, energy_y) / np.maximum(np.maximum(energy_x, energy_y), 1e-6)
+    text_blocks = (block_edges >= TEXT_BLOCK_EDGE_DENSITY) & (balance >= TEXT_BLOCK_BALANCE)
+    text_coverage = text_blocks.mean(axis=(1, 2))
+
+    return [{"colour_count": int(colour_count[index]),
+             "colourfulness": round(float(colourfulness[index]), 1),
+             "edge_density": round(float(edge_density[index]), 3),
+             "texture_entropy": round(float(texture_entropy[index]), 3),
+             "intensity_entropy": round(float(intensity_entropy[index]), 2),
+             "text_coverage": round(float(text_coverage[index]), 3)} for index in range(count)]
+
+
+def get_features(images: list[RequestImage]) -> list[dict]:
+    """Returns the features of images from the result cache, computing the missing ones in one batch.
+
+    Args:
+        images (list[RequestImage]): The images.
+
+    Returns:
+        list[dict]: The features of every image.
+    """
+    app_config = AppConfig()
+    keys = [make_key(image.digest, FEATURES_VERSION) for image in images]
+    features = [app_config.result_cache.get("features", key) for key in keys]
+    missing = [index for index, value in enumerate(features) if value is None]
+    if missing:
+        with metrics.local_seconds.time(operation="features"):
+            computed = compute_features([images[index] for index in missing])
+        for index, value in zip(missing, computed):
+            features[index] = value
+            app_config.result_cache.set("features", keys[index], value)
+    return features
+
+
+def describe(features: dict) -> str:
+    """Describes the features for a prompt.
+
+    Args:
+        features (dict): Features of an image.
+
+    Returns:
+        str: One line per feature with its value and meaning.
+    """
+    return "\n".join(f"- {name}: {features[name]} ({description})"
+                     for name, description in FEATURE_DESCRIPTIONS.items())
@@ -0,0 +1,215 @@
+"""This module provides a local analysis of the attention heatmap of an advert.
+
+The heatmap is segmented into attention levels by hue (red is high attention, yellow medium, green low; blue and
+transparent pixels get none), weighted by the alpha channel, on a small analysis grid. Connected attention regions
+are labelled with vectorised NumPy operations, and their attention share, peak level and bounding box on the advert
+are computed. The compact text summary of the regions can replace the heatmap image in the A2 request, see
+processA, together with an optional strip of advert crops at the regions.
+"""
+
+import io
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+from analysis.request_image import RequestImage
+from common import metrics
+
+ANALYSIS_SIZE = 128  # longest side of the grid the heatmap is analysed on
+LEVELS = ("none", "low", "medium", "high")
+LEVEL_WEIGHTS = np.array([0.0, 0.3, 0.6, 1.0])
+# upper bounds of the hue in degrees of the "high", "medium" and "low" levels; hues from 330 are red again
+HUE_BOUNDS = {"high": 25, "medium": 70, "low": 170}
+RED_HUE_START = 330
+MIN_SATURATION = 0.35
+MIN_VALUE = 0.25
+MIN_ALPHA = 32
+CROP_HEIGHT = 128
+CROP_MARGIN = 0.1  # share of the region size added around its crop
+JPEG_QUALITY = 85
+
+
+@dataclass(frozen=True)
+class HeatmapRegion:
+    """A connected region of the heatmap which gets attention."""
+
+    level: str  # peak attention level in the region
+    attention_share: float  # share of the attention of the whole heatmap
+    area_share: float  # share of the advert area
+    box: tuple[int, int, int, int]  # left, top, right and bottom in advert pixels
+    position: str  # e.g. "top left"
+
+    def describe(self) -> str:
+        """Describes the region in one line.
+
+        Returns:
+            str: The description.
+        """
+        left, top, right, bottom = self.box
+        return (f"{self.position}: {self.level} attention, {self.attention_share:.0%} of the attention, "
+                f"{self.area_share:.0%} of the area, box ({left}, {top})-({right}, {bottom})")
+
+
+def attention_levels(image: Image.Image) -> tuple[np.ndarray, np.ndarray]:
+    """Segments a heatmap into attention levels by hue, saturation and alpha.
+
+    Args:
+        image (Image.Image): The heatmap.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Index of the level in LEVELS and the attention weight of every pixel.
+    """
+    hsv = np.asarray(image.convert("RGB").convert("HSV"), dtype=np.float32) / 255
+    hue, saturation, value = hsv[..., 0] * 360, hsv[..., 1], hsv[..., 2]
+
+    levels = np.zeros(hue.shape, dtype=np.int8)
+    levels[hue < HUE_BOUNDS["low"]] = LEVELS.index("low")
+    levels[hue < HUE_BOUNDS["medium"]] = LEVELS.index("medium")
+    levels[(hue < HUE_BOUNDS["high"]) | (hue >= RED_HUE_START)] = LEVELS.index("high")
+    levels[(saturation < MIN_SATURATION) | (value < MIN_VALUE)] = 0
+
+    weights = LEVEL_WEIGHTS[levels]
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        alpha = np.asarray(image.convert("RGBA"), dtype=np.uint8)[..., 3]
+        levels[alpha < MIN_ALPHA] = 0
+        weights = np.where(alpha < MIN_ALPHA, 0.0, weights * alpha / 255)
+    return levels, weights
+
+
+def label_regions(mask: np.ndarray) -> np.ndarray:
+    """Labels the 4-connected regions of a mask.
+
+    Every pixel takes the minimum label of its neighbours, and labels jump to the label of the pixel they point at,
+    until no label changes.
+
+    Args:
+        mask (np.ndarray): Boolean mask.
+
+    Returns:
+        np.ndarray: Labels of the regions (not consecutive); 0 outside the mask.
+    """
+    height, width = mask.shape
+    background = height * width + 1
+    labels = np.where(mask, np.arange(1, height * width + 1).reshape(height, width), background)
+    while True:
+        padded = np.pad(labels, 1, constant_values=background)
+        updated = np.minimum.reduce([labels, padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2],
+                                     padded[1:-1, 2:]])
+        updated = np.where(mask, updated, background)
+        flat = np.append(updated.ravel(), background)
+        updated = np.where(mask, flat[updated - 1], background)  # a label is the index of a pixel of the region
+        if np.array_equal(updated, labels):
+            return np.where(mask, labels, 0)
+        labels = updated
+
+
+def _position(center_x: float, center_y: float) -> str:
+    row = ("top", "middle", "bottom")[min(2, int(center_y * 3))]
+    column = ("left", "center", "right")[min(2, int(center_x * 3))]
+    return "center" if (row, column) == ("middle", "center") else f"{row} {column}"
+
+
+def find_regions(heatmap: RequestImage, advert_size: tuple[int, int], max_regions: int = 5,
+                 min_share: float = 0.02) -> list[HeatmapRegion]:
+    """Finds the regions of a heatmap which get the most attention, mapped onto the advert.
+
+    Args:
+        heatmap (RequestImage): The attention heatmap of the advert.
+        advert_size (tuple[int, int]): Width and height of the advert; the heatmap is scaled to it.
+        max_regions (int): Maximum number of regions returned.
+        min_share (float): Minimum attention share of a returned region.
+
+    Returns:
+        list[HeatmapRegion]: The regions in the order of decreasing attention share.
+    """
+    with metrics.local_seconds.time(operation="heatmap"):
+        with Image.open(io.BytesIO(heatmap.data)) as image:
+            image.draft("RGB", (ANALYSIS_SIZE, ANALYSIS_SIZE))  # JPEG is decoded at a reduced scale
+            image.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE), Image.BOX)
+            levels, weights = attention_levels(image)
+
+        total = weights.sum()
+        if total == 0:
+            return []
+        labels = label_regions(levels > 0)
+        ids, inverse = np.unique(labels, return_inverse=True)
+        inverse = inverse.reshape(labels.shape)
+        rows, columns = np.indices(labels.shape)
+        count = len(ids)
+        shares = np.bincount(inverse.ravel(), weights=weights.ravel(), minlength=count) / total
+        areas = np.bincount(inverse.ravel(), minlength=count) / labels.size
+        peaks = np.zeros(count, dtype=np.int8)
+        np.maximum.at(peaks, inverse, levels)
+        tops, lefts = np.full(count, labels.shape[0]), np.full(count, labels.shape[1])
+        bottoms, rights = np.zeros(count, dtype=int), np.zeros(count, dtype=int)
+        np.minimum.at(tops, inverse, rows)
+        np.minimum.at(lefts, inverse, columns)
+        np.maximum.at(bottoms, inverse, rows + 1)
+        np.maximum.at(rights, inverse, columns + 1)
+
+        scale_x, scale_y = advert_size[0] / labels.shape[1], advert_size[1] / labels.shape[0]
+        regions = []
+        for index in np.argsort(-shares):
+            if ids[index] == 0:
+                continue  # the pixels without attention
+            if len(regions) == max_regions or shares[index] < min_share:
+                break
+            box = (round(lefts[index] * scale_x), round(tops[index] * scale_y),
+                   round(rights[index] * scale_x), round(bottoms[index] * scale_y))
+            regions.append(HeatmapRegion(level=LEVELS[peaks[index]],
+                                         attention_share=round(float(shares[index]), 3),
+                                         area_share=round(float(areas[index]), 3),
+                                         box=box,
+                                         position=_position((box[0] + box[2]) / 2 / advert_size[0],
+                                                            (box[1] + box[3]) / 2 / advert_size[1])))
+        return regions
+
+
+def summarize(regions: list[HeatmapRegion]) -> str:
+    """Builds the text summary of the heatmap regions.
+
+    Args:
+        regions (list[HeatmapRegion]): The regions found in the heatmap.
+
+    Returns:
+        str: One line per region, numbered in the order of decreasing attention.
+    """
+    if not regions:
+        return "The attention heatmap shows no region of notable attention."
+    covered = sum(region.attention_share for region in regions)
+    lines = [f"{len(regions)} regions of the advert get {covered:.0%} of the attention:"]
+    lines += [f"{number}. {region.describe()}" for number, region in enumerate(regions, 1)]
+    return "\n".join(lines)
+
+
+def crop_strip(advert: RequestImage, regions: list[HeatmapRegion]) -> RequestImage | None:
+    """Crops the advert at the regions and puts the crops side by side, in the order of the regions.
+
+    Args:
+        advert (RequestImage): The advert.
+        regions (list[HeatmapRegion]): The regions found in its heatmap.
+
+    Returns:
+        RequestImage | None: JPEG image of the crops, or None if there are no regions.
+    """
+    if not regions:
+        return None
+    with metrics.local_seconds.time(operation="heatmap"), Image.open(io.BytesIO(advert.data)) as image:
+        image = image.convert("RGB")
+        crops = []
+        for region in regions:
+            left, top, right, bottom = region.box
+            margin_x, margin_y = (right - left) * CROP_MARGIN, (bottom - top) * CROP_MARGIN
+            crop = image.crop((max(0, round(left - margin_x)), max(0, round(top - margin_y)),
+                               min(image.width, round(right + margin_x)), min(image.height, round(bottom + margin_y))))
+            crop.thumbnail((CROP_HEIGHT * 4, CROP_HEIGHT))
+            crops.append(crop)
+        strip = Image.new("RGB", (sum(crop.width for crop in crops), CROP_HEIGHT), "white")
+        x = 0
+        for crop in crops:
+            strip.paste(crop, (x, 0))
+            x += crop.width
+        output = io.BytesIO()
+        strip.save(output, format="JPEG", quality=JPEG_QUALITY)
+    return RequestImage(output.getvalue())
@@ -0,0 +1,150 @@
+"""This module provides per-stage image policies: the vision detail level and a tile-aligned image resolution.
+
+The model bills an image by its detail level. A "low" detail image costs a fixed number of tokens. A "high" detail
+image is scaled to fit 2048x2048, then its shortest side is scaled to 768 px, and every 512 px tile costs extra
+tokens. Images are therefore downscaled before sending to the largest resolution which fits the tile budget of the
+stage, so no pixels are sent that the model would discard or bill for a barely used tile.
+"""
+
+import io
+import math
+from dataclasses import dataclass
+
+from PIL import Image
+
+from analysis import utils
+from analysis.request_image import RequestImage
+from common.result_cache import LRUCache, make_key
+from config.prompts_config import IMAGE_DETAILS
+
+TILE_SIZE = 512
+BASE_TOKENS = 85  # tokens of a low detail image and the base cost of a high detail image
+TILE_TOKENS = 170
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+JPEG_QUALITY = 85
+
+_encoded_images = LRUCache(max_entries=256)
+
+
+@dataclass(frozen=True)
+class ImagePolicy:
+    """Vision detail level and tile budget of the images of a stage."""
+
+    detail: str = "auto"
+    max_tiles: int = 4  # maximum number of 512 px tiles of a "high" or "auto" detail image
+
+    @classmethod
+    def from_config(cls, process_prompts: dict, stage: str) -> "ImagePolicy":
+        """Reads the policy of a stage from the "image_policy" section of a process config.
+
+        Args:
+            process_prompts (dict): The process configuration.
+            stage (str): Name of the stage, e.g. "a1".
+
+        Returns:
+            ImagePolicy: The configured policy, or the default one.
+        """
+        return cls(**process_prompts.get("image_policy", {}).get(stage, {}))
+
+    def __post_init__(self):
+        if self.detail not in IMAGE_DETAILS:
+            raise ValueError(f"unknown image detail {self.detail}, use one of {IMAGE_DETAILS}")
+
+
+def _fit(width: int, height: int, max_width: float, max_height: float) -> tuple[int, int]:
+    scale = min(1.0, max_width / width, max_height / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def high_detail_size(width: int, height: int) -> tuple[int, int]:
+    """Returns the resolution the model scales a high detail image to.
+
+    Args:
+        width (int): Image width.
+        height (int): Image height.
+
+    Returns:
+        tuple[int, int]: Width and height seen by the model.
+    """
+    width, height = _fit(width, height, HIGH_DETAIL_MAX_SIDE, HIGH_DETAIL_MAX_SIDE)
+    scale = min(1.0, HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def image_tokens(width: int, height: int, detail: str) -> int:
+    """Returns the prompt tokens billed for an image.
+
+    Args:
+        width (int): Image width.
+        height (int): Image height.
+        detail (str): "low", "high" or "auto"; "auto" is billed like "high" as the worst case.
+
+    Returns:
+        int: Number of tokens.
+    """
+    if detail == "low":
+        return BASE_TOKENS
+    width, height = high_detail_size(width, height)
+    return BASE_TOKENS + TILE_TOKENS * math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+
+
+def target_size(width: int, height: int, policy: ImagePolicy) -> tuple[int, int]:
+    """Returns the largest resolution of an image which does not exceed the tile budget of the policy.
+
+    The image is never upscaled. For "high"/"auto" detail the result fills a grid of at most max_tiles tiles
+    along one of its sides.
+
+    Args:
+        width (int): Image width.
+        height (int): Image height.
+        policy (ImagePolicy): Image policy of the stage.
+
+    Returns:
+        tuple[int, int]: Target width and height.
+    """
+    if policy.detail == "low":
+        return _fit(width, height, TILE_SIZE, TILE_SIZE)
+
+    width, height = high_detail_size(width, height)
+    best = (1, 1)
+    for columns in range(1, policy.max_tiles + 1):
+        rows = policy.max_tiles // columns
+        size = _fit(width, height, columns * TILE_SIZE, rows * TILE_SIZE)
+        if size[0] * size[1] > best[0] * best[1]:
+            best = size
+    return best
+
+
+def image_url(image: RequestImage | bytes, policy: ImagePolicy) -> str:
+    """Downscales an image to the target resolution of the policy if needed and returns its base64 data URL.
+
+    An image which is not downscaled reuses the data URL memoized by the request image; downscaled images are
+    cached by the image digest and the policy.
+
+    Args:
+        image (RequestImage | bytes): The image.
+        policy (ImagePolicy): Image policy of the stage.
+
+    Returns:
+        str: The data URL; of a JPEG if the image was downscaled, of the original file otherwise.
+    """
+    image = RequestImage.of(image)
+    size = target_size(*image.size, policy)
+    if size == image.size:
+        return image.data_url
+
+    cache_key = make_key(image.digest, policy.detail, str(policy.max_tiles))
+    url = _encoded_images.get(cache_key)
+    if url is not None:
+        return url
+
+    resized = Image.open(io.BytesIO(image.data))
+    resized.draft("RGB", size)
+    resized = resized.convert("RGB").resize(size, Image.LANCZOS)
+    output = io.BytesIO()
+    resized.save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+
+    url = f"data:image/jpeg;base64,{utils.encode_image(output.getbuffer())}"
+    _encoded_images.set(cache_key, url)
+    return url
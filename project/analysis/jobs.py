@@ -0,0 +1,189 @@
+"""This module provides a queue of analysis jobs executed by a pool of worker threads.
+
+Jobs are submitted with their images and return immediately; their status, per-stage progress and result
+are kept in a pluggable job store and can be polled, or pushed to a callback URL when the job finishes.
+"""
+
+import ipaddress
+import json
+import queue
+import threading
+import urllib.parse
+import urllib.request
+import uuid
+
+from analysis import process_main
+from common import QueueFullException, metrics
+from common.job_store import JOB_STAGES, InMemoryJobStore, SqliteJobStore, new_job
+from config import AppConfig
+
+
+CALLBACK_SCHEMES = ("http", "https")
+
+
+def check_callback_url(url: str, allowed_hosts: list[str]):
+    """Checks that a callback URL is an http(s) URL of an allowed host.
+
+    Without an allow-list, any host is allowed except literal loopback, private, link-local and reserved addresses.
+
+    Args:
+        url (str): The callback URL.
+        allowed_hosts (list[str]): Lowercase host names callbacks may be sent to; empty allows any public host.
+
+    Raises:
+        ValueError: If the URL is not allowed.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in CALLBACK_SCHEMES or not parsed.hostname:
+        raise ValueError("callback_url must be an http or https URL with a host")
+    host = parsed.hostname.lower()
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise ValueError(f"callback host {host} is not allowed")
+        return
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return
+    if address.is_loopback or address.is_private or address.is_link_local or address.is_reserved:
+        raise ValueError(f"callback host {host} is not a public address")
+
+
+class JobQueue:
+    """Bounded queue of analysis jobs processed by worker threads."""
+
+    def __init__(self, store, workers: int = 4, max_queued: int = 100, callback_timeout: float = 10.0):
+        """Initialize a JobQueue instance and start its workers.
+
+        Unfinished jobs found in the store whose worker is not running (e.g. after a restart) are queued again.
+
+        Args:
+            store (InMemoryJobStore | SqliteJobStore): Backend storing the jobs.
+            workers (int): Number of worker threads.
+            max_queued (int): Maximum number of jobs waiting in the queue.
+            callback_timeout (float): Timeout in seconds of the callback request.
+        """
+        self.store = store
+        self.callback_timeout = callback_timeout
+        self._queue = queue.Queue(maxsize=max_queued)
+        for job_id in store.claim_unfinished():
+            store.update(job_id, status="queued")
+            try:
+                self._queue.put_nowait(job_id)
+            except queue.Full:
+                store.update(job_id, status="failed", error="job queue is full after restart")
+
+        self._workers = [threading.Thread(target=self._work, name=f"job_worker_{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, advert_image: bytes, advert_heatmap_image: bytes, callback_url: str | None = None) -> dict:
+        """Queues an analysis job.
+
+        Args:
+            advert_image (bytes): image file to process.
+            advert_heatmap_image (bytes): heatmap image file to process.
+            callback_url (str | None): Optional URL which receives the finished job record as a JSON POST.
+
+        Returns:
+            dict: The job record.
+
+        Raises:
+            QueueFullException: If the queue is full.
+        """
+        if self._queue.full():
+            raise QueueFullException("job queue is full, retry later")
+
+        job = new_job(uuid.uuid4().hex, callback_url)
+        self.store.create(job, advert_image, advert_heatmap_image)
+        try:
+            self._queue.put_nowait(job["job_id"])
+        except queue.Full:
+            self.store.update(job["job_id"], status="failed", error="job queue is full")
+            raise QueueFullException("job queue is full, retry later")
+        return job
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns the job record.
+
+        Args:
+            job_id (str): The unique identifier of the job.
+
+        Returns:
+            dict | None: The job record, or None if the job is unknown.
+        """
+        return self.store.get(job_id)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                with metrics.trace_scope(request_id=job_id):
+                    self._run(job_id)
+            except Exception as e:  # a worker never dies, or the queued jobs would wait forever
+                AppConfig().process_logger.error(f"Job {job_id} crashed its worker: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id: str):
+        app_config = AppConfig()
+        inputs = self.store.get_inputs(job_id)
+        if inputs is None:
+            self.store.update(job_id, status="failed", error="job inputs are missing")
+            return
+
+        def progress(stage: str, status: str, output=None):
+            if stage == "A":
+                # a cached process A output finishes both of its stages at once
+                if status == "done":
+                    self.store.update(job_id, progress={"A1": "done", "A2": "done"})
+                return
+            self.store.update(job_id, progress={stage: status})
+
+        self.store.update(job_id, status="running")
+        try:
+            result = process_main.run(*inputs, progress=progress)
+        except Exception as e:
+            app_config.process_logger.error(f"Job {job_id} failed: {e}")
+            self.store.update(job_id, status="failed", error=str(e))
+        else:
+            self.store.update(job_id, status="done", result=result,
+                              progress={stage: "done" for stage in JOB_STAGES})
+
+        job = self.store.get(job_id)
+        if job and job["callback_url"]:
+            self._notify(job)
+
+    def _notify(self, job: dict):
+        try:
+            check_callback_url(job["callback_url"], AppConfig().job_callback_hosts)
+            request = urllib.request.Request(job["callback_url"],
+                                             data=json.dumps(job, ensure_ascii=False).encode("utf-8"),
+                                             headers={"Content-Type": "application/json"}, method="POST")
+            with urllib.request.urlopen(request, timeout=self.callback_timeout):
+                pass
+        except Exception as e:
+            AppConfig().process_logger.warning(f"Callback of job {job['job_id']} failed: {e}")
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Returns the job queue of the process, creating it on first use.
+
+    Returns:
+        JobQueue: Queue configured by AppConfig (job_workers, job_queue_size, job_store_path, job_ttl).
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            app_config = AppConfig()
+            if app_config.job_store_path:
+                store = SqliteJobStore(app_config.job_store_path, app_config.job_ttl)
+            else:
+                store = InMemoryJobStore(app_config.job_ttl)
+            _job_queue = JobQueue(store, app_config.job_workers, app_config.job_queue_size)
+        return _job_queue
@@ -0,0 +1,101 @@
+"""This module routes the processing stages to their models.
+
+Each process of the prompts configuration may have a "model" section with the model name, temperature, max_tokens
+and timeout of its requests; the clients are pooled in AppConfig. If the section lists models to "escalate_to", the
+stage is first run on its (cheaper) model and is re-run on the next model only if the output cannot be parsed or
+misses keys of the response schemas. Unless "structured_output" of the section is false, the models are asked for
+the native structured output of the stage, see structured_output; otherwise the prompt carries format instructions.
+"""
+
+from typing import Awaitable, Callable, TypeVar
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import Runnable
+
+from common import metrics
+from config import AppConfig
+
+T = TypeVar("T")
+
+
+def stage_models(process_prompts: dict) -> list[tuple[str, Runnable]]:
+    """Returns the models of a process in the order they are tried.
+
+    Args:
+        process_prompts (dict): Configuration of the process, e.g. prompts_config["c_process"].
+
+    Returns:
+        list[tuple[str, Runnable]]: The model names and clients; the first one is used unless an output fails.
+    """
+    app_config = AppConfig()
+    settings = process_prompts.get("model", {})
+    names = [settings.get("name", app_config.model_name)] + settings.get("escalate_to", [])
+    return [(name, app_config.get_model(settings | {"name": name})) for name in names]
+
+
+def native_output(process_prompts: dict) -> bool:
+    """Whether the models of a process support the native structured output.
+
+    Args:
+        process_prompts (dict): Configuration of the process.
+
+    Returns:
+        bool: The "structured_output" setting of the "model" section, true by default.
+    """
+    return process_prompts.get("model", {}).get("structured_output", True)
+
+
+def _escalate(name: str, next_name: str, error: OutputParserException):
+    metrics.llm_escalations.inc(stage=metrics.stage_var.get(), model=name)
+    AppConfig().process_logger.warning(f"Output of {name} cannot be parsed, escalating to {next_name}: {error}")
+
+
+def run(process_prompts: dict, attempt: Callable[[Runnable, bool], T]) -> T:
+    """Runs a stage on its models, escalating to the next model when the output cannot be parsed.
+
+    Args:
+        process_prompts (dict): Configuration of the process.
+        attempt (Callable[[Runnable, bool], T]): Runs the stage on a model and parses its output; the second
+                                                 argument tells if the model is the last one to try.
+
+    Returns:
+        T: The result of the first successful attempt.
+
+    Raises:
+        OutputParserException: If the output of the last model cannot be parsed.
+    """
+    models = stage_models(process_prompts)
+    for index, (name, model) in enumerate(models):
+        metrics.llm_stage_models.inc(stage=metrics.stage_var.get(), model=name)
+        final = index == len(models) - 1
+        try:
+            return attempt(model, final)
+        except OutputParserException as e:
+            if final:
+                raise
+            _escalate(name, models[index + 1][0], e)
+
+
+async def arun(process_prompts: dict, attempt: Callable[[Runnable, bool], Awaitable[T]]) -> T:
+    """Asynchronous version of run.
+
+    Args:
+        process_prompts (dict): Configuration of the process.
+        attempt (Callable[[Runnable, bool], Awaitable[T]]): Coroutine function running the stage on a model.
+
+    Returns:
+        T: The result of the first successful attempt.
+
+    Raises:
+        OutputParserException: If the output of the last model cannot be parsed.
+    """
+    models = stage_models(process_prompts)
+    for index, (name, model) in enumerate(models):
+        metrics.llm_stage_models.inc(stage=metrics.stage_var.get(), model=name)
+        final = index == len(models) - 1
+        try:
+            return await attempt(model, final)
+        except OutputParserException as e:
+            if final:
+                raise
+            _escalate(name, models[index + 1][0], e)
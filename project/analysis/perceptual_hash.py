@@ -0,0 +1,95 @@
+"""This module provides perceptual hashes of images.
+
+A perceptual hash is a 64-bit fingerprint of the coarse structure of an image, so resized or re-encoded versions of
+the same image get hashes which differ in a few bits (a small Hamming distance), unlike their bytes or digests.
+"""
+
+import io
+
+import numpy as np
+from PIL import Image
+
+from analysis.request_image import RequestImage
+
+HASH_SIZE = 8  # bits per side of the hash
+DCT_SIZE = 32  # side of the image the DCT of the pHash is computed on
+HASH_KINDS = ("phash", "dhash")
+
+
+def _grey(image: RequestImage, size: tuple[int, int]) -> np.ndarray:
+    with Image.open(io.BytesIO(image.data)) as decoded:
+        decoded.draft("L", size)  # JPEG is decoded at a reduced scale
+        return np.asarray(decoded.convert("L").resize(size, Image.LANCZOS), dtype=np.float32)
+
+
+def _bits(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    rows, columns = np.indices((size, size))
+    matrix = np.cos(np.pi * (2 * columns + 1) * rows / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def dhash(image: RequestImage) -> int:
+    """Computes the difference hash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour.
+
+    Args:
+        image (RequestImage): The image.
+
+    Returns:
+        int: The 64-bit hash.
+    """
+    pixels = _grey(image, (HASH_SIZE + 1, HASH_SIZE))
+    return _bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: RequestImage) -> int:
+    """Computes the DCT hash: whether each of the 8x8 lowest frequencies of a 32x32 thumbnail is above their median.
+
+    The median is taken over all 64 coefficients, so half of the bits are set and distances of two hashes are even.
+
+    Args:
+        image (RequestImage): The image.
+
+    Returns:
+        int: The 64-bit hash.
+    """
+    frequencies = (_DCT @ _grey(image, (DCT_SIZE, DCT_SIZE)) @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    return _bits(frequencies > np.median(frequencies))
+
+
+def hash_image(image: RequestImage, kind: str = "phash") -> int:
+    """Computes a perceptual hash of an image.
+
+    Args:
+        image (RequestImage): The image.
+        kind (str): "phash" or "dhash".
+
+    Returns:
+        int: The 64-bit hash.
+
+    Raises:
+        ValueError: If the kind is unknown.
+    """
+    if kind not in HASH_KINDS:
+        raise ValueError(f"unknown perceptual hash {kind}, use one of {HASH_KINDS}")
+    return phash(image) if kind == "phash" else dhash(image)
+
+
+def distance(first: int, second: int) -> int:
+    """Returns the Hamming distance of two hashes.
+
+    Args:
+        first (int): A hash.
+        second (int): Another hash.
+
+    Returns:
+        int: Number of differing bits.
+    """
+    return (first ^ second).bit_count()
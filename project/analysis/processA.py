@@ -1,48 +1,352 @@
 """This module provides functionality for processing images and generating results based on provided сonfigurations.
 
-It includes functions for managing session history and running image processing
-with prompt-based configurations.
+It includes functions for running image processing with prompt-based configurations.
+In the "sequential" mode the A1 -> A2 chat history is kept in a request-scoped session of
+AppConfig.session_histories; in the "combined" mode both images are sent in a single request.
+A stage output which cannot be parsed is escalated to the next model of the process, see model_routing.
+Depending on "heatmap_mode", A2 gets the heatmap image, a summary of the attention regions found in the heatmap
+locally (see heatmap), or is not sent to the model at all.
 """
 
-from analysis import utils
+import asyncio
+
+from analysis import heatmap, image_policy, model_routing, utils
 from analysis.base_prompt import BasePrompt
-from common import LLMException
+from analysis.registry import CompiledStage, registry
+from analysis.request_image import RequestImage
+from common import LLMException, metrics
 from config import AppConfig
-from langchain.output_parsers import StructuredOutputParser
-from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
+from langchain_core.output_parsers import BaseOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
-# In-memory store for session histories
-store = {}
 
-def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    """Retrieves the chat message history for a given session.
+def create_chat_template(prompt: BasePrompt | None = None) -> ChatPromptTemplate:
+    """Creates the chat prompt template shared by the A1 and A2 stages.
+
+    Args:
+        prompt (BasePrompt | None): Prompt of the stage; the template does not depend on it.
+
+    Returns:
+        ChatPromptTemplate: Template with the stage instructions, the session history and the image.
+    """
+    return ChatPromptTemplate.from_messages([
+        # tdo change prompt потому что оно скорее на свои штуки отвлекается чем на картинку, показать эксперимент со второй картинкой
+        ("system", "{prompt_role}"),
+        ("system", "{task_instruction}"),
+        ("system", "{response_template}"),
+        MessagesPlaceholder(variable_name="history"),
+        (
+            "user",
+            [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "{image}", "detail": "{image_detail}"},
+                }
+            ],
+        ),
+    ])
+
 
-    If the session does not exist, a new session history is created and added to the store.
+def create_chain(chat_template: ChatPromptTemplate, output_parser: BaseOutputParser,
+                 model: Runnable) -> RunnableWithMessageHistory:
+    """Creates the chain of an A stage, which keeps the request chat history.
 
     Args:
-        session_id (str): The unique identifier for the session. Each session_id
-                          should be unique for every session.
+        chat_template (ChatPromptTemplate): Template for creating the chat prompt.
+        output_parser (BaseOutputParser): Parser of the stage output; it is applied after the history update.
+        model (Runnable): The chat model.
 
     Returns:
-        BaseChatMessageHistory: The chat message history associated with the session_id.
-                                 If the session_id is not found in the store, a new
-                                 InMemoryChatMessageHistory instance is created and returned.
+        RunnableWithMessageHistory: The chain with message history.
+    """
+    return RunnableWithMessageHistory(chat_template | model, AppConfig().session_histories.get_session_history,
+                                      input_messages_key="image", history_messages_key="history")
+
 
+def combined_instructions(process_prompts: dict) -> dict:
+    """Merges the A1 and A2 instructions into the instructions of a single request with both images.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+
+    Returns:
+        dict: Instructions with both tasks and the response schemas of both stages.
     """
-    if session_id not in store:
-        store[session_id] = InMemoryChatMessageHistory()
-    return store[session_id]
+    a1, a2 = process_prompts["a1_instructions"], process_prompts["a2_instructions"]
+    return {"role": a1["role"],
+            "input_overview": "You are provided with two images: the first one is a digital advertisement, "
+                              "the second one is the attention heatmap of the same advertisement.",
+            "task": f"Task for the first image. {a1['input_overview']} {a1['task']}\n"
+                    f"Task for the second image. {a2['input_overview']} {a2['task']}\n"
+                    "Provide the answers to all tasks in a single JSON object.",
+            "response_schemas": a1["response_schemas"] + a2["response_schemas"]}
 
 
-def run_process(image: bytes, prompt: BasePrompt, chat_template: ChatPromptTemplate, session_config: dict) -> dict:
-    """Runs the image processing pipeline with the given prompt and configuration.
+def create_combined_chat_template(prompt: BasePrompt | None = None) -> ChatPromptTemplate:
+    """Creates the chat prompt template of the combined A1+A2 request.
+
+    Args:
+        prompt (BasePrompt | None): Prompt of the stage; the template does not depend on it.
+
+    Returns:
+        ChatPromptTemplate: Template with the instructions, the advert and its heatmap.
+    """
+    return ChatPromptTemplate.from_messages([
+        ("system", "{prompt_role}"),
+        ("system", "{task_instruction}"),
+        ("system", "{response_template}"),
+        (
+            "user",
+            [
+                {"type": "text", "text": "The first image: the advertisement."},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "{image}", "detail": "{image_detail}"},
+                },
+                {"type": "text", "text": "The second image: the attention heatmap of the advertisement."},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "{heatmap_image}", "detail": "{heatmap_detail}"},
+                },
+            ],
+        ),
+    ])
+
+
+def create_combined_chain(chat_template: ChatPromptTemplate, output_parser: BaseOutputParser,
+                          model: Runnable) -> Runnable:
+    """Creates the chain of the combined A1+A2 request.
 
     Args:
-        image_path (bytes): Image file to be processed.
-        prompt (BasePrompt): The prompt containing instructions for the LLM.
         chat_template (ChatPromptTemplate): Template for creating the chat prompt.
+        output_parser (BaseOutputParser): Parser of the output with the keys of both stages.
+        model (Runnable): The chat model.
+
+    Returns:
+        Runnable: The chain ending with the output parser.
+    """
+    return chat_template | model | output_parser
+
+
+SUMMARY_OVERVIEW = ("You are now provided with a summary of the attention heatmap of the same image. The attention "
+                    "heatmap was predicted by an AI model that was trained on eye-tracking data. The summary lists "
+                    "the regions of the advert which get the most attention, with their position, peak attention "
+                    "level, share of the total attention and bounding box in pixels of the advert.")
+CROPS_OVERVIEW = " You are also provided with crops of the advert at these regions, side by side in the same order."
+
+
+def summary_instructions(process_prompts: dict, crops: bool = False) -> dict:
+    """Returns the A2 instructions for the heatmap summary instead of the heatmap image.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        crops (bool): Whether the crops of the advert at the regions are sent too.
+
+    Returns:
+        dict: The A2 instructions with the input overview of the summary.
+    """
+    return process_prompts["a2_instructions"] | {"input_overview": SUMMARY_OVERVIEW + (CROPS_OVERVIEW if crops else "")}
+
+
+def create_summary_chat_template(prompt: BasePrompt | None = None) -> ChatPromptTemplate:
+    """Creates the chat prompt template of A2 with the heatmap summary.
+
+    Args:
+        prompt (BasePrompt | None): Prompt of the stage; the template does not depend on it.
+
+    Returns:
+        ChatPromptTemplate: Template with the stage instructions, the session history and the summary.
+    """
+    return ChatPromptTemplate.from_messages([
+        ("system", "{prompt_role}"),
+        ("system", "{task_instruction}"),
+        ("system", "{response_template}"),
+        MessagesPlaceholder(variable_name="history"),
+        ("user", "{heatmap_summary}"),
+    ])
+
+
+def create_crops_chat_template(prompt: BasePrompt | None = None) -> ChatPromptTemplate:
+    """Creates the chat prompt template of A2 with the heatmap summary and the crops of the advert.
+
+    Args:
+        prompt (BasePrompt | None): Prompt of the stage; the template does not depend on it.
+
+    Returns:
+        ChatPromptTemplate: Template with the stage instructions, the session history, the summary and the crops.
+    """
+    return ChatPromptTemplate.from_messages([
+        ("system", "{prompt_role}"),
+        ("system", "{task_instruction}"),
+        ("system", "{response_template}"),
+        MessagesPlaceholder(variable_name="history"),
+        (
+            "user",
+            [
+                {"type": "text", "text": "{heatmap_summary}"},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "{image}", "detail": "{image_detail}"},
+                },
+            ],
+        ),
+    ])
+
+
+def create_summary_chain(chat_template: ChatPromptTemplate, output_parser: BaseOutputParser,
+                         model: Runnable) -> RunnableWithMessageHistory:
+    """Creates the chain of A2 with the heatmap summary, which keeps the request chat history.
+
+    Args:
+        chat_template (ChatPromptTemplate): Template for creating the chat prompt.
+        output_parser (BaseOutputParser): Parser of the stage output; it is applied after the history update.
+        model (Runnable): The chat model.
+
+    Returns:
+        RunnableWithMessageHistory: The chain with message history.
+    """
+    return RunnableWithMessageHistory(chat_template | model, AppConfig().session_histories.get_session_history,
+                                      input_messages_key="heatmap_summary", history_messages_key="history")
+
+
+registry.register("a1", create_chat_template, create_chain)
+registry.register("a2", create_chat_template, create_chain)
+registry.register("a", create_combined_chat_template, create_combined_chain,
+                  lambda prompts_config: combined_instructions(prompts_config["a_process"]))
+registry.register("a2_summary", create_summary_chat_template, create_summary_chain,
+                  lambda prompts_config: summary_instructions(prompts_config["a_process"]))
+registry.register("a2_crops", create_crops_chat_template, create_summary_chain,
+                  lambda prompts_config: summary_instructions(prompts_config["a_process"], crops=True))
+
+
+def prepare_process(image: RequestImage, stage: CompiledStage, policy: image_policy.ImagePolicy):
+    """Builds the inputs of a single process A stage.
+
+    Args:
+        image (RequestImage): Image file to be processed.
+        stage (CompiledStage): The compiled prompt of the stage.
+        policy (image_policy.ImagePolicy): Detail level and resolution of the image.
+
+    Returns:
+        dict: The input dictionary of the runnable with message history.
+    """
+    inputs = {"prompt_role": stage.prompt.role,
+              "task_instruction": stage.task_instruction,
+              "image": image_policy.image_url(image, policy),
+              "image_detail": policy.detail}
+    return inputs
+
+
+def find_heatmap_regions(process_prompts: dict, advert_image: RequestImage,
+                         advert_heatmap_image: RequestImage) -> list[heatmap.HeatmapRegion]:
+    """Finds the attention regions of the heatmap with the "heatmap_summary" settings of process A.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        advert_image (RequestImage): The advert.
+        advert_heatmap_image (RequestImage): The heatmap of the advert.
+
+    Returns:
+        list[heatmap.HeatmapRegion]: The regions in the order of decreasing attention share.
+    """
+    settings = process_prompts.get("heatmap_summary", {})
+    return heatmap.find_regions(advert_heatmap_image, advert_image.size, settings.get("max_regions", 5),
+                                settings.get("min_share", 0.02))
+
+
+def prepare_a2(process_prompts: dict, advert_image: RequestImage, advert_heatmap_image: RequestImage):
+    """Compiles the A2 stage for the heatmap mode of process A and builds its inputs.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        advert_image (RequestImage): The advert.
+        advert_heatmap_image (RequestImage): The heatmap of the advert.
+
+    Returns:
+        tuple: The compiled stage and the input dictionary of its runnable with message history.
+    """
+    policy = image_policy.ImagePolicy.from_config(process_prompts, "a2")
+    if process_prompts.get("heatmap_mode", "image") == "image":
+        stage = registry.get("a2", process_prompts["a2_instructions"])
+        return stage, prepare_process(advert_heatmap_image, stage, policy)
+
+    regions = find_heatmap_regions(process_prompts, advert_image, advert_heatmap_image)
+    with_crops = process_prompts.get("heatmap_summary", {}).get("crops", False)
+    crops = heatmap.crop_strip(advert_image, regions) if with_crops else None
+    stage = registry.get("a2_crops" if crops else "a2_summary", summary_instructions(process_prompts, bool(crops)))
+    inputs = {"prompt_role": stage.prompt.role,
+              "task_instruction": stage.task_instruction,
+              "heatmap_summary": heatmap.summarize(regions)}
+    if crops:
+        inputs |= {"image": image_policy.image_url(crops, policy), "image_detail": policy.detail}
+    return stage, inputs
+
+
+def local_output(process_prompts: dict, advert_image: RequestImage, advert_heatmap_image: RequestImage) -> dict:
+    """Builds the A2 output from the heatmap summary, without a model request.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        advert_image (RequestImage): The advert.
+        advert_heatmap_image (RequestImage): The heatmap of the advert.
+
+    Returns:
+        dict: The summary under every key of the A2 response schemas.
+    """
+    summary = heatmap.summarize(find_heatmap_regions(process_prompts, advert_image, advert_heatmap_image))
+    return {schema["name"]: summary for schema in process_prompts["a2_instructions"]["response_schemas"]}
+
+
+def prepare_combined(process_prompts: dict, advert_image: RequestImage, advert_heatmap_image: RequestImage):
+    """Builds the chain and the inputs of the combined A1+A2 request.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        advert_image (RequestImage): The advert.
+        advert_heatmap_image (RequestImage): The heatmap of the advert.
+
+    Returns:
+        tuple: The compiled stage, whose chain ends with the output parser, and its input dictionary.
+    """
+    stage = registry.get("a", combined_instructions(process_prompts))
+    advert_policy = image_policy.ImagePolicy.from_config(process_prompts, "a1")
+    heatmap_policy = image_policy.ImagePolicy.from_config(process_prompts, "a2")
+    inputs = {"prompt_role": stage.prompt.role,
+              "task_instruction": stage.task_instruction,
+              "image": image_policy.image_url(advert_image, advert_policy),
+              "image_detail": advert_policy.detail,
+              "heatmap_image": image_policy.image_url(advert_heatmap_image, heatmap_policy),
+              "heatmap_detail": heatmap_policy.detail}
+    return stage, inputs
+
+
+def split_output(process_prompts: dict, result: dict) -> tuple[dict, dict]:
+    """Splits an output of process A into the A1 and A2 schema keys.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        result (dict): Output with the keys of both stages.
+
+    Returns:
+        tuple[dict, dict]: The A1 and the A2 output.
+
+    Raises:
+        KeyError: If a key of the stages is missing.
+    """
+    a1, a2 = ({schema["name"]: result[schema["name"]] for schema in process_prompts[instructions]["response_schemas"]}
+              for instructions in ("a1_instructions", "a2_instructions"))
+    return a1, a2
+
+
+def run_process(process_prompts: dict, stage: CompiledStage, inputs: dict, session_config: dict) -> dict:
+    """Runs the image processing pipeline with the given prompt and configuration.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        stage (CompiledStage): The compiled prompt of the stage.
+        inputs (dict): The input dictionary of the stage runnable with message history.
         session_config (dict): Configuration dictionary for the session.
 
     Returns:
@@ -51,35 +355,116 @@ def run_process(image: bytes, prompt: BasePrompt, chat_template: ChatPromptTempl
     Raises:
         LLMException: If an error occurs during the LLM processing.
     """
-    app_config = AppConfig()
-    output_parser = StructuredOutputParser.from_response_schemas(prompt.response_template)
-    chain = chat_template | app_config.model
-    with_message_history = RunnableWithMessageHistory(chain, get_session_history, input_messages_key="image",
-                                                      history_messages_key="history")
+    history = AppConfig().session_histories.get_session_history(session_config["configurable"]["session_id"])
+    start = len(history.messages)
 
-    base64_image = utils.encode_image(image)
+    native = model_routing.native_output(process_prompts)
+
+    def attempt(model: Runnable, final: bool) -> dict:
+        del history.messages[start:]  # an escalated model does not see the output which failed
+        result = stage.chain(model, native).invoke(inputs, config=session_config)
+        return stage.parser(native).parse(result.content)  # Here to be able to drop the entire line as a memory.
 
     try:
-        result = with_message_history.invoke(
-            {"prompt_role": prompt.role,
-             "task_instruction": prompt.input_overview + "\n" + prompt.task,
-             "response_template": output_parser.get_format_instructions(),
-             "image": base64_image},
-            config=session_config)
-        result = output_parser.parse(result.content)  # Here to be able to drop the entire line as a memory.
+        result = model_routing.run(process_prompts, attempt)
     except Exception as e:
         raise LLMException(str(e))
 
     return result
 
 
-def pipeline(process_prompts: dict, advert_image: bytes, advert_heatmap_image: bytes) -> dict:
+async def arun_process(process_prompts: dict, stage: CompiledStage, inputs: dict, session_config: dict) -> dict:
+    """Asynchronous version of run_process.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        stage (CompiledStage): The compiled prompt of the stage.
+        inputs (dict): The input dictionary of the stage runnable with message history.
+        session_config (dict): Configuration dictionary for the session.
+
+    Returns:
+        dict: The result of the LLM processing, parsed into a structured format.
+
+    Raises:
+        LLMException: If an error occurs during the LLM processing.
+    """
+    history = AppConfig().session_histories.get_session_history(session_config["configurable"]["session_id"])
+    start = len(history.messages)
+
+    native = model_routing.native_output(process_prompts)
+
+    async def attempt(model: Runnable, final: bool) -> dict:
+        del history.messages[start:]
+        result = await stage.chain(model, native).ainvoke(inputs, config=session_config)
+        return stage.parser(native).parse(result.content)
+
+    try:
+        result = await model_routing.arun(process_prompts, attempt)
+    except Exception as e:
+        raise LLMException(str(e))
+
+    return result
+
+
+def run_combined(process_prompts: dict, advert_image: RequestImage,
+                 advert_heatmap_image: RequestImage) -> tuple[dict, dict]:
+    """Runs A1 and A2 as a single request with both images.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        advert_image (RequestImage): The advert.
+        advert_heatmap_image (RequestImage): The heatmap of the advert.
+
+    Returns:
+        tuple[dict, dict]: The A1 and A2 results.
+
+    Raises:
+        LLMException: If an error occurs during the LLM processing.
+    """
+    stage, inputs = prepare_combined(process_prompts, advert_image, advert_heatmap_image)
+    native = model_routing.native_output(process_prompts)
+    try:
+        return split_output(process_prompts, model_routing.run(
+            process_prompts, lambda model, final: stage.chain(model, native).invoke(inputs)))
+    except Exception as e:
+        raise LLMException(str(e))
+
+
+async def arun_combined(process_prompts: dict, advert_image: RequestImage,
+                        advert_heatmap_image: RequestImage) -> tuple[dict, dict]:
+    """Asynchronous version of run_combined.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        advert_image (RequestImage): The advert.
+        advert_heatmap_image (RequestImage): The heatmap of the advert.
+
+    Returns:
+        tuple[dict, dict]: The A1 and A2 results.
+
+    Raises:
+        LLMException: If an error occurs during the LLM processing.
+    """
+    stage, inputs = await asyncio.to_thread(prepare_combined, process_prompts, advert_image, advert_heatmap_image)
+    native = model_routing.native_output(process_prompts)
+    try:
+        result = await model_routing.arun(process_prompts,
+                                          lambda model, final: stage.chain(model, native).ainvoke(inputs))
+        return split_output(process_prompts, result)
+    except Exception as e:
+        raise LLMException(str(e))
+
+
+def pipeline(process_prompts: dict, advert_image: RequestImage, advert_heatmap_image: RequestImage,
+             progress=None) -> dict:
     """Executes the processing pipeline with the provided prompts and image paths.
 
     Args:
         process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
-        advert_image (bytes): Image file for the first processing stage.
-        advert_heatmap_image (bytes): Image file for the second processing stage.
+        advert_image (RequestImage): Image file for the first processing stage.
+        advert_heatmap_image (RequestImage): Image file for the second processing stage.
+        progress (Callable[..., None] | None): Optional callback receiving the stage ("A1", "A2"), its status
+                                               ("running", "done") and the output of a finished stage.
 
     Returns:
         dict: The combined result of both processing stages.
@@ -88,36 +473,102 @@ def pipeline(process_prompts: dict, advert_image: bytes, advert_heatmap_image: b
         LLMException: If an error occurs during the LLM processing.
     """
     app_config = AppConfig()
-    session_config = {"configurable": {"session_id": "procA"}}
 
     app_config.process_logger.info("Start process A")
-    a1_prompt = BasePrompt(**process_prompts["a1_instructions"])
-    a2_prompt = BasePrompt(**process_prompts["a2_instructions"])
+    if process_prompts.get("mode") == "combined":
+        utils.report_progress(progress, "A1", "running")
+        utils.report_progress(progress, "A2", "running")
+        a1, a2 = run_combined(process_prompts, advert_image, advert_heatmap_image)
+        utils.report_progress(progress, "A1", "done", a1)
+        utils.report_progress(progress, "A2", "done", a2)
+        result = a1 | a2
+        app_config.process_logger.info(result)
+        return result
 
-    chat_template = ChatPromptTemplate.from_messages([
-        # tdo change prompt потому что оно скорее на свои штуки отвлекается чем на картинку, показать эксперимент со второй картинкой
-        ("system", "{prompt_role}"),
-        ("system", "{task_instruction}"),
-        ("system", "{response_template}"),
-        MessagesPlaceholder(variable_name="history"),
-        (
-            "user",
-            [
-                {
-                    "type": "image_url",
-                    "image_url": {"url": "data:image/jpeg;base64,{image}"},
-                }
-            ],
-        ),
-    ])
+    a1_stage = registry.get("a1", process_prompts["a1_instructions"])
+
+    # A2 sees the A1 messages of the same request only
+    with app_config.session_histories.session() as session_id:
+        session_config = {"configurable": {"session_id": session_id}}
+
+        app_config.process_logger.info("Start process A1")
+        utils.report_progress(progress, "A1", "running")
+        with metrics.trace_scope(stage="A1"):
+            a1_inputs = prepare_process(advert_image, a1_stage,
+                                        image_policy.ImagePolicy.from_config(process_prompts, "a1"))
+            a1 = run_process(process_prompts, a1_stage, a1_inputs, session_config)
+        utils.report_progress(progress, "A1", "done", a1)
+
+        app_config.process_logger.info("Start process A2")
+        utils.report_progress(progress, "A2", "running")
+        with metrics.trace_scope(stage="A2"):
+            if process_prompts.get("heatmap_mode") == "skip":
+                a2 = local_output(process_prompts, advert_image, advert_heatmap_image)
+            else:
+                a2_stage, a2_inputs = prepare_a2(process_prompts, advert_image, advert_heatmap_image)
+                a2 = run_process(process_prompts, a2_stage, a2_inputs, session_config)
+        utils.report_progress(progress, "A2", "done", a2)
+
+    result = a1 | a2
+    app_config.process_logger.info(result)
+    return result
+
+
+async def apipeline(process_prompts: dict, advert_image: RequestImage, advert_heatmap_image: RequestImage,
+                    progress=None) -> dict:
+    """Asynchronous version of pipeline.
+
+    The images are decoded, analysed and encoded in worker threads, so they do not block the event loop.
+
+    Args:
+        process_prompts (dict): Dictionary containing prompts and instructions for the processing stages.
+        advert_image (RequestImage): Image file for the first processing stage.
+        advert_heatmap_image (RequestImage): Image file for the second processing stage.
+        progress (Callable[..., None] | None): Optional callback receiving the stage, its status and output.
+
+    Returns:
+        dict: The combined result of both processing stages.
+
+    Raises:
+        LLMException: If an error occurs during the LLM processing.
+    """
+    app_config = AppConfig()
+
+    app_config.process_logger.info("Start process A")
+    if process_prompts.get("mode") == "combined":
+        utils.report_progress(progress, "A1", "running")
+        utils.report_progress(progress, "A2", "running")
+        a1, a2 = await arun_combined(process_prompts, advert_image, advert_heatmap_image)
+        utils.report_progress(progress, "A1", "done", a1)
+        utils.report_progress(progress, "A2", "done", a2)
+        result = a1 | a2
+        app_config.process_logger.info(result)
+        return result
+
+    a1_stage = registry.get("a1", process_prompts["a1_instructions"])
+
+    with app_config.session_histories.session() as session_id:
+        session_config = {"configurable": {"session_id": session_id}}
 
-    app_config.process_logger.info("Start process A1")
-    a1 = run_process(advert_image, a1_prompt, chat_template, session_config)
+        app_config.process_logger.info("Start process A1")
+        utils.report_progress(progress, "A1", "running")
+        with metrics.trace_scope(stage="A1"):
+            a1_inputs = await asyncio.to_thread(prepare_process, advert_image, a1_stage,
+                                                image_policy.ImagePolicy.from_config(process_prompts, "a1"))
+            a1 = await arun_process(process_prompts, a1_stage, a1_inputs, session_config)
+        utils.report_progress(progress, "A1", "done", a1)
 
-    app_config.process_logger.info("Start process A2")
-    a2 = run_process(advert_heatmap_image, a2_prompt, chat_template, session_config)
+        app_config.process_logger.info("Start process A2")
+        utils.report_progress(progress, "A2", "running")
+        with metrics.trace_scope(stage="A2"):
+            if process_prompts.get("heatmap_mode") == "skip":
+                a2 = await asyncio.to_thread(local_output, process_prompts, advert_image, advert_heatmap_image)
+            else:
+                a2_stage, a2_inputs = await asyncio.to_thread(prepare_a2, process_prompts, advert_image,
+                                                              advert_heatmap_image)
+                a2 = await arun_process(process_prompts, a2_stage, a2_inputs, session_config)
+        utils.report_progress(progress, "A2", "done", a2)
 
     result = a1 | a2
     app_config.process_logger.info(result)
-    store.clear()
     return result
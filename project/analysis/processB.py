@@ -1,85 +1,240 @@
 """This module provides functionality for processing images and generating results based on provided configurations.
 
 It includes functions for retrieving help information from a PDF and running
-the image processing pipeline.
+the image processing pipeline. Depending on "features_mode", the visual complexity features of the advert
+(see features) are added to the prompt and to the output, and may replace the full image with a thumbnail.
 """
-from langchain.output_parsers import StructuredOutputParser
-from langchain_community.document_loaders import PyPDFLoader
+import asyncio
+
+from langchain_core.output_parsers import BaseOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
 
-from analysis import utils
+from analysis import features, image_policy, model_routing
 from analysis.base_prompt import BasePrompt
-from common import LLMException
+from analysis.registry import registry
+from analysis.request_image import RequestImage
+from common import LLMException, metrics
 from config.config import AppConfig
 
+THUMBNAIL_POLICY = image_policy.ImagePolicy(detail="low")  # at most 512x512 px, billed as a low detail image
+THUMBNAIL_NOTE = "\nThe image is a low resolution thumbnail; rely on the features for its details."
+
 
 def get_help_info(process_prompts: dict) -> str:
     """Retrieves help information from a PDF document specified in the process prompts.
 
+    The text is served from the application helper document cache, so the document is only
+    downloaded and parsed when its version changes. If "helper_doc_retrieval" is configured, only the
+    chunks of the document most relevant to the process B task are returned, within its token budget.
+
     Args:
         process_prompts (dict): A dictionary containing configuration information,
-                                including the path to the helper document.
+                                including the path to the helper document and optionally
+                                the path to its pre-extracted text ("helper_doc_text_path")
+                                and the retrieval settings ("helper_doc_retrieval").
 
     Returns:
-        str: The combined text content from all pages of the PDF document.
+        str: The relevant text content of the PDF document.
     """
-    doc_path = process_prompts["helper_doc_path"]
-    loader = PyPDFLoader(doc_path, extract_images=True)
-    help_info = "\n".join([page.page_content for page in loader.load()])
-    return help_info
+    app_config = AppConfig()
+    with metrics.local_seconds.time(operation="helper_doc"):
+        text = app_config.helper_doc_cache.get(process_prompts["helper_doc_path"],
+                                               process_prompts.get("helper_doc_text_path"))
+        retrieval = process_prompts.get("helper_doc_retrieval")
+        if not retrieval or not retrieval["top_k"]:
+            return text
 
+        index = app_config.helper_doc_index.get(text, retrieval["chunk_tokens"], retrieval["chunk_overlap"])
+        instructions = process_prompts["b_instructions"]
+        return index.select(instructions["input_overview"] + "\n" + instructions["task"], retrieval["top_k"],
+                            retrieval["token_budget"])
 
-def pipeline(process_prompts: dict, advert_image: bytes) -> dict:
-    """Executes the processing pipeline using the provided prompts and image path.
 
-    It retrieves help information from a PDF, constructs a chat prompt template,
-    and processes the image with the LLM.
+def create_chat_template(prompt: BasePrompt) -> ChatPromptTemplate:
+    """Creates the chat prompt template of process B.
 
     Args:
-        process_prompts (dict): A dictionary containing configuration information,
-                                including prompts and instructions for processing.
-        advert_image (bytes): Image file to be processed.
+        prompt (BasePrompt): The prompt containing instructions for the LLM.
 
     Returns:
-        dict: The result of the image processing, parsed into a structured format.
+        ChatPromptTemplate: Template with the instructions, the helper document and the image.
+    """
+    return ChatPromptTemplate.from_messages([
+        ("system", prompt.role),
+        ("system", "{task_instruction}"),
+        ("system", "{response_template}"),
+        ("system", "When completing the task, you will need the following information {help_info}"),
+        (
+            "user",
+            [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "{image}", "detail": "{image_detail}"},
+                }
+            ],
+        ),
+    ])
 
-    Raises:
-        LLMException: If an error occurs during the LLM processing.
+
+def create_chain(chat_template: ChatPromptTemplate, output_parser: BaseOutputParser,
+                 model: Runnable) -> Runnable:
+    """Creates the process B chain.
+
+    Args:
+        chat_template (ChatPromptTemplate): Template for creating the chat prompt.
+        output_parser (BaseOutputParser): Parser of the stage output.
+        model (Runnable): The chat model.
+
+    Returns:
+        Runnable: The chain ending with the output parser.
     """
-    app_config = AppConfig()
-    app_config.process_logger.info("Start process B")
-    help_info = get_help_info(process_prompts)
-    prompt = BasePrompt(**process_prompts["b_instructions"])
+    return chat_template | model | output_parser
+
+
+def create_features_chat_template(prompt: BasePrompt) -> ChatPromptTemplate:
+    """Creates the chat prompt template of process B with the visual complexity features of the image.
 
-    chat_template = ChatPromptTemplate.from_messages([
+    Args:
+        prompt (BasePrompt): The prompt containing instructions for the LLM.
+
+    Returns:
+        ChatPromptTemplate: Template with the instructions, the helper document, the features and the image.
+    """
+    return ChatPromptTemplate.from_messages([
         ("system", prompt.role),
         ("system", "{task_instruction}"),
         ("system", "{response_template}"),
         ("system", "When completing the task, you will need the following information {help_info}"),
+        ("system", "Visual complexity features measured on the image:\n{visual_features}"),
         (
             "user",
             [
                 {
                     "type": "image_url",
-                    "image_url": {"url": "data:image/jpeg;base64,{image}"},
+                    "image_url": {"url": "{image}", "detail": "{image_detail}"},
                 }
             ],
         ),
     ])
 
-    output_parser = StructuredOutputParser.from_response_schemas(prompt.response_template)
-    chain = chat_template | app_config.model | output_parser
 
-    base64_image = utils.encode_image(advert_image)
+registry.register("b", create_chat_template, create_chain)
+registry.register("b_features", create_features_chat_template, create_chain,
+                  lambda prompts_config: prompts_config["b_process"]["b_instructions"])
+
+
+def get_visual_features(process_prompts: dict, advert_image: RequestImage) -> dict | None:
+    """Returns the visual complexity features of the advert if the "features_mode" of process B uses them.
+
+    Args:
+        process_prompts (dict): A dictionary containing prompts and instructions for processing.
+        advert_image (RequestImage): Image file to be processed.
+
+    Returns:
+        dict | None: The features, or None if "features_mode" is "off".
+    """
+    if process_prompts.get("features_mode", "off") == "off":
+        return None
+    return features.get_features([advert_image])[0]
+
+
+def prepare_chain(process_prompts: dict, advert_image: RequestImage, help_info: str,
+                  visual_features: dict | None = None):
+    """Compiles the process B stage and builds its inputs.
+
+    Args:
+        process_prompts (dict): A dictionary containing prompts and instructions for processing.
+        advert_image (RequestImage): Image file to be processed.
+        help_info (str): Text of the helper document.
+        visual_features (dict | None): Visual complexity features of the image, see get_visual_features.
+
+    Returns:
+        tuple: The compiled stage, whose chain ends with the output parser, and its input dictionary.
+    """
+    if visual_features is None:
+        stage = registry.get("b", process_prompts["b_instructions"])
+        policy = image_policy.ImagePolicy.from_config(process_prompts, "b")
+    else:
+        stage = registry.get("b_features", process_prompts["b_instructions"])
+        thumbnail = process_prompts.get("features_mode") == "features_only"
+        policy = THUMBNAIL_POLICY if thumbnail else image_policy.ImagePolicy.from_config(process_prompts, "b")
+    inputs = {"task_instruction": stage.task_instruction,
+              "help_info": help_info,
+              "image": image_policy.image_url(advert_image, policy),
+              "image_detail": policy.detail}
+    if visual_features is not None:
+        inputs["visual_features"] = features.describe(visual_features) + (THUMBNAIL_NOTE if thumbnail else "")
+    return stage, inputs
+
+
+def pipeline(process_prompts: dict, advert_image: RequestImage) -> dict:
+    """Executes the processing pipeline using the provided prompts and image path.
+
+    It retrieves help information from a PDF, constructs a chat prompt template,
+    and processes the image with the LLM.
+
+    Args:
+        process_prompts (dict): A dictionary containing configuration information,
+                                including prompts and instructions for processing.
+        advert_image (RequestImage): Image file to be processed.
+
+    Returns:
+        dict: The result of the image processing, parsed into a structured format, with the "visual_features"
+              of the image unless "features_mode" is "off".
+
+    Raises:
+        LLMException: If an error occurs during the LLM processing.
+    """
+    app_config = AppConfig()
+    app_config.process_logger.info("Start process B")
+    help_info = get_help_info(process_prompts)
+    visual_features = get_visual_features(process_prompts, advert_image)
+    stage, inputs = prepare_chain(process_prompts, advert_image, help_info, visual_features)
+
+    native = model_routing.native_output(process_prompts)
+    try:
+        result = model_routing.run(process_prompts, lambda model, final: stage.chain(model, native).invoke(inputs))
+    except Exception as e:
+        raise LLMException(str(e))
+
+    if visual_features is not None:
+        result["visual_features"] = visual_features
+    app_config.process_logger.info(result)
+    return result
+
+
+async def apipeline(process_prompts: dict, advert_image: RequestImage) -> dict:
+    """Asynchronous version of pipeline.
+
+    The helper document is read in a worker thread, since it may hit the disk or the network.
+
+    Args:
+        process_prompts (dict): A dictionary containing configuration information,
+                                including prompts and instructions for processing.
+        advert_image (RequestImage): Image file to be processed.
+
+    Returns:
+        dict: The result of the image processing, parsed into a structured format, with the "visual_features"
+              of the image unless "features_mode" is "off".
+
+    Raises:
+        LLMException: If an error occurs during the LLM processing.
+    """
+    app_config = AppConfig()
+    app_config.process_logger.info("Start process B")
+    help_info = await asyncio.to_thread(get_help_info, process_prompts)
+    visual_features = await asyncio.to_thread(get_visual_features, process_prompts, advert_image)
+    stage, inputs = prepare_chain(process_prompts, advert_image, help_info, visual_features)
 
+    native = model_routing.native_output(process_prompts)
     try:
-        result = chain.invoke(
-            {"task_instruction": prompt.input_overview + "\n" + prompt.task,
-             "response_template": output_parser.get_format_instructions(),
-             "help_info": help_info,
-             "image": base64_image})
+        result = await model_routing.arun(process_prompts,
+                                          lambda model, final: stage.chain(model, native).ainvoke(inputs))
     except Exception as e:
         raise LLMException(str(e))
 
+    if visual_features is not None:
+        result["visual_features"] = visual_features
     app_config.process_logger.info(result)
     return result
@@ -1,19 +1,99 @@
 """This module provides functionality for processing outputs from different stages.
 
-It includes a function for executing the final processing stage of the pipeline.
+It includes a function for executing the final processing stage of the pipeline, optionally streaming its tokens.
+Model responses which are not valid JSON are escalated to the next model of the stage, if one is configured;
+otherwise they get a cheap repair pass that only re-asks for the JSON.
 """
 
-from langchain.output_parsers import StructuredOutputParser
+from langchain.output_parsers import OutputFixingParser
+from langchain.output_parsers.prompts import NAIVE_FIX_PROMPT
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import BaseOutputParser, StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
 
+from analysis import model_routing
 from analysis.base_prompt import BasePrompt
+from analysis.registry import registry
 from common import LLMException
 from config.config import AppConfig
 
 
+def create_chat_template(prompt: BasePrompt) -> ChatPromptTemplate:
+    """Creates the chat prompt template of process C.
+
+    Args:
+        prompt (BasePrompt): The prompt containing instructions for the LLM.
+
+    Returns:
+        ChatPromptTemplate: Template with the instructions and the outputs of the previous stages.
+    """
+    return ChatPromptTemplate.from_messages([
+        ("system", prompt.role),
+        ("system", "{task_instruction}"),
+        ("system", "{response_template}"),
+        (
+            "user", "First multi-modal LLM output {first_output}. Second multi-modal LLM output {second_output}."
+        ),
+    ])
+
+
+def create_chain(chat_template: ChatPromptTemplate, output_parser: BaseOutputParser,
+                 model: Runnable) -> Runnable:
+    """Creates the process C chain; the output is parsed separately to be able to repair it.
+
+    Args:
+        chat_template (ChatPromptTemplate): Template for creating the chat prompt.
+        output_parser (BaseOutputParser): Parser of the stage output.
+        model (Runnable): The chat model.
+
+    Returns:
+        Runnable: The chain returning the raw model text.
+    """
+    return chat_template | model | StrOutputParser()
+
+
+registry.register("c", create_chat_template, create_chain)
+
+
+def prepare_chain(process_prompts: dict, a_output: dict, b_output: dict):
+    """Compiles the process C stage and builds its inputs.
+
+    Args:
+        process_prompts (dict): A dictionary containing prompts and instructions for the processing stages.
+        a_output (dict): The output from the first processing stage.
+        b_output (dict): The output from the second processing stage.
+
+    Returns:
+        tuple: The compiled stage, whose chain returns the raw model text, and its input dictionary.
+    """
+    stage = registry.get("c", process_prompts["c_instructions"])
+    inputs = {"task_instruction": stage.task_instruction,
+              "first_output": a_output,
+              "second_output": b_output}
+    return stage, inputs
+
+
+def create_repair_parser(output_parser: BaseOutputParser, model: Runnable) -> OutputFixingParser:
+    """Creates a parser which asks the model once to fix a response that cannot be parsed.
+
+    Args:
+        output_parser (BaseOutputParser): Parser of the stage output.
+        model (Runnable): The chat model asked for the fix.
+
+    Returns:
+        OutputFixingParser: Parser re-asking the model for valid JSON only, without the stage inputs.
+    """
+    return OutputFixingParser(parser=output_parser, retry_chain=NAIVE_FIX_PROMPT | model | StrOutputParser(),
+                              max_retries=1)
+
+
 def pipeline(process_prompts: dict, a_output: dict, b_output: dict) -> list:
     """Executes the final processing stage using the provided prompts and outputs from previous stages.
 
+    An output which cannot be parsed is escalated to the next model of the stage, if there is one;
+    the output of the last model gets a repair pass.
+
     Args:
         process_prompts (dict): A dictionary containing prompts and instructions for the processing stages.
                                 Specifically, it should include "c_instructions" with details for this stage.
@@ -29,28 +109,75 @@ def pipeline(process_prompts: dict, a_output: dict, b_output: dict) -> list:
     app_config = AppConfig()
 
     app_config.process_logger.info("Start process C")
-    prompt = BasePrompt(**process_prompts["c_instructions"])
+    stage, inputs = prepare_chain(process_prompts, a_output, b_output)
+    native = model_routing.native_output(process_prompts)
 
-    chat_template = ChatPromptTemplate.from_messages([
-        ("system", prompt.role),
-        ("system", "{task_instruction}"),
-        ("system", "{response_template}"),
-        (
-            "user", "First multi-modal LLM output {first_output}. Second multi-modal LLM output {second_output}."
-        ),
-    ])
-
-    output_parser = StructuredOutputParser.from_response_schemas(prompt.response_template)
-    chain = chat_template | app_config.model | output_parser
+    def attempt(model: Runnable, final: bool) -> dict:
+        completion = stage.chain(model, native).invoke(inputs)
+        try:
+            return stage.parser(native).parse(completion)
+        except OutputParserException as e:
+            if not final:
+                raise
+            app_config.process_logger.warning(f"Process C output cannot be parsed, repairing it: {e}")
+            return create_repair_parser(stage.parser(native), model).parse(completion)
 
     try:
-        dict_result = chain.invoke(
-            {"task_instruction": prompt.input_overview + "\n" + prompt.task,
-             "response_template": output_parser.get_format_instructions(),
-             "first_output": a_output,
-             "second_output": b_output})
+        dict_result = model_routing.run(process_prompts, attempt)
     except Exception as e:
         raise LLMException(str(e))
 
     list_result = [dict_result]
     return list_result
+
+
+async def apipeline(process_prompts: dict, a_output: dict, b_output: dict, on_token=None) -> list:
+    """Asynchronous version of pipeline.
+
+    Args:
+        process_prompts (dict): A dictionary containing prompts and instructions for the processing stages.
+        a_output (dict): The output from the first processing stage, used as input to this stage.
+        b_output (dict): The output from the second processing stage, used as input to this stage.
+        on_token (Callable[[str], None] | None): If set, the completion of the first model is streamed and this
+                                                 callback receives its text chunks as they arrive; completions of
+                                                 escalated models are not streamed.
+
+    Returns:
+        list: A list containing the result of the final processing stage.
+
+    Raises:
+        LLMException: If an error occurs during the LLM processing.
+    """
+    app_config = AppConfig()
+
+    app_config.process_logger.info("Start process C")
+    stage, inputs = prepare_chain(process_prompts, a_output, b_output)
+    native = model_routing.native_output(process_prompts)
+    streamed = False
+
+    async def attempt(model: Runnable, final: bool) -> dict:
+        nonlocal streamed
+        chain = stage.chain(model, native)
+        if on_token is None or streamed:
+            completion = await chain.ainvoke(inputs)
+        else:
+            streamed = True
+            chunks = []
+            async for chunk in chain.astream(inputs):
+                chunks.append(chunk)
+                on_token(chunk)
+            completion = "".join(chunks)
+        try:
+            return stage.parser(native).parse(completion)
+        except OutputParserException as e:
+            if not final:
+                raise
+            app_config.process_logger.warning(f"Process C output cannot be parsed, repairing it: {e}")
+            return await create_repair_parser(stage.parser(native), model).aparse(completion)
+
+    try:
+        dict_result = await model_routing.arun(process_prompts, attempt)
+    except Exception as e:
+        raise LLMException(str(e))
+
+    return [dict_result]
@@ -1,8 +1,17 @@
-import json
+import asyncio
+import contextvars
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import yaml
 from analysis import processB, processA
-from analysis import processC
+from analysis import processC, utils
+from analysis.perceptual_hash import hash_image
+from analysis.request_image import RequestImage
+from common import LLMException, metrics
+from common.result_cache import LRUCache, make_key
 from config import AppConfig
 from PIL import Image
 import io
@@ -22,65 +31,655 @@ def load_prompts_config(file_path: str) -> dict:
     return config
 
 
-def resize_image_to_max_size(image_data: bytes, max_size: int):
+MIN_JPEG_QUALITY = 40
+MAX_JPEG_QUALITY = 90
+BYTES_PER_PIXEL_ESTIMATE = 0.1  # lower bound of JPEG bytes per pixel, used to choose the decode resolution
+
+_resized_images = LRUCache(max_entries=256)
+
+
+def encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    """Encodes an image as JPEG.
+
+    Args:
+        image (Image.Image): RGB image to encode.
+        quality (int): JPEG quality.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def resize_image_to_max_size(image_data: bytes, max_size: int) -> bytes:
     """
     Resizes the given image data to ensure its size does not exceed the specified max_size.
 
+    Images are downscaled while decoding (JPEG) or by an integer factor (other formats) to the smallest
+    resolution that can still use the whole budget.
+    Then the highest JPEG quality that fits is found by binary search; if even the lowest quality is too big,
+    the largest scale that fits is found by binary search. Results are cached by the image hash.
+
     Args:
         image_data (bytes): The original image data in bytes.
         max_size (int): The maximum allowed size for the image in bytes.
 
     Returns:
-        bytes: The resized image data in bytes. If the original image is already within the size limit,
-               the original image data is returned.
+        bytes: The resized JPEG image data in bytes, not larger than max_size. If the original image is already
+               within the size limit, the original image data is returned.
     """
+    if len(image_data) <= max_size:
+        return image_data
+
+    cache_key = make_key(image_data, str(max_size))
+    resized = _resized_images.get(cache_key)
+    if resized is not None:
+        return resized
+
     image = Image.open(io.BytesIO(image_data))
+    max_pixels = max_size / BYTES_PER_PIXEL_ESTIMATE
+    if image.width * image.height > max_pixels:
+        draft_scale = (max_pixels / (image.width * image.height)) ** 0.5
+        image.draft('RGB', (int(image.width * draft_scale), int(image.height * draft_scale)))
 
-    if image.mode == 'RGBA':
+    if image.mode != 'RGB':
         image = image.convert('RGB')
 
-    output = io.BytesIO()
-    image.save(output, format='JPEG')
+    reduce_factor = int((image.width * image.height / max_pixels) ** 0.5)
+    if reduce_factor > 1:
+        image = image.reduce(reduce_factor)
 
-    current_size = output.tell()
+    resized = fit_jpeg_quality(image, max_size)
+    if resized is None:
+        resized = fit_jpeg_scale(image, max_size)
 
-    if current_size <= max_size:
-        return image_data
+    _resized_images.set(cache_key, resized)
+    return resized
 
-    scale_factor = (max_size / current_size) ** 0.5
-    new_width = int(image.width * scale_factor)
-    new_height = int(image.height * scale_factor)
 
-    resized_image = image.resize((new_width, new_height), Image.LANCZOS)
+def prepare_image(image: bytes | RequestImage, max_size: int) -> RequestImage:
+    """Wraps an image of the request and downscales it if it is larger than max_size.
 
-    output = io.BytesIO()
-    resized_image.save(output, format='JPEG')
+    Args:
+        image (bytes | RequestImage): The image.
+        max_size (int): The maximum allowed size for the image in bytes.
 
-    return output.getvalue()
+    Returns:
+        RequestImage: The image, or its resized JPEG version.
 
+    Raises:
+        InvalidImageException: If the data is not an image of a supported format.
+    """
+    image = RequestImage.of(image)
+    if image.nbytes <= max_size:
+        return image
+    return RequestImage(resize_image_to_max_size(image.data, max_size))
 
-def run(advert_image: bytes, advert_heatmap_image: bytes) -> list:
+
+def fit_jpeg_quality(image: Image.Image, max_size: int) -> bytes | None:
+    """Finds the highest JPEG quality at which the image fits into max_size.
+
+    Args:
+        image (Image.Image): RGB image to encode.
+        max_size (int): The maximum allowed size for the image in bytes.
+
+    Returns:
+        bytes | None: The encoded image, or None if the image does not fit even at the lowest quality.
+    """
+    best = None
+    low, high = MIN_JPEG_QUALITY, MAX_JPEG_QUALITY
+    while low <= high:
+        quality = (low + high) // 2
+        encoded = encode_jpeg(image, quality)
+        if len(encoded) <= max_size:
+            best = encoded
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+
+def fit_jpeg_scale(image: Image.Image, max_size: int, steps: int = 8) -> bytes:
+    """Finds the largest scale at which the image fits into max_size at the lowest JPEG quality.
+
+    Args:
+        image (Image.Image): RGB image to encode.
+        max_size (int): The maximum allowed size for the image in bytes.
+        steps (int): Number of binary search steps.
+
+    Returns:
+        bytes: The encoded image, never larger than max_size.
+    """
+    best = None
+    low, high = 0.0, 1.0
+    for _ in range(steps):
+        scale = (low + high) / 2
+        size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        encoded = encode_jpeg(image.resize(size, Image.LANCZOS, reducing_gap=2.0), MIN_JPEG_QUALITY)
+        if len(encoded) <= max_size:
+            best = encoded
+            low = scale
+        else:
+            high = scale
+
+    while best is None:
+        # the budget is below the smallest searched scale, keep halving until the image fits
+        size = (max(1, size[0] // 2), max(1, size[1] // 2))
+        encoded = encode_jpeg(image.resize(size, Image.LANCZOS, reducing_gap=2.0), MIN_JPEG_QUALITY)
+        if len(encoded) <= max_size or size == (1, 1):
+            best = encoded
+    return best
+
+
+def stage_cache_keys(advert_image: RequestImage, advert_heatmap_image: RequestImage, prompts_config: dict) -> dict:
+    """Builds the result cache keys of the pipeline and of its cacheable stages.
+
+    The keys depend on the digests of the (resized) images, the model name and the prompts config of the stage,
+    so process B output is reused when only the heatmap changes.
+
+    Args:
+        advert_image (RequestImage): image file to process.
+        advert_heatmap_image (RequestImage): heatmap image file to process.
+        prompts_config (dict): The prompts configuration of the run.
+
+    Returns:
+        dict: Cache keys of the whole pipeline ("result") and of processes "A" and "B".
+    """
+    app_config = AppConfig()
+    advert, heatmap = advert_image.digest, advert_heatmap_image.digest
+    return {"result": make_key(advert, heatmap, app_config.model_name, prompts_config),
+            "A": make_key(advert, heatmap, app_config.model_name, prompts_config["a_process"]),
+            "B": make_key(advert, app_config.model_name, prompts_config["b_process"])}
+
+
+def load_stage_output(stage: str, cache_key: str | None):
+    """Returns the stored output of a stage from the result cache or from the stage checkpoints.
+
+    Args:
+        stage (str): Name of the stage.
+        cache_key (str | None): Cache key of the stage output.
+
+    Returns:
+        Any: The stored output, or None if there is none.
+    """
+    if cache_key is None:
+        return None
+    app_config = AppConfig()
+    result = app_config.result_cache.get(stage, cache_key)
+    if result is None:
+        result = app_config.checkpoints.get(stage, cache_key)
+    metrics.cache_lookups.inc(cache=stage, result="miss" if result is None else "hit")
+    if result is not None:
+        app_config.process_logger.info(f"Process {stage} output is taken from the cache")
+    return result
+
+
+def save_stage_output(stage: str, cache_key: str | None, result):
+    """Stores the output of a stage in the result cache and as a checkpoint.
+
+    Args:
+        stage (str): Name of the stage.
+        cache_key (str | None): Cache key of the stage output. If None, the output is not stored.
+        result (Any): JSON-serializable output of the stage.
+    """
+    if cache_key is None:
+        return
+    app_config = AppConfig()
+    app_config.result_cache.set(stage, cache_key, result)
+    app_config.checkpoints.set(stage, cache_key, result)
+
+
+def config_keys(prompts_config: dict) -> dict:
+    """Builds the keys of the model and prompts config the pipeline and its cacheable stages depend on.
+
+    Args:
+        prompts_config (dict): The prompts configuration of the run.
+
+    Returns:
+        dict: Config keys of the whole pipeline ("result") and of processes "A" and "B".
+    """
+    model_name = AppConfig().model_name
+    return {"result": make_key(model_name, prompts_config),
+            "A": make_key(model_name, prompts_config["a_process"]),
+            "B": make_key(model_name, prompts_config["b_process"])}
+
+
+def perceptual_hashes(advert_image: RequestImage, advert_heatmap_image: RequestImage) -> tuple[int, int] | None:
+    """Computes the perceptual hashes of the images looked up in AppConfig.near_duplicates.
+
+    Args:
+        advert_image (RequestImage): image file to process.
+        advert_heatmap_image (RequestImage): heatmap image file to process.
+
+    Returns:
+        tuple[int, int] | None: Hashes of the advert and of the heatmap, or None if the reuse is disabled.
+    """
+    index = AppConfig().near_duplicates
+    if index is None:
+        return None
+    with metrics.local_seconds.time(operation="perceptual_hash"):
+        return hash_image(advert_image, index.kind), hash_image(advert_heatmap_image, index.kind)
+
+
+def reuse_near_duplicate(hashes: tuple[int, int] | None, cache_keys: dict, prompts_config: dict) -> tuple:
+    """Reuses the stored outputs of an analysed near-duplicate of the images, e.g. a resized or re-encoded copy.
+
+    The result of a pair within AppConfig.near_duplicates.max_distance of both images is returned; otherwise the
+    output of process A of such a pair, and the output of process B of an advert within the distance, are stored
+    under the own cache keys, so the run skips these stages. Only outputs of the same model and prompts config
+    are reused.
+
+    Args:
+        hashes (tuple[int, int] | None): Perceptual hashes of the advert and of the heatmap.
+        cache_keys (dict): Cache keys of the run, see stage_cache_keys.
+        prompts_config (dict): The prompts configuration of the run.
+
+    Returns:
+        tuple: The reused result or None, and the report of the reuse ({"threshold": ..., "matches": {stage:
+               distance}}) or None if nothing is reused.
+    """
+    if hashes is None:
+        return None, None
+    app_config = AppConfig()
+    index = app_config.near_duplicates
+    configs = config_keys(prompts_config)
+    matches = {}
+
+    def find(stage: str, candidates: list):
+        for match in candidates:
+            if match.key == cache_keys["result"] or match.value["configs"][stage] != configs[stage]:
+                continue
+            key = match.value["keys"][stage]
+            output = app_config.result_cache.get(stage, key)
+            if output is None:
+                output = app_config.checkpoints.get(stage, key)
+            if output is not None:
+                matches[stage] = match.distance
+                return output
+        return None
+
+    pairs = index.search(*hashes)
+    result = find("result", pairs)
+    if result is not None:
+        app_config.result_cache.set("result", cache_keys["result"], result)
+    else:
+        for stage, candidates in (("A", pairs), ("B", index.search(hashes[0]))):
+            if app_config.result_cache.get(stage, cache_keys[stage]) is None:
+                output = find(stage, candidates)
+                if output is not None:
+                    save_stage_output(stage, cache_keys[stage], output)
+    metrics.cache_lookups.inc(cache="near_duplicate", result="hit" if matches else "miss")
+    if not matches:
+        return None, None
+    app_config.process_logger.info(f"Outputs of near-duplicate images are reused: {matches}")
+    return result, {"threshold": index.max_distance, "matches": matches}
+
+
+def index_near_duplicate(hashes: tuple[int, int] | None, cache_keys: dict, prompts_config: dict):
+    """Adds the images of a finished run to AppConfig.near_duplicates.
+
+    Args:
+        hashes (tuple[int, int] | None): Perceptual hashes of the advert and of the heatmap.
+        cache_keys (dict): Cache keys of the run, see stage_cache_keys.
+        prompts_config (dict): The prompts configuration of the run.
+    """
+    if hashes is not None:
+        AppConfig().near_duplicates.add(cache_keys["result"], *hashes,
+                                        {"keys": cache_keys, "configs": config_keys(prompts_config)})
+
+
+def with_report(result: list, report: dict | None) -> list:
+    """Adds the near-duplicate reuse report to the items of a result.
+
+    Args:
+        result (list): The result of the pipeline.
+        report (dict | None): The report returned by reuse_near_duplicate.
+
+    Returns:
+        list: Copy of the result with the report under "near_duplicate", or the result if there is no report.
+    """
+    if report is None:
+        return result
+    return [{**item, "near_duplicate": report} if isinstance(item, dict) else item for item in result]
+
+
+def start_stage(stage: str, cache_key: str | None, progress=None):
+    """Returns the stored output of a stage, or reports the stage as running if there is none.
+
+    Args:
+        stage (str): Name of the stage, also the cache namespace.
+        cache_key (str | None): Cache key of the stage output.
+        progress (Callable[..., None] | None): Optional progress callback, see timed_stage.
+
+    Returns:
+        Any: The stored output, or None if the stage has to run.
+    """
+    result = load_stage_output(stage, cache_key)
+    if result is not None:
+        utils.report_progress(progress, stage, "done", result)
+    else:
+        utils.report_progress(progress, stage, "running")
+    return result
+
+
+def retry_stage(stage: str, attempt: int, error: Exception, progress=None) -> bool:
+    """Records a failed attempt of a stage and tells whether to re-attempt it.
+
+    Only LLMException is re-attempted, up to AppConfig.stage_retries times.
+
+    Args:
+        stage (str): Name of the stage.
+        attempt (int): Number of the failed attempt, starting at 0.
+        error (Exception): The error of the attempt.
+        progress (Callable[..., None] | None): Optional progress callback, see timed_stage.
+
+    Returns:
+        bool: True if the stage is re-attempted, False if the error is final.
+    """
+    app_config = AppConfig()
+    metrics.stage_failures.inc(stage=stage)
+    if isinstance(error, LLMException) and attempt < app_config.stage_retries:
+        app_config.process_logger.warning(f"Process {stage} failed, retrying it: {error}")
+        return True
+    utils.report_progress(progress, stage, "failed")
+    return False
+
+
+def record_stage_time(stage: str, start: float):
+    """Records the wall time of a stage attempt.
+
+    Args:
+        stage (str): Name of the stage.
+        start (float): time.perf_counter() at the start of the attempt.
+    """
+    elapsed = time.perf_counter() - start
+    metrics.stage_seconds.observe(elapsed, stage=stage)
+    AppConfig().process_logger.info(f"Process {stage} took {elapsed:.3f}s")
+
+
+def finish_stage(stage: str, cache_key: str | None, result, progress=None):
+    """Reports a stage as done and stores its output.
+
+    Args:
+        stage (str): Name of the stage, also the cache namespace.
+        cache_key (str | None): Cache key of the stage output. If None, the output is not stored.
+        result (Any): The stage output.
+        progress (Callable[..., None] | None): Optional progress callback, see timed_stage.
+
+    Returns:
+        Any: The stage output.
+    """
+    utils.report_progress(progress, stage, "done", result)
+    save_stage_output(stage, cache_key, result)
+    return result
+
+
+def timed_stage(stage: str, cache_key: str | None, func, *args, progress=None):
+    """Runs a pipeline stage, reusing its stored output if available, and records its wall time.
+
+    The stage name is set in the trace context, so log records and model metrics of the stage are labelled with it.
+
+    A stage failing with LLMException is re-attempted up to AppConfig.stage_retries times; the outputs of the
+    other stages are not recomputed, since they are checkpointed.
+
+    Args:
+        stage (str): Name of the stage used in the log message and as the cache namespace.
+        cache_key (str | None): Cache key of the stage output. If None, the output is not stored.
+        func (Callable): Stage function to execute.
+        *args: Arguments passed to the stage function.
+        progress (Callable[..., None] | None): Optional callback receiving the stage, its status ("running",
+                                               "done" or "failed") and the output of a finished stage.
+
+    Returns:
+        Any: The result of the stage function.
+    """
+    result = start_stage(stage, cache_key, progress)
+    if result is not None:
+        return result
+
+    with metrics.trace_scope(stage=stage):
+        for attempt in range(AppConfig().stage_retries + 1):
+            start = time.perf_counter()
+            try:
+                result = func(*args)
+                break
+            except Exception as e:
+                if not retry_stage(stage, attempt, e, progress):
+                    raise
+            finally:
+                record_stage_time(stage, start)
+    return finish_stage(stage, cache_key, result, progress)
+
+
+async def atimed_stage(stage: str, cache_key: str | None, func, *args, progress=None):
+    """Asynchronous version of timed_stage.
+
+    Args:
+        stage (str): Name of the stage used in the log message and as the cache namespace.
+        cache_key (str | None): Cache key of the stage output. If None, the output is not stored.
+        func (Callable): Coroutine function of the stage.
+        *args: Arguments passed to the stage function.
+        progress (Callable[..., None] | None): Optional callback receiving the stage, its status ("running",
+                                               "done" or "failed") and the output of a finished stage.
+
+    Returns:
+        Any: The result of the stage function.
+    """
+    result = start_stage(stage, cache_key, progress)
+    if result is not None:
+        return result
+
+    with metrics.trace_scope(stage=stage):
+        for attempt in range(AppConfig().stage_retries + 1):
+            start = time.perf_counter()
+            try:
+                result = await func(*args)
+                break
+            except Exception as e:
+                if not retry_stage(stage, attempt, e, progress):
+                    raise
+            finally:
+                record_stage_time(stage, start)
+    return finish_stage(stage, cache_key, result, progress)
+
+
+_analysis_semaphores = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+
+
+def get_analysis_semaphore() -> asyncio.Semaphore:
+    """Returns the semaphore of the running event loop limiting the number of concurrent analyses in arun.
+
+    Returns:
+        asyncio.Semaphore: Semaphore sized by AppConfig.max_concurrent_analyses.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _analysis_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _analysis_semaphores[loop] = asyncio.Semaphore(AppConfig().max_concurrent_analyses)
+    return semaphore
+
+
+def run(advert_image: bytes | RequestImage, advert_heatmap_image: bytes | RequestImage, progress=None) -> list:
     """Execute the main processing pipeline using the provided configuration and image paths.
 
+    Processes A and B are independent, so they run concurrently; process C waits for both of them.
+    The final result and the outputs of A and B are cached in AppConfig.result_cache, and the outputs of
+    A and B are also checkpointed, so a retry after a failed process C does not rerun them.
+
     Args:
-        advert_image (bytes): image file to process.
-        advert_heatmap_image (bytes): heatmap image file to process.
+        advert_image (bytes | RequestImage): image file to process.
+        advert_heatmap_image (bytes | RequestImage): heatmap image file to process.
+        progress (Callable[..., None] | None): Optional callback receiving the stage ("A", "A1", "A2", "B", "C"),
+                                               its status ("running", "done", "failed") and the output of a
+                                               finished stage, see utils.report_progress.
 
     Returns:
         list: The result of the final processing stage.
+
+    Raises:
+        InvalidImageException: If an image is not an image of a supported format.
     """
 
     app_config = AppConfig()
 
-    if len(advert_image) > app_config.max_size:
-        advert_image = resize_image_to_max_size(advert_image, app_config.max_size)
+    with metrics.local_seconds.time(operation="resize"):
+        advert_image = prepare_image(advert_image, app_config.max_size)
+        advert_heatmap_image = prepare_image(advert_heatmap_image, app_config.max_size)
 
-    if len(advert_heatmap_image) > app_config.max_size:
-        advert_heatmap_image = resize_image_to_max_size(advert_heatmap_image, app_config.max_size)
+    prompts_config = app_config.prompts_config  # the same config version for all stages
+    cache_keys = stage_cache_keys(advert_image, advert_heatmap_image, prompts_config)
+    c_output = app_config.result_cache.get("result", cache_keys["result"])
+    metrics.cache_lookups.inc(cache="result", result="miss" if c_output is None else "hit")
+    if c_output is not None:
+        app_config.process_logger.info("Main process result is taken from the cache")
+        return c_output
+
+    hashes = perceptual_hashes(advert_image, advert_heatmap_image)
+    c_output, report = reuse_near_duplicate(hashes, cache_keys, prompts_config)
+    if c_output is not None:
+        return with_report(c_output, report)
 
     app_config.process_logger.info("Start Main process")
-    a_output = processA.pipeline(app_config.prompts_config["a_process"], advert_image, advert_heatmap_image)
-    b_output = processB.pipeline(app_config.prompts_config["b_process"], advert_image)
-    c_output = processC.pipeline(app_config.prompts_config["c_process"], a_output, b_output)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="process") as executor:
+        # each stage runs in a copy of the caller context, so it keeps the request id
+        a_future = executor.submit(contextvars.copy_context().run, timed_stage, "A", cache_keys["A"],
+                                   partial(processA.pipeline, progress=progress), prompts_config["a_process"],
+                                   advert_image, advert_heatmap_image, progress=progress)
+        b_future = executor.submit(contextvars.copy_context().run, timed_stage, "B", cache_keys["B"],
+                                   processB.pipeline, prompts_config["b_process"], advert_image, progress=progress)
+        a_output = a_future.result()
+        b_output = b_future.result()
+    c_output = timed_stage("C", None, processC.pipeline, prompts_config["c_process"], a_output, b_output,
+                           progress=progress)
+    elapsed = time.perf_counter() - start
+    metrics.analysis_seconds.observe(elapsed)
+    app_config.process_logger.info(f"Main process took {elapsed:.3f}s")
+    app_config.result_cache.set("result", cache_keys["result"], c_output)
+    index_near_duplicate(hashes, cache_keys, prompts_config)
+
+    return with_report(c_output, report)
+
+
+async def arun(advert_image: bytes | RequestImage, advert_heatmap_image: bytes | RequestImage, progress=None,
+               on_token=None, prompts_config: dict | None = None) -> list:
+    """Asynchronous version of run.
+
+    Image resizing runs in worker threads, the LLM stages use the asynchronous LangChain API.
+    At most AppConfig.max_concurrent_analyses analyses run at the same time, the others wait.
+
+    Args:
+        advert_image (bytes | RequestImage): image file to process.
+        advert_heatmap_image (bytes | RequestImage): heatmap image file to process.
+        progress (Callable[..., None] | None): Optional callback receiving the stage ("A", "A1", "A2", "B", "C"),
+                                               its status ("running", "done", "failed") and the output of a
+                                               finished stage, see utils.report_progress.
+
+        on_token (Callable[[str], None] | None): If set, the process C completion is streamed and this callback
+                                                 receives its text chunks.
+        prompts_config (dict | None): Prompts config used by all stages. Defaults to the current
+                                      AppConfig.prompts_config.
+
+    Returns:
+        list: The result of the final processing stage.
+
+    Raises:
+        InvalidImageException: If an image is not an image of a supported format.
+    """
+    app_config = AppConfig()
+    advert_image, advert_heatmap_image = RequestImage.of(advert_image), RequestImage.of(advert_heatmap_image)
+
+    async with get_analysis_semaphore():
+        with metrics.local_seconds.time(operation="resize"):
+            if advert_image.nbytes > app_config.max_size:
+                advert_image = await asyncio.to_thread(prepare_image, advert_image, app_config.max_size)
+            if advert_heatmap_image.nbytes > app_config.max_size:
+                advert_heatmap_image = await asyncio.to_thread(prepare_image, advert_heatmap_image,
+                                                               app_config.max_size)
+
+        prompts_config = prompts_config or app_config.prompts_config  # the same config version for all stages
+        cache_keys = stage_cache_keys(advert_image, advert_heatmap_image, prompts_config)
+        c_output = app_config.result_cache.get("result", cache_keys["result"])
+        metrics.cache_lookups.inc(cache="result", result="miss" if c_output is None else "hit")
+        if c_output is not None:
+            app_config.process_logger.info("Main process result is taken from the cache")
+            return c_output
+
+        hashes = await asyncio.to_thread(perceptual_hashes, advert_image, advert_heatmap_image)
+        c_output, report = await asyncio.to_thread(reuse_near_duplicate, hashes, cache_keys, prompts_config)
+        if c_output is not None:
+            return with_report(c_output, report)
+
+        app_config.process_logger.info("Start Main process")
+        start = time.perf_counter()
+        a_output, b_output = await asyncio.gather(
+            atimed_stage("A", cache_keys["A"], partial(processA.apipeline, progress=progress),
+                         prompts_config["a_process"], advert_image, advert_heatmap_image, progress=progress),
+            atimed_stage("B", cache_keys["B"], processB.apipeline, prompts_config["b_process"],
+                         advert_image, progress=progress))
+        c_output = await atimed_stage("C", None, partial(processC.apipeline, on_token=on_token),
+                                      prompts_config["c_process"], a_output, b_output, progress=progress)
+        elapsed = time.perf_counter() - start
+        metrics.analysis_seconds.observe(elapsed)
+        app_config.process_logger.info(f"Main process took {elapsed:.3f}s")
+        app_config.result_cache.set("result", cache_keys["result"], c_output)
+        await asyncio.to_thread(index_near_duplicate, hashes, cache_keys, prompts_config)
+
+    return with_report(c_output, report)
+
+
+async def astream(advert_image: bytes | RequestImage, advert_heatmap_image: bytes | RequestImage):
+    """Runs the pipeline like arun and yields its events as soon as they happen.
+
+    Events are dicts with "event" and "data": "a1", "a2" and "b" with the stage outputs, "c_delta" with a text
+    chunk of the process C completion, then "c" with the final result, or "error" if the analysis failed.
+    Outputs taken from the cache are emitted at once; a cached final result only yields the "c" event.
+    If the consumer stops iterating, the analysis is cancelled.
+
+    Args:
+        advert_image (bytes | RequestImage): image file to process.
+        advert_heatmap_image (bytes | RequestImage): heatmap image file to process.
+
+    Yields:
+        dict: The events.
+    """
+    events = asyncio.Queue()
+    prompts_config = AppConfig().prompts_config  # the config the stages of this run use, even if it is reloaded
+
+    def progress(stage: str, status: str, output=None):
+        if status == "done" and output is not None:
+            events.put_nowait((stage, output))
+
+    task = asyncio.create_task(arun(advert_image, advert_heatmap_image, progress=progress,
+                                    on_token=lambda text: events.put_nowait(("c_delta", {"text": text})),
+                                    prompts_config=prompts_config))
+    task.add_done_callback(lambda _: events.put_nowait(None))
+    emitted = set()
+    try:
+        while (item := await events.get()) is not None:
+            stage, output = item
+            if stage == "c_delta":
+                yield {"event": "c_delta", "data": output}
+                continue
+            if stage == "A":
+                # a cached process A output finishes both of its stages at once
+                a1, a2 = processA.split_output(prompts_config["a_process"], output)
+                outputs = {"A1": a1, "A2": a2}
+            else:
+                outputs = {stage: output}
+            for stage, output in outputs.items():
+                if stage in ("A1", "A2", "B") and stage not in emitted:
+                    emitted.add(stage)
+                    yield {"event": stage.lower(), "data": output}
 
-    return json.loads(json.dumps(c_output, ensure_ascii=False, indent=4))
+        try:
+            yield {"event": "c", "data": task.result()}
+        except Exception as e:
+            # the response has already started, so the failure is reported as an event
+            AppConfig().process_logger.error(f"Streamed analysis failed: {e}")
+            yield {"event": "error", "data": {"error": str(e)}}
+    finally:
+        if not task.done():
+            task.cancel()
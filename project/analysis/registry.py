@@ -0,0 +1,157 @@
+"""This module provides a registry of compiled prompts and chains of the processing stages.
+
+Every stage (a1, a2, b, c) registers how its chat template and chain are built. The registry compiles the prompt,
+template, output parsers, format instructions and native response format of a stage once per distinct instructions
+config, so requests reuse them; a changed prompts config (e.g. after a hot-reload) is compiled on first use.
+"""
+
+import threading
+from dataclasses import dataclass, field
+from typing import Callable
+
+from langchain.output_parsers import StructuredOutputParser
+from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+from pydantic import BaseModel
+
+from analysis import structured_output
+from analysis.base_prompt import BasePrompt
+from common.result_cache import LRUCache, make_key
+
+# stage -> (process section, instructions section)
+STAGE_INSTRUCTIONS = {"a1": ("a_process", "a1_instructions"),
+                      "a2": ("a_process", "a2_instructions"),
+                      "b": ("b_process", "b_instructions"),
+                      "c": ("c_process", "c_instructions")}
+
+
+@dataclass(frozen=True)
+class CompiledStage:
+    """Immutable compiled prompt of a stage; chains are built once per model and shared between threads."""
+
+    prompt: BasePrompt
+    chat_template: ChatPromptTemplate
+    output_parser: StructuredOutputParser
+    format_instructions: str
+    output_model: type[BaseModel]
+    schema_parser: structured_output.SchemaOutputParser
+    response_format: dict
+    task_instruction: str
+    chain_builder: Callable
+    _chains: dict = field(default_factory=dict, compare=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, compare=False, repr=False)
+
+    def parser(self, native: bool = False) -> BaseOutputParser:
+        """Returns the parser of the stage output.
+
+        Args:
+            native (bool): Whether the output is requested in the native response format.
+
+        Returns:
+            BaseOutputParser: The pydantic validating parser, or the parser of the prompted format.
+        """
+        return self.schema_parser if native else self.output_parser
+
+    def chain(self, model: Runnable, native: bool = False) -> Runnable:
+        """Returns the chain of the stage for the model, building it on first use.
+
+        The "response_template" of the chat template is filled with the format instructions; with the native
+        response format, which is bound to the model requests, only a short reminder is sent instead.
+
+        Args:
+            model (Runnable): The chat model of the chain.
+            native (bool): Whether the output is requested in the native response format.
+
+        Returns:
+            Runnable: The stage chain.
+        """
+        with self._lock:
+            cached = self._chains.get((id(model), native))
+            if cached is None or cached[0] is not model:
+                template = self.chat_template.partial(response_template=structured_output.NATIVE_RESPONSE_TEMPLATE
+                                                      if native else self.format_instructions)
+                bound = model.bind(response_format=self.response_format) if native else model
+                cached = self._chains[(id(model), native)] = (model, self.chain_builder(template, self.parser(native),
+                                                                                       bound))
+            return cached[1]
+
+
+class StageRegistry:
+    """Registry of stage builders and of the compiled stages."""
+
+    def __init__(self, max_entries: int = 64):
+        """Initialize a StageRegistry instance.
+
+        Args:
+            max_entries (int): Maximum number of compiled stages kept.
+        """
+        self._builders = {}
+        self._compiled = LRUCache(max_entries)
+        self._lock = threading.Lock()
+
+    def register(self, stage: str, template_builder: Callable, chain_builder: Callable,
+                 select_instructions: Callable | None = None):
+        """Registers how a stage is built.
+
+        Args:
+            stage (str): Name of the stage.
+            template_builder (Callable[[BasePrompt], ChatPromptTemplate]): Builds the chat template of the stage.
+            chain_builder (Callable[[ChatPromptTemplate, BaseOutputParser, Runnable], Runnable]):
+                Builds the chain of the stage from its template, output parser and model.
+            select_instructions (Callable[[dict], dict] | None): Returns the instructions of the stage from the
+                prompts configuration. Defaults to the section of the stage in STAGE_INSTRUCTIONS.
+        """
+        if select_instructions is None:
+            process, instructions = STAGE_INSTRUCTIONS[stage]
+
+            def select_instructions(prompts_config: dict) -> dict:
+                return prompts_config[process][instructions]
+        self._builders[stage] = (template_builder, chain_builder, select_instructions)
+
+    def get(self, stage: str, instructions: dict) -> CompiledStage:
+        """Returns the compiled stage for the instructions, compiling it on first use.
+
+        Args:
+            stage (str): Name of the stage.
+            instructions (dict): Instructions config of the stage, e.g. process_prompts["a1_instructions"].
+
+        Returns:
+            CompiledStage: The compiled stage.
+        """
+        key = (stage, make_key(instructions))
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            with self._lock:
+                compiled = self._compiled.get(key)
+                if compiled is None:
+                    compiled = self._compile(stage, instructions)
+                    self._compiled.set(key, compiled)
+        return compiled
+
+    def compile_all(self, prompts_config: dict):
+        """Compiles all registered stages of a prompts configuration.
+
+        Args:
+            prompts_config (dict): The prompts configuration.
+        """
+        for stage, (_, _, select_instructions) in self._builders.items():
+            self.get(stage, select_instructions(prompts_config))
+
+    def _compile(self, stage: str, instructions: dict) -> CompiledStage:
+        template_builder, chain_builder, _ = self._builders[stage]
+        prompt = BasePrompt(**instructions)
+        output_parser = StructuredOutputParser.from_response_schemas(prompt.response_template)
+        output_model = structured_output.schema_model(f"{stage}_output", prompt.response_template)
+        return CompiledStage(prompt=prompt,
+                             chat_template=template_builder(prompt),
+                             output_parser=output_parser,
+                             format_instructions=output_parser.get_format_instructions(),
+                             output_model=output_model,
+                             schema_parser=structured_output.SchemaOutputParser(output_model=output_model),
+                             response_format=structured_output.json_schema_format(f"{stage}_output", output_model),
+                             task_instruction=prompt.input_overview + "\n" + prompt.task,
+                             chain_builder=chain_builder)
+
+
+registry = StageRegistry()
@@ -0,0 +1,154 @@
+"""This module provides the image of an analysis request.
+
+An uploaded image is read once, with a hard size limit, into a single immutable buffer. Its format and size are
+sniffed from the header without decoding the pixels, so invalid files are rejected before any processing. The
+digest (used for the cache keys) and the base64 data URL are computed at most once and reused by every stage.
+"""
+
+import hashlib
+import io
+
+from PIL import Image, UnidentifiedImageError
+
+from analysis import utils
+from common import InvalidImageException
+
+READ_CHUNK_SIZE = 1 << 20
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif", "WEBP": "image/webp"}
+
+
+def sniff(data: bytes) -> tuple[str, tuple[int, int]]:
+    """Reads the format and the size of an image from its header; the pixels are not decoded.
+
+    Args:
+        data (bytes): The image file.
+
+    Returns:
+        tuple[str, tuple[int, int]]: The PIL format name and the width and height.
+
+    Raises:
+        InvalidImageException: If the data is not an image of a supported format.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format, size = image.format, image.size
+    except UnidentifiedImageError as e:
+        raise InvalidImageException("the file is not an image") from e
+    except OSError as e:
+        raise InvalidImageException(f"the image header is invalid: {e}") from e
+    if image_format not in MIME_TYPES:
+        raise InvalidImageException(f"unsupported image format {image_format}, use one of {list(MIME_TYPES)}")
+    return image_format, size
+
+
+async def read_upload(upload, max_bytes: int) -> bytes:
+    """Reads an uploaded file in chunks, rejecting it as soon as it exceeds the size limit.
+
+    Args:
+        upload (UploadFile): The uploaded file.
+        max_bytes (int): Maximum size of the file in bytes.
+
+    Returns:
+        bytes: The file content.
+
+    Raises:
+        InvalidImageException: If the file is too large (status 413).
+    """
+    too_large = InvalidImageException(f"{upload.filename} is larger than {max_bytes} bytes", status_code=413)
+    if upload.size is not None and upload.size > max_bytes:
+        raise too_large
+
+    chunks, total = [], 0
+    while chunk := await upload.read(READ_CHUNK_SIZE):
+        total += len(chunk)
+        if total > max_bytes:
+            raise too_large
+        chunks.append(chunk)
+    return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+
+class RequestImage:
+    """An image of a request: one read-only buffer with its sniffed header and memoized encodings."""
+
+    def __init__(self, data: bytes):
+        """Initialize a RequestImage instance.
+
+        Args:
+            data (bytes): The image file. It is not copied.
+
+        Raises:
+            InvalidImageException: If the data is not an image of a supported format.
+        """
+        self.data = data
+        self.view = memoryview(data)  # zero-copy slices of the buffer
+        self.format, self.size = sniff(data)
+        self._digest = None
+        self._data_url = None
+
+    @classmethod
+    def of(cls, image: "bytes | RequestImage") -> "RequestImage":
+        """Wraps image bytes, or returns the image if it is wrapped already.
+
+        Args:
+            image (bytes | RequestImage): The image.
+
+        Returns:
+            RequestImage: The request image.
+        """
+        return image if isinstance(image, RequestImage) else cls(image)
+
+    @classmethod
+    async def from_upload(cls, upload, max_bytes: int) -> "RequestImage":
+        """Reads an uploaded file in chunks, rejecting it as soon as it exceeds the size limit.
+
+        Args:
+            upload (UploadFile): The uploaded file.
+            max_bytes (int): Maximum size of the file in bytes.
+
+        Returns:
+            RequestImage: The request image.
+
+        Raises:
+            InvalidImageException: If the file is too large (status 413) or is not an image (status 400).
+        """
+        return cls(await read_upload(upload, max_bytes))
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the size of the image file.
+
+        Returns:
+            int: Size in bytes.
+        """
+        return self.view.nbytes
+
+    @property
+    def mime_type(self) -> str:
+        """Returns the MIME type of the image.
+
+        Returns:
+            str: The MIME type, e.g. "image/png".
+        """
+        return MIME_TYPES[self.format]
+
+    @property
+    def digest(self) -> bytes:
+        """Returns the sha256 digest of the image, computed once; cache keys are built from it.
+
+        Returns:
+            bytes: The digest.
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.view).digest()
+        return self._digest
+
+    @property
+    def data_url(self) -> str:
+        """Returns the base64 data URL of the image, encoded once for all stages.
+
+        Returns:
+            str: The data URL, e.g. "data:image/png;base64,...".
+        """
+        if self._data_url is None:
+            self._data_url = f"data:{self.mime_type};base64,{utils.encode_image(self.view)}"
+        return self._data_url
@@ -0,0 +1,89 @@
+"""This module provides the native structured output of the stages.
+
+The response schemas of a stage in the prompts config are turned into a pydantic model. Its JSON schema is sent as the
+"json_schema" response format, so the model itself is constrained to a JSON object with exactly these keys, and the
+completion is validated once against the pydantic model. This replaces the format instructions of the prompt and the
+StructuredOutputParser, which remain for backends without native structured output, see model_routing.
+"""
+
+import json
+from typing import Any
+
+from langchain.output_parsers import ResponseSchema
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.utils.json import parse_json_markdown
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, create_model
+
+# types of the response schemas, see ResponseSchema.type
+SCHEMA_TYPES = {"string": str, "str": str, "integer": int, "int": int, "number": float, "float": float,
+                "boolean": bool, "bool": bool}
+# replaces the format instructions in the prompt; the response format carries the schema
+NATIVE_RESPONSE_TEMPLATE = "Respond with a JSON object in the requested response format."
+
+
+def schema_model(name: str, response_schemas: list[ResponseSchema]) -> type[BaseModel]:
+    """Creates the pydantic model of the response schemas of a stage.
+
+    Args:
+        name (str): Name of the model, e.g. the stage name.
+        response_schemas (list[ResponseSchema]): The response schemas; types other than SCHEMA_TYPES are strings.
+
+    Returns:
+        type[BaseModel]: Model with a required field per schema, ignoring other keys.
+    """
+    fields = {schema.name: (SCHEMA_TYPES.get(schema.type, str), Field(description=schema.description))
+              for schema in response_schemas}
+    return create_model(name, __config__=ConfigDict(extra="ignore"), **fields)
+
+
+def json_schema_format(name: str, output_model: type[BaseModel]) -> dict:
+    """Builds the strict "json_schema" response format of the OpenAI chat completions API.
+
+    Args:
+        name (str): Name of the schema, letters, digits, underscores and dashes only.
+        output_model (type[BaseModel]): The pydantic model of the output.
+
+    Returns:
+        dict: The response format to bind to the model requests.
+    """
+    schema = output_model.model_json_schema()
+    schema["additionalProperties"] = False  # required by the strict mode, like all properties being required
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+class SchemaOutputParser(BaseOutputParser[dict]):
+    """Parses a JSON completion and validates it against the pydantic model of the stage."""
+
+    output_model: Any
+
+    def parse(self, text: str) -> dict:
+        """Parses and validates a completion; JSON in a markdown code block is accepted too.
+
+        Args:
+            text (str): The completion.
+
+        Returns:
+            dict: The fields of the output model.
+
+        Raises:
+            OutputParserException: If the completion is not a JSON object of the output model.
+        """
+        try:
+            return self.output_model.model_validate(parse_json_markdown(text)).model_dump()
+        except (ValueError, TypeError, ValidationError) as e:
+            raise OutputParserException(f"Output is not a valid {self.output_model.__name__}: {e}",
+                                        llm_output=text) from e
+
+    def get_format_instructions(self) -> str:
+        """Returns the JSON schema of the output, used by the repair pass.
+
+        Returns:
+            str: Instructions with the JSON schema.
+        """
+        return ("Return a JSON object matching this JSON schema:\n"
+                + json.dumps(self.output_model.model_json_schema(), ensure_ascii=False))
+
+    @property
+    def _type(self) -> str:
+        return "schema_output_parser"
@@ -1,7 +1,10 @@
-"""This module provides utility functions for image processing, including resizing and encoding images."""
+"""This module provides utility functions for image processing, including resizing and encoding images,
+and for reporting the progress of the processing stages."""
 import base64
 from typing_extensions import BinaryIO
 
+from common import metrics
+
 
 def resize_image(image_path: str, output_path: str, scale_factor: int):
     """Resizes an image by a given scale factor and saves the resized image to the specified output path.
@@ -21,13 +24,32 @@ def resize_image(image_path: str, output_path: str, scale_factor: int):
     img.save(output_path)
 
 
-def encode_image(image: bytes) -> str:
+def encode_image(image: bytes | memoryview) -> str:
     """Encodes an image file to a base64-encoded string.
 
     Args:
-        image_path (bytes): Image file that needs to be encoded.
+        image (bytes | memoryview): Image file that needs to be encoded.
 
     Returns:
         str: The base64-encoded string of the image file.
     """
-    return base64.b64encode(image).decode('utf-8');
+    with metrics.local_seconds.time(operation="base64"):
+        return base64.b64encode(image).decode('utf-8')
+
+
+def report_progress(progress, stage: str, status: str, output=None):
+    """Calls the progress callback if it is set.
+
+    Args:
+        progress (Callable[..., None] | None): Progress callback receiving the stage, its status and, when the stage
+                                               is done, its output as the "output" keyword argument.
+        stage (str): Name of the stage.
+        status (str): Status of the stage.
+        output (Any): Output of a finished stage.
+    """
+    if progress is None:
+        return
+    if output is None:
+        progress(stage, status)
+    else:
+        progress(stage, status, output=output)
@@ -1,16 +1,285 @@
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
-from analysis import process_main
-from common.custom_exceptions import LLMException
+import io
+import json
+import threading
+import time
+import uuid
+import zipfile
+
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from common import metrics
+from common.custom_exceptions import InvalidImageException, LLMException, QueueFullException
+from common.startup import LazyModule, startup_profile
+from config import AppConfig
+
+# the analysis modules import langchain, so they are loaded by the warm-up (or the first request needing them)
+batch = LazyModule("analysis.batch")
+jobs = LazyModule("analysis.jobs")
+model_routing = LazyModule("analysis.model_routing")
+process_main = LazyModule("analysis.process_main")
+processB = LazyModule("analysis.processB")
+request_image = LazyModule("analysis.request_image")
+stage_registry = LazyModule("analysis.registry")
+
+# imported by the warm-up in dependency order, so each module is profiled with the time of its own import
+WARM_UP_MODULES = ("PIL.Image", "yaml", "langchain_core.runnables", "langchain.output_parsers", "langchain_openai",
+                   "common.llm_client", "common.session_history", "analysis.registry", "analysis.image_policy",
+                   "analysis.model_routing", "analysis.processA", "analysis.processB", "analysis.processC",
+                   "analysis.process_main", "analysis.batch", "analysis.jobs")
+
+# endpoints receiving one advert/heatmap pair, rejected by their Content-Length before the body is read
+PAIR_UPLOAD_PATHS = ("/congnitiv-analysis", "/congnitiv-analysis/stream", "/jobs")
+BATCH_UPLOAD_PATH = "/congnitiv-analysis/batch"  # limited by MAX_BATCH_UPLOAD_SIZE instead
+MULTIPART_OVERHEAD = 64 * 1024  # bytes of the multipart boundaries, headers and form fields
 
 app = FastAPI()
 
+
+def warm_up():
+    """Imports the analysis modules, creates the stage models and compiles the prompts and helper document index.
+
+    Every step is recorded in the startup profile, which is logged and reported by /readyz.
+    """
+    app_config = AppConfig()
+    try:
+        for name in WARM_UP_MODULES:
+            startup_profile.import_module(name)
+        prompts_config = app_config.prompts_config
+        for process in ("a_process", "b_process", "c_process"):
+            model_routing.stage_models(prompts_config[process])  # the clients are created on first use
+        with startup_profile.step("init prompts"):
+            stage_registry.registry.compile_all(prompts_config)
+        if app_config.job_store_path:
+            with startup_profile.step("init job queue"):
+                jobs.get_job_queue()  # takes over the unfinished jobs of exited workers
+    except Exception as e:
+        app_config.process_logger.error(f"Warm-up failed: {e}")
+        startup_profile.mark_ready(e)
+        return
+
+    try:
+        with startup_profile.step("init helper document"):
+            app_config.helper_doc_cache.warm(prompts_config["b_process"])
+        with startup_profile.step("init helper document index"):
+            processB.get_help_info(prompts_config["b_process"])
+    except Exception as e:
+        app_config.process_logger.warning(f"Helper document was not loaded, it will be loaded lazily: {e}")
+    startup_profile.mark_ready()
+    app_config.process_logger.info(f"Warm-up finished: {json.dumps(startup_profile.to_dict())}")
+
+
+@app.on_event("startup")
+def start_warm_up():
+    """Warms up in a background thread, so the port is bound at once, or before binding the port without FAST_START."""
+    if AppConfig().fast_start:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        warm_up()
+
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Rejects with 413 an image pair upload whose Content-Length exceeds twice MAX_UPLOAD_SIZE, or a batch upload
+    whose Content-Length exceeds MAX_BATCH_UPLOAD_SIZE."""
+    content_length = request.headers.get("content-length", "")
+    if request.method != "POST" or not content_length.isdigit():
+        return await call_next(request)
+    app_config = AppConfig()
+    max_bytes = app_config.max_upload_size
+    if request.url.path in PAIR_UPLOAD_PATHS and int(content_length) > 2 * max_bytes + MULTIPART_OVERHEAD:
+        return JSONResponse(content={"invalid image: ": f"the images are larger than {max_bytes} bytes each"},
+                            status_code=413)
+    max_batch_bytes = app_config.max_batch_upload_size
+    if request.url.path == BATCH_UPLOAD_PATH and int(content_length) > max_batch_bytes + MULTIPART_OVERHEAD:
+        return JSONResponse(content={"invalid image: ": f"the batch is larger than {max_batch_bytes} bytes"},
+                            status_code=413)
+    return await call_next(request)
+
+
+async def read_images(*uploads: UploadFile) -> list:
+    """Reads uploaded images with the MAX_UPLOAD_SIZE limit and checks their headers.
+
+    Args:
+        *uploads (UploadFile): The uploaded files.
+
+    Returns:
+        list[RequestImage]: The images.
+
+    Raises:
+        InvalidImageException: If a file is too large or is not an image.
+    """
+    max_bytes = AppConfig().max_upload_size
+    return [await request_image.RequestImage.from_upload(upload, max_bytes) for upload in uploads]
+
+
+def read_archive_image(zip_file: zipfile.ZipFile, name: str):
+    """Reads an image of a batch archive with the MAX_UPLOAD_SIZE limit and checks its header.
+
+    The uncompressed size is checked before the member is decompressed, and zipfile never returns more than it.
+
+    Args:
+        zip_file (zipfile.ZipFile): The archive.
+        name (str): Name of the member.
+
+    Returns:
+        RequestImage: The image.
+
+    Raises:
+        InvalidImageException: If the member is too large or is not an image.
+    """
+    max_bytes = AppConfig().max_upload_size
+    if zip_file.getinfo(name).file_size > max_bytes:
+        raise InvalidImageException(f"{name} is larger than {max_bytes} bytes", status_code=413)
+    return request_image.RequestImage(zip_file.read(name))
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Sets the request id of the logs (the X-Request-ID header or a new one) and records the request time."""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    start = time.perf_counter()
+    with metrics.trace_scope(request_id=request_id):
+        response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.http_seconds.observe(time.perf_counter() - start, method=request.method,
+                                 path=route.path if route else "unmatched", status=response.status_code)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
 @app.post("/congnitiv-analysis")
 async def congnitiv_analysis(advertisement_image: UploadFile = File(...), advertisement_heatmap_image: UploadFile = File(...)):
-    advert_image = advertisement_image.file.read()
-    advert_heatmap = advertisement_heatmap_image.file.read()
     try:
-        result = process_main.run(advert_image, advert_heatmap)
+        advert_image, advert_heatmap = await read_images(advertisement_image, advertisement_heatmap_image)
+        result = await process_main.arun(advert_image, advert_heatmap)
+    except InvalidImageException as e:
+        return JSONResponse(content={"invalid image: ": str(e)}, status_code=e.status_code)
     except LLMException as e:
         return JSONResponse(content={"temporary error with llm: ": str(e)}, status_code=503)
     return JSONResponse(content=result, status_code=200)
+
+
+@app.post("/congnitiv-analysis/stream")
+async def congnitiv_analysis_stream(advertisement_image: UploadFile = File(...),
+                                    advertisement_heatmap_image: UploadFile = File(...), format: str = "sse"):
+    """Streams the stage results as they complete: a1, a2, b, c_delta (process C tokens), then c or error.
+
+    Events are sent as server-sent events, or as NDJSON records {"event": ..., "data": ...} with ?format=ndjson.
+    """
+    if format not in ("sse", "ndjson"):
+        return JSONResponse(content={"invalid request: ": "format must be 'sse' or 'ndjson'"}, status_code=400)
+    try:
+        advert_image, advert_heatmap = await read_images(advertisement_image, advertisement_heatmap_image)
+    except InvalidImageException as e:
+        return JSONResponse(content={"invalid image: ": str(e)}, status_code=e.status_code)
+
+    async def events():
+        async for event in process_main.astream(advert_image, advert_heatmap):
+            if format == "sse":
+                yield f"event: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+            else:
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post(BATCH_UPLOAD_PATH)
+async def congnitiv_analysis_batch(advertisement_images: list[UploadFile] = File(None),
+                                   advertisement_heatmap_images: list[UploadFile] = File(None),
+                                   archive: UploadFile = File(None)):
+    """Analyses many advert/heatmap pairs and streams a NDJSON record per pair as it finishes.
+
+    Pairs are either uploaded as two lists of the same length, matched by position, or as a zip archive
+    where each heatmap is named like its advert with the "_heatmap" suffix. Every image is limited by
+    MAX_UPLOAD_SIZE, the archive by MAX_BATCH_UPLOAD_SIZE and the number of pairs by MAX_BATCH_PAIRS.
+    """
+    app_config = AppConfig()
+    advertisement_images = advertisement_images or []
+    advertisement_heatmap_images = advertisement_heatmap_images or []
+    if len(advertisement_images) != len(advertisement_heatmap_images):
+        return JSONResponse(content={"invalid request: ": "the number of adverts and heatmaps differs"},
+                            status_code=400)
+
+    max_pairs = app_config.max_batch_pairs
+    too_many_pairs = JSONResponse(content={"invalid request: ": f"a batch has at most {max_pairs} pairs"},
+                                  status_code=400)
+    if len(advertisement_images) > max_pairs:
+        return too_many_pairs
+    try:
+        items = []
+        if archive is not None:
+            data = await request_image.read_upload(archive, app_config.max_batch_upload_size)
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                pairs = batch.pair_files(zip_file.namelist())
+                if len(pairs) + len(advertisement_images) > max_pairs:
+                    return too_many_pairs
+                items = [(item_id, read_archive_image(zip_file, advert), read_archive_image(zip_file, heatmap))
+                         for item_id, advert, heatmap in pairs]
+        for advert, heatmap in zip(advertisement_images, advertisement_heatmap_images):
+            items.append((advert.filename or str(len(items)), *await read_images(advert, heatmap)))
+    except (zipfile.BadZipFile, ValueError) as e:
+        return JSONResponse(content={"invalid archive: ": str(e)}, status_code=400)
+    except InvalidImageException as e:
+        return JSONResponse(content={"invalid image: ": str(e)}, status_code=e.status_code)
+
+    async def records():
+        async for record in batch.arun_batch(items, AppConfig().batch_concurrency):
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(records(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs")
+async def submit_job(advertisement_image: UploadFile = File(...), advertisement_heatmap_image: UploadFile = File(...),
+                     callback_url: str = Form(None)):
+    """Queues an analysis and returns its job id immediately; poll GET /jobs/{job_id} or pass a callback_url."""
+    callback_url = callback_url or None
+    if callback_url is not None:
+        try:
+            jobs.check_callback_url(callback_url, AppConfig().job_callback_hosts)
+        except ValueError as e:
+            return JSONResponse(content={"invalid request: ": str(e)}, status_code=400)
+    try:
+        advert_image, advert_heatmap = await read_images(advertisement_image, advertisement_heatmap_image)
+        job = jobs.get_job_queue().submit(advert_image.data, advert_heatmap.data, callback_url)
+    except InvalidImageException as e:
+        return JSONResponse(content={"invalid image: ": str(e)}, status_code=e.status_code)
+    except QueueFullException as e:
+        return JSONResponse(content={"too many jobs: ": str(e)}, status_code=429, headers={"Retry-After": "30"})
+    return JSONResponse(content={"job_id": job["job_id"], "status": job["status"]}, status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get_job_queue().get(job_id)
+    if job is None:
+        return JSONResponse(content={"unknown job: ": job_id}, status_code=404)
+    return JSONResponse(content=job, status_code=200)
+
+
+@app.get("/healthz")
+async def healthz():
+    """Reports that the server process is up; it does not wait for the warm-up."""
+    return JSONResponse(content={"status": "ok"}, status_code=200)
+
+
+@app.get("/readyz")
+async def readyz():
+    """Reports whether the warm-up finished, with the startup profile; 503 until the server is warm."""
+    profile = startup_profile.to_dict()
+    return JSONResponse(content=profile, status_code=200 if profile["ready"] else 503)
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    app_config = AppConfig()
+    return JSONResponse(content={"result_cache": app_config.result_cache.stats,
+                                 "helper_doc_cache": app_config.helper_doc_cache.stats}, status_code=200)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Returns the metrics of this server worker in the Prometheus text format."""
+    return PlainTextResponse(metrics.metrics_registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from analysis import batch
+from config import AppConfig
+
+
+async def main(items: list, concurrency: int, output):
+    async for record in batch.arun_batch(items, concurrency):
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Batch')
+    parser.add_argument('--env_path', type=str, default="./envs/.env")
+    parser.add_argument('--logger_save_path', type=str, default=".")
+    parser.add_argument('--prompts_config_path', type=str, default="./analysis/prompts/data.yaml")
+    parser.add_argument('--input_dir', type=str, help="folder with adverts and their '<name>_heatmap' images")
+    parser.add_argument('--manifest', type=str, help="csv or jsonl file with 'advert', 'heatmap' and optional 'id'")
+    parser.add_argument('--output', type=str, default=None, help="NDJSON output file, stdout by default")
+    parser.add_argument('--concurrency', type=int, default=None)
+
+    args = parser.parse_args()
+    if bool(args.input_dir) == bool(args.manifest):
+        parser.error("exactly one of --input_dir and --manifest is required")
+    app_config = AppConfig(args.env_path, args.logger_save_path, args.prompts_config_path)
+
+    if args.manifest:
+        items = batch.read_manifest(args.manifest)
+    else:
+        items = batch.pair_files(os.path.join(args.input_dir, name) for name in os.listdir(args.input_dir))
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        asyncio.run(main(items, args.concurrency or app_config.batch_concurrency, output))
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,116 @@
+"""This module provides a deterministic local chat model used instead of gpt-4o in benchmarks.
+
+The model answers every prompt with JSON containing the keys of the requested "json_schema" response format, or
+the keys requested by the format instructions of the prompt, after a latency drawn from a configurable
+distribution; a share of the requests fails with a retryable server error.
+"""
+
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.pydantic_v1 import PrivateAttr
+
+from common.llm_client import estimate_tokens
+
+RESPONSE_KEY_PATTERN = re.compile(r'^\s*"(\w+)": ', re.MULTILINE)
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+STREAM_CHUNK_SIZE = 16  # characters of a streamed chunk
+
+
+class FakeServerError(Exception):
+    """Retryable error of the fake model provider."""
+
+    status_code = 503
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model with simulated latency and failures, reproducible for a given seed."""
+
+    latency: float = 1.0  # mean latency in seconds
+    jitter: float = 0.0  # half-width (uniform) or sigma (lognormal) of the latency distribution
+    distribution: str = "fixed"
+    failure_rate: float = 0.0
+    completion_tokens: int = 150
+    seed: int = 0
+    model_name: str = "fake-multimodal"
+    _random: random.Random = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, **kwargs):
+        """Initialize a FakeChatModel instance.
+
+        Args:
+            **kwargs: Values of the model fields (latency, jitter, distribution, failure_rate, completion_tokens,
+                      seed, model_name).
+
+        Raises:
+            ValueError: If the distribution is unknown.
+        """
+        super().__init__(**kwargs)
+        if self.distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"unknown latency distribution {self.distribution}, use one of {LATENCY_DISTRIBUTIONS}")
+        self._random = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-multimodal"
+
+    def _draw(self) -> tuple[float, bool]:
+        with self._lock:
+            if self.distribution == "uniform":
+                latency = self._random.uniform(self.latency - self.jitter, self.latency + self.jitter)
+            elif self.distribution == "lognormal":
+                # heavy right tail with the mean equal to self.latency
+                latency = self.latency * self._random.lognormvariate(-self.jitter ** 2 / 2, self.jitter)
+            else:
+                latency = self.latency
+            failed = self._random.random() < self.failure_rate
+        return max(0.0, latency), failed
+
+    def _respond(self, messages: list, failed: bool, response_format: dict | None = None) -> ChatResult:
+        if failed:
+            raise FakeServerError("simulated server error")
+        if response_format is not None:
+            keys = list(response_format["json_schema"]["schema"]["properties"])
+            content = json.dumps({key: f"benchmark {key}" for key in keys})
+        else:
+            keys = []
+            for message in messages:
+                if isinstance(message.content, str):
+                    keys.extend(key for key in RESPONSE_KEY_PATTERN.findall(message.content) if key not in keys)
+            content = "```json\n" + json.dumps({key: f"benchmark {key}" for key in keys}) + "\n```"
+        prompt_tokens = estimate_tokens(messages)
+        message = AIMessage(content=content, usage_metadata={"input_tokens": prompt_tokens,
+                                                             "output_tokens": self.completion_tokens,
+                                                             "total_tokens": prompt_tokens + self.completion_tokens})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        latency, failed = self._draw()
+        time.sleep(latency)
+        return self._respond(messages, failed, kwargs.get("response_format"))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        latency, failed = self._draw()
+        await asyncio.sleep(latency)
+        return self._respond(messages, failed, kwargs.get("response_format"))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # half of the latency before the first chunk, the rest spread over the chunks
+        latency, failed = self._draw()
+        await asyncio.sleep(latency / 2)
+        message = self._respond(messages, failed, kwargs.get("response_format")).generations[0].message
+        pieces = [message.content[i:i + STREAM_CHUNK_SIZE]
+                  for i in range(0, len(message.content), STREAM_CHUNK_SIZE)]
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(latency / 2 / len(pieces))
+            usage = message.usage_metadata if i == len(pieces) - 1 else None
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece, usage_metadata=usage))
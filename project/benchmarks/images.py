@@ -0,0 +1,98 @@
+"""This module generates a reproducible corpus of synthetic adverts and attention heatmaps of varied sizes."""
+
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+DEFAULT_SIZES = ((320, 240), (800, 600), (1280, 960), (1920, 1080), (3000, 2000))
+
+
+def encode(image: Image.Image, image_format: str) -> bytes:
+    """Encodes an image.
+
+    Args:
+        image (Image.Image): The image.
+        image_format (str): "JPEG" or "PNG".
+
+    Returns:
+        bytes: The encoded image.
+    """
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=92)
+    return output.getvalue()
+
+
+def generate_advert(width: int, height: int, rng: np.random.Generator) -> Image.Image:
+    """Generates an advert-like image: a gradient background with noise, colour blocks and text.
+
+    Args:
+        width (int): Image width.
+        height (int): Image height.
+        rng (np.random.Generator): Random generator.
+
+    Returns:
+        Image.Image: RGB image.
+    """
+    start, end = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+    ramp = np.linspace(0, 1, width)[None, :, None]
+    pixels = start + (end - start) * ramp + rng.normal(0, 12, (height, width, 3))
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(3, 8)):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        w, h = rng.integers(width // 10, width // 3), rng.integers(height // 10, height // 3)
+        draw.rectangle((x, y, x + w, y + h), fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+    for line in range(rng.integers(1, 4)):
+        draw.text((width // 20, height // 20 + line * max(12, height // 15)), "SALE -50% BUY NOW",
+                  fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+    return image
+
+
+def generate_heatmap(advert: Image.Image, rng: np.random.Generator) -> Image.Image:
+    """Generates an attention heatmap of an advert: gaussian blobs coloured from green to red over the advert.
+
+    Args:
+        advert (Image.Image): The advert.
+        rng (np.random.Generator): Random generator.
+
+    Returns:
+        Image.Image: RGB image of the advert size.
+    """
+    width, height = advert.size
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    attention = np.zeros((height, width), dtype=np.float32)
+    for _ in range(rng.integers(2, 6)):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        sigma = rng.uniform(0.05, 0.2) * min(width, height)
+        attention += rng.uniform(0.3, 1.0) * np.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / (2 * sigma ** 2))
+    attention /= max(float(attention.max()), 1e-6)
+
+    colours = np.stack([np.clip(2 * attention, 0, 1), np.clip(2 - 2 * attention, 0, 1), np.zeros_like(attention)],
+                       axis=-1) * 255
+    alpha = np.clip(attention * 1.5, 0, 0.8)[..., None]
+    pixels = np.asarray(advert, dtype=np.float32) * (1 - alpha) + colours * alpha
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def generate_corpus(count: int, sizes: tuple = DEFAULT_SIZES, seed: int = 0) -> list[tuple[str, bytes, bytes]]:
+    """Generates distinct advert/heatmap pairs, cycling through the sizes; adverts alternate JPEG and PNG.
+
+    Args:
+        count (int): Number of pairs.
+        sizes (tuple): (width, height) of the adverts.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        list[tuple[str, bytes, bytes]]: Id, advert and heatmap (PNG) of each pair.
+    """
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        advert = generate_advert(width, height, rng)
+        heatmap = generate_heatmap(advert, rng)
+        advert_format = "JPEG" if i % 2 == 0 else "PNG"
+        corpus.append((f"{i}_{width}x{height}", encode(advert, advert_format), encode(heatmap, "PNG")))
+    return corpus
@@ -0,0 +1,310 @@
+"""Offline load test of the analysis API.
+
+The chat model is replaced with a local FakeChatModel and the helper document is served from a local file,
+so no tokens are spent. N concurrent clients post a corpus of generated adverts and heatmaps to
+/congnitiv-analysis in the same process; latency percentiles, requests per second, peak RSS and the CPU
+time of image resizing and encoding are reported and can be saved as a JSON baseline and compared with it.
+
+Usage (from the project folder):
+    python -m benchmarks.load_test --clients 16 --requests 128 --output baseline.json
+    python -m benchmarks.load_test --clients 16 --requests 128 --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import yaml
+
+from benchmarks.fake_model import LATENCY_DISTRIBUTIONS, FakeChatModel
+from benchmarks.images import DEFAULT_SIZES, generate_corpus
+
+# metric -> whether a higher value is better
+COMPARED_METRICS = {"latency_ms.p50": False, "latency_ms.p95": False, "latency_ms.p99": False, "rps": True,
+                    "cpu_seconds.resize_image_to_max_size": False, "cpu_seconds.encode_image": False,
+                    "peak_rss_mb": False}
+HELPER_DOC_TEXT = ("Cognitive load theory distinguishes intrinsic, extraneous and germane load. "
+                   "Visual clutter, many colours, dense text and competing focal points increase extraneous load.\n")
+
+
+class CpuTimer:
+    """Thread-safe accumulator of the CPU time of the wrapped function calls."""
+
+    def __init__(self):
+        """Initialize a CpuTimer instance."""
+        self.seconds = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, func):
+        """Wraps a function, so the CPU time of its calling thread is accumulated.
+
+        Args:
+            func (Callable): The function.
+
+        Returns:
+            Callable: The wrapped function.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.seconds += time.thread_time() - start
+                    self.calls += 1
+        return wrapper
+
+
+def parse_size(size: str) -> tuple[int, int]:
+    """Parses an image size.
+
+    Args:
+        size (str): Size like "800x600".
+
+    Returns:
+        tuple[int, int]: Width and height.
+    """
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def current_rss_mb() -> float | None:
+    """Returns the resident set size of the process.
+
+    Returns:
+        float | None: RSS in megabytes, or None if /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of the process.
+
+    Returns:
+        float: Peak RSS in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on macOS, KiB on Linux
+
+
+def setup(args: argparse.Namespace, work_dir: str) -> dict:
+    """Configures the application with the fake model, a local helper document and no result caches.
+
+    Environment variables set by the caller take precedence over the benchmark defaults.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        work_dir (str): Folder for the prompts config, the helper document, caches and logs.
+
+    Returns:
+        dict: CPU timers of "resize_image_to_max_size" and "encode_image".
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")  # the OpenAI model is created, but never called
+    os.environ.setdefault("HELPER_DOC_CACHE_DIR", os.path.join(work_dir, "helper_docs"))
+    if not args.cache:
+        for name in ("RESULT_CACHE_MAX_ENTRIES", "CHECKPOINT_MAX_ENTRIES"):
+            os.environ.setdefault(name, "0")
+    if not args.rate_limits:
+        for name in ("LLM_REQUESTS_PER_MINUTE", "LLM_TOKENS_PER_MINUTE"):
+            os.environ.setdefault(name, "0")
+
+    helper_doc_path = os.path.join(work_dir, "helper_doc.txt")
+    with open(helper_doc_path, "w") as file:
+        file.write(HELPER_DOC_TEXT * 40)
+    with open(args.prompts_config_path) as file:
+        prompts_config = yaml.safe_load(file)
+    prompts_config["b_process"]["helper_doc_path"] = helper_doc_path
+    prompts_config["b_process"].pop("helper_doc_text_path", None)
+    prompts_config_path = os.path.join(work_dir, "data.yaml")
+    with open(prompts_config_path, "w") as file:
+        yaml.safe_dump(prompts_config, file, allow_unicode=True)
+
+    from analysis import process_main, utils
+    from analysis.registry import registry
+    from common.llm_client import ResilientChatModel
+    from config import AppConfig
+
+    app_config = AppConfig(args.env_path, work_dir, prompts_config_path)
+    app_config.set_log_level(args.log_level)
+    model = FakeChatModel(latency=args.latency, jitter=args.jitter, distribution=args.distribution,
+                          failure_rate=args.failure_rate, seed=args.seed)
+    app_config.model = ResilientChatModel(model, requests_per_minute=app_config.model.requests.capacity,
+                                          tokens_per_minute=app_config.model.tokens.capacity,
+                                          max_concurrency=app_config.model.max_concurrency,
+                                          max_retries=app_config.model.max_retries, base_delay=args.retry_delay)
+    registry.compile_all(app_config.prompts_config)
+
+    timers = {"resize_image_to_max_size": CpuTimer(), "encode_image": CpuTimer()}
+    process_main.resize_image_to_max_size = timers["resize_image_to_max_size"].wrap(
+        process_main.resize_image_to_max_size)
+    utils.encode_image = timers["encode_image"].wrap(utils.encode_image)
+    return timers
+
+
+async def drive(corpus: list, clients: int) -> tuple[list[float], list[int], float]:
+    """Posts every pair of the corpus to the API from concurrent clients.
+
+    Args:
+        corpus (list): Id, advert and heatmap of each pair.
+        clients (int): Number of concurrent clients.
+
+    Returns:
+        tuple[list[float], list[int], float]: Latencies in seconds, status codes and the wall time.
+    """
+    import httpx
+    from api import api
+
+    latencies, statuses = [], []
+    pending = iter(corpus)
+
+    async def client_loop(client: httpx.AsyncClient):
+        for item_id, advert, heatmap in pending:
+            start = time.perf_counter()
+            response = await client.post("/congnitiv-analysis",
+                                         files={"advertisement_image": (f"{item_id}.img", advert),
+                                                "advertisement_heatmap_image": (f"{item_id}_heatmap.png", heatmap)})
+            latencies.append(time.perf_counter() - start)
+            statuses.append(response.status_code)
+
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(clients)))
+        return latencies, statuses, time.perf_counter() - start
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """Runs the load test.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        dict: The benchmark configuration ("config") and its results ("results").
+    """
+    sizes = tuple(parse_size(size) for size in args.sizes.split(",")) if args.sizes else DEFAULT_SIZES
+    with tempfile.TemporaryDirectory() as work_dir:
+        timers = setup(args, work_dir)
+        corpus = generate_corpus(args.requests + args.warmup, sizes, args.seed)
+        if args.warmup:
+            asyncio.run(drive(corpus[args.requests:], min(args.clients, args.warmup)))
+        for timer in timers.values():
+            timer.seconds, timer.calls = 0.0, 0
+
+        rss_before = current_rss_mb()
+        cpu_before = time.process_time()
+        latencies, statuses, wall = asyncio.run(drive(corpus[:args.requests], args.clients))
+        cpu = time.process_time() - cpu_before
+
+    latencies_ms = np.asarray(latencies) * 1000
+    config = {name: value for name, value in vars(args).items() if name not in ("output", "compare")}
+    config.update(sizes=[f"{width}x{height}" for width, height in sizes], python=platform.python_version(),
+                  platform=platform.platform(), cpus=os.cpu_count())
+    results = {"requests": len(statuses),
+               "errors": sum(status != 200 for status in statuses),
+               "wall_seconds": round(wall, 3),
+               "rps": round(len(statuses) / wall, 3),
+               "latency_ms": {"p50": round(float(np.percentile(latencies_ms, 50)), 1),
+                              "p95": round(float(np.percentile(latencies_ms, 95)), 1),
+                              "p99": round(float(np.percentile(latencies_ms, 99)), 1),
+                              "mean": round(float(latencies_ms.mean()), 1),
+                              "max": round(float(latencies_ms.max()), 1)},
+               "cpu_seconds": {"process": round(cpu, 3),
+                               **{name: round(timer.seconds, 4) for name, timer in timers.items()}},
+               "calls": {name: timer.calls for name, timer in timers.items()},
+               "rss_before_mb": round(rss_before, 1) if rss_before is not None else None,
+               "peak_rss_mb": round(peak_rss_mb(), 1)}
+    return {"config": config, "results": results}
+
+
+def lookup(results: dict, metric: str):
+    """Returns a nested value of the results.
+
+    Args:
+        results (dict): Benchmark results.
+        metric (str): Dotted path like "latency_ms.p95".
+
+    Returns:
+        Any: The value, or None if it is missing.
+    """
+    value = results
+    for part in metric.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    """Compares the results with a baseline and prints the relative changes.
+
+    Args:
+        baseline (dict): Baseline benchmark.
+        current (dict): Current benchmark.
+        tolerance (float): Allowed relative worsening of a metric, e.g. 0.1 for 10%.
+
+    Returns:
+        list[str]: Metrics which got worse by more than the tolerance.
+    """
+    regressions = []
+    print(f"{'metric':40} {'baseline':>12} {'current':>12} {'change':>9}", file=sys.stderr)
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        before, after = lookup(baseline["results"], metric), lookup(current["results"], metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        print(f"{metric:40} {before:>12} {after:>12} {change:>+9.1%}{flag}", file=sys.stderr)
+        if flag:
+            regressions.append(metric)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='LoadTest')
+    parser.add_argument('--env_path', type=str, default="./envs/.env")
+    parser.add_argument('--prompts_config_path', type=str, default="./analysis/prompts/data.yaml")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--requests', type=int, default=64, help="measured requests, each with distinct images")
+    parser.add_argument('--warmup', type=int, default=4, help="requests sent before the measurement")
+    parser.add_argument('--sizes', type=str, default=None, help="advert sizes like '800x600,1920x1080'")
+    parser.add_argument('--latency', type=float, default=1.0, help="mean model latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--distribution', type=str, default="uniform", choices=LATENCY_DISTRIBUTIONS)
+    parser.add_argument('--failure_rate', type=float, default=0.0, help="share of model requests failing with 503")
+    parser.add_argument('--retry_delay', type=float, default=0.05, help="base delay of model retries in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help="keep the result cache and the stage checkpoints")
+    parser.add_argument('--rate_limits', action='store_true', help="keep the LLM_*_PER_MINUTE rate limits")
+    parser.add_argument('--log_level', type=str, default="WARNING")
+    parser.add_argument('--output', type=str, default=None, help="save the results as a JSON baseline")
+    parser.add_argument('--compare', type=str, default=None, help="baseline JSON to compare the results with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed relative regression")
+
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    benchmark = run_benchmark(args)
+    print(json.dumps(benchmark, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(benchmark, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), benchmark, args.tolerance)
+        if regressions:
+            sys.exit(f"regressions: {', '.join(regressions)}")
@@ -1,2 +1,4 @@
+from .custom_exceptions import InvalidImageException as InvalidImageException
 from .custom_exceptions import LLMException as LLMException
+from .custom_exceptions import QueueFullException as QueueFullException
 from .logger import get_logger as get_logger
@@ -20,3 +20,47 @@ class LLMException(Exception):
             str: The error message associated with the exception.
         """
         return f"{self.message}"
+
+
+class QueueFullException(Exception):
+    """Custom exception class raised when a job cannot be accepted because the job queue is full."""
+
+    def __init__(self, message: str):
+        """Initializes the QueueFullException with a custom error message.
+
+        Args:
+           message (str): The error message to be associated with the exception.
+        """
+        super().__init__(message)
+        self.message = message
+
+    def __str__(self):
+        """Returns the string representation of the exception.
+
+        Returns:
+            str: The error message associated with the exception.
+        """
+        return f"{self.message}"
+
+
+class InvalidImageException(Exception):
+    """Custom exception class raised when an uploaded file is not an image or is larger than allowed."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        """Initializes the InvalidImageException with a custom error message.
+
+        Args:
+           message (str): The error message to be associated with the exception.
+           status_code (int): HTTP status of the error: 400 for a file which is not an image, 413 for a too large one.
+        """
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+    def __str__(self):
+        """Returns the string representation of the exception.
+
+        Returns:
+            str: The error message associated with the exception.
+        """
+        return f"{self.message}"
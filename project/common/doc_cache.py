@@ -0,0 +1,219 @@
+"""This module provides a persistent cache for the helper documents used by the analysis processes.
+
+Helper documents (e.g. the cognitive load PDF used by process B) are expensive to fetch, parse and OCR,
+so the extracted text is kept in memory and on disk, keyed by the document path/URL plus its version
+(ETag/Last-Modified for URLs, mtime/size for local files). The disk tier is shared by the server worker processes:
+a document is extracted by one of them while the others wait for its result.
+"""
+
+import contextlib
+import hashlib
+import os
+import threading
+import time
+import urllib.request
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where each process builds the cache entries itself
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Holds an exclusive lock of a file, shared by all processes of the host.
+
+    Args:
+        path (str): Path of the lock file; it is created if needed.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class HelperDocCache:
+    """Two-tier (memory + disk) cache of text extracted from helper documents.
+
+    Lookup order is: pre-extracted text artifact, memory, disk, and finally a full load of the document.
+    If the document version cannot be determined (e.g. no network access), the latest disk entry for the
+    document is used, so the service can run fully offline once the cache is warm.
+    """
+
+    def __init__(self, cache_dir: str, revalidate_after: float = 3600.0, request_timeout: float = 5.0):
+        """Initialize a HelperDocCache instance.
+
+        Args:
+            cache_dir (str): Directory where extracted texts are stored.
+            revalidate_after (float): Seconds after which an in-memory entry is revalidated against the source.
+            request_timeout (float): Timeout in seconds for the HEAD request used to get a remote document version.
+        """
+        self.cache_dir = cache_dir
+        self.revalidate_after = revalidate_after
+        self.request_timeout = request_timeout
+        self.hits = 0
+        self.misses = 0
+        self._memory = {}  # doc_path -> (key, text, checked_at)
+        self._refresh_locks = {}  # doc_path -> threading.Lock held by the caller refreshing the document
+        self._lock = threading.Lock()  # guards the dicts and counters; never held across I/O
+
+    @property
+    def stats(self) -> dict:
+        """Returns cache hit/miss counters.
+
+        Returns:
+            dict: Number of cache hits and misses.
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def warm(self, process_prompts: dict):
+        """Loads the helper document of a process config into the cache.
+
+        Args:
+            process_prompts (dict): Process configuration containing "helper_doc_path" and optionally
+                                    "helper_doc_text_path".
+        """
+        self.get(process_prompts["helper_doc_path"], process_prompts.get("helper_doc_text_path"))
+
+    def get(self, doc_path: str, text_path: str | None = None) -> str:
+        """Returns the text content of a helper document.
+
+        Args:
+            doc_path (str): Local path or URL of the PDF document.
+            text_path (str | None): Optional path of a pre-extracted text artifact. If the file exists,
+                                    it is used instead of the document.
+
+        Returns:
+            str: The combined text content from all pages of the document.
+        """
+        if text_path and os.path.isfile(text_path):
+            doc_path = text_path
+
+        with self._lock:
+            cached = self._memory.get(doc_path)
+            if cached and time.monotonic() - cached[2] < self.revalidate_after:
+                self.hits += 1
+                return cached[1]
+            refresh_lock = self._refresh_locks.setdefault(doc_path, threading.Lock())
+
+        # one caller checks the version and extracts the document; the others keep the stale text meanwhile,
+        # or wait for it on a cold cache
+        if not refresh_lock.acquire(blocking=cached is None):
+            with self._lock:
+                self.hits += 1
+            return cached[1]
+        try:
+            with self._lock:
+                refreshed = self._memory.get(doc_path)
+            if refreshed is not cached and refreshed is not None:  # refreshed while this caller waited
+                with self._lock:
+                    self.hits += 1
+                return refreshed[1]
+            return self._refresh(doc_path, cached)
+        finally:
+            refresh_lock.release()
+
+    def _refresh(self, doc_path: str, cached: tuple | None) -> str:
+        version = self._get_version(doc_path)
+        if version is None:
+            key = self._read_latest_key(doc_path) or (cached[0] if cached else None)
+        else:
+            key = self._make_key(doc_path, version)
+
+        hit = True
+        if cached and cached[0] == key:
+            text = cached[1]
+        else:
+            text = self._read_disk(key) if key else None
+        if text is None:
+            # another worker process may be extracting the same document; wait for it and reuse its result
+            with file_lock(os.path.join(self.cache_dir, f"{key or self._make_key(doc_path, '')}.lock")):
+                key = key or self._read_latest_key(doc_path)
+                text = self._read_disk(key) if key else None
+                if text is None:
+                    hit = False
+                    text = self._load(doc_path)
+                    key = key or self._make_key(doc_path, hashlib.sha256(text.encode("utf-8")).hexdigest())
+                    self._write_disk(doc_path, key, text)
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._memory[doc_path] = (key, text, time.monotonic())
+        return text
+
+    def export(self, doc_path: str, text_path: str):
+        """Saves the text of a document as a pre-extracted artifact for offline use.
+
+        Args:
+            doc_path (str): Local path or URL of the PDF document.
+            text_path (str): Path where the extracted text will be saved.
+        """
+        text = self.get(doc_path)
+        os.makedirs(os.path.dirname(os.path.abspath(text_path)), exist_ok=True)
+        with open(text_path, "w", encoding="utf-8") as file:
+            file.write(text)
+
+    def _get_version(self, doc_path: str) -> str | None:
+        if doc_path.startswith(("http://", "https://")):
+            request = urllib.request.Request(doc_path, method="HEAD")
+            try:
+                with urllib.request.urlopen(request, timeout=self.request_timeout) as response:
+                    headers = response.headers
+            except OSError:
+                return None
+            version = headers.get("ETag") or headers.get("Last-Modified")
+            return f"{version}-{headers.get('Content-Length')}" if version else None
+
+        try:
+            stat = os.stat(doc_path)
+        except OSError:
+            return None
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    @staticmethod
+    def _make_key(doc_path: str, version: str) -> str:
+        return hashlib.sha256(f"{doc_path}\0{version}".encode("utf-8")).hexdigest()
+
+    def _latest_path(self, doc_path: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(doc_path.encode("utf-8")).hexdigest() + ".latest")
+
+    def _read_latest_key(self, doc_path: str) -> str | None:
+        try:
+            with open(self._latest_path(doc_path), encoding="utf-8") as file:
+                return file.read().strip() or None
+        except OSError:
+            return None
+
+    def _read_disk(self, key: str) -> str | None:
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.txt"), encoding="utf-8") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, doc_path: str, key: str, text: str):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for path, content in ((os.path.join(self.cache_dir, f"{key}.txt"), text), (self._latest_path(doc_path), key)):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(content)
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def _load(doc_path: str) -> str:
+        if doc_path.endswith(".txt"):
+            with open(doc_path, encoding="utf-8") as file:
+                return file.read()
+
+        from langchain_community.document_loaders import PyPDFLoader
+        loader = PyPDFLoader(doc_path, extract_images=True)
+        return "\n".join([page.page_content for page in loader.load()])
@@ -0,0 +1,258 @@
+"""This module provides offline retrieval over helper documents.
+
+A helper document is split into overlapping chunks and indexed with BM25, without any network access or model.
+Only the chunks relevant to a query, within a token budget, are then put into a prompt instead of the whole
+document. Indexes are kept in memory and on disk, keyed by the document text and the chunking parameters,
+so they are built once per document version, by one of the server worker processes.
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from common.doc_cache import file_lock
+
+INDEX_FORMAT_VERSION = 1
+WORD_PATTERN = re.compile(r"[^\W_]+")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+STOPWORDS = frozenset("""
+a an and are as at be been but by can could do does for from had has have how i if in into is it its itself may might
+more most no not of on or our should so such than that the their them then there these they this those to too was we
+were what when where which while who why will with would you your
+""".split())
+
+
+def count_tokens(text: str) -> int:
+    """Roughly estimates the tokens of a text, 4 characters per token like the model client.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: Estimated number of tokens.
+    """
+    return max(1, len(text) // 4)
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits a text into lowercase index terms without stopwords and with common suffixes stripped.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list[str]: The terms.
+    """
+    terms = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        for suffix in ("ing", "ed", "es", "ly", "s"):
+            if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+                word = word[:-len(suffix)]
+                break
+        terms.append(word)
+    return terms
+
+
+def chunk_text(text: str, chunk_tokens: int = 150, overlap_tokens: int = 30) -> list[str]:
+    """Splits a text into chunks of whole sentences, each of about chunk_tokens tokens.
+
+    Args:
+        text (str): The text.
+        chunk_tokens (int): Maximum tokens of a chunk; longer sentences are split by words.
+        overlap_tokens (int): Tokens of the trailing sentences of a chunk repeated at the start of the next one.
+
+    Returns:
+        list[str]: The chunks in document order.
+    """
+    sentences = []
+    for sentence in SENTENCE_PATTERN.split(text):
+        sentence = " ".join(sentence.split())
+        if not sentence:
+            continue
+        words = sentence.split(" ")
+        while count_tokens(sentence) > chunk_tokens and len(words) > 1:
+            # take as many words as fit into a chunk
+            size = max(1, len(words) * chunk_tokens // count_tokens(sentence))
+            sentences.append(" ".join(words[:size]))
+            words = words[size:]
+            sentence = " ".join(words)
+        sentences.append(sentence)
+
+    chunks, current = [], []
+    for sentence in sentences:
+        if current and count_tokens(" ".join(current + [sentence])) > chunk_tokens:
+            chunks.append(" ".join(current))
+            overlap = []
+            for previous in reversed(current):
+                if count_tokens(" ".join([previous] + overlap)) > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+            current = overlap
+        current.append(sentence)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 index of text chunks."""
+
+    def __init__(self, chunks: list[str], term_frequencies: list[dict] | None = None, k1: float = 1.5,
+                 b: float = 0.75):
+        """Initialize a BM25Index instance.
+
+        Args:
+            chunks (list[str]): Indexed chunks.
+            term_frequencies (list[dict] | None): Term frequencies of each chunk; computed if None.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 length normalization.
+        """
+        self.chunks = chunks
+        self.term_frequencies = term_frequencies or [dict(Counter(tokenize(chunk))) for chunk in chunks]
+        self.k1 = k1
+        self.b = b
+        self.lengths = [sum(frequencies.values()) for frequencies in self.term_frequencies]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        document_frequencies = Counter(term for frequencies in self.term_frequencies for term in frequencies)
+        self.idf = {term: math.log(1 + (len(chunks) - df + 0.5) / (df + 0.5))
+                    for term, df in document_frequencies.items()}
+
+    def search(self, query: str, top_k: int) -> list[tuple[int, float]]:
+        """Ranks the chunks by their relevance to a query.
+
+        Args:
+            query (str): The query text.
+            top_k (int): Maximum number of results.
+
+        Returns:
+            list[tuple[int, float]]: Index and score of the chunks with a positive score, best first.
+        """
+        terms = [term for term in set(tokenize(query)) if term in self.idf]
+        scores = []
+        for i, frequencies in enumerate(self.term_frequencies):
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / (self.average_length or 1))
+            score = sum(self.idf[term] * frequencies[term] * (self.k1 + 1) / (frequencies[term] + norm)
+                        for term in terms if term in frequencies)
+            if score > 0:
+                scores.append((i, score))
+        scores.sort(key=lambda item: (-item[1], item[0]))
+        return scores[:top_k]
+
+    def select(self, query: str, top_k: int, token_budget: int) -> str:
+        """Returns the most relevant chunks which fit into a token budget, in document order.
+
+        If no chunk matches the query, the leading chunks of the document are returned.
+
+        Args:
+            query (str): The query text.
+            top_k (int): Maximum number of chunks.
+            token_budget (int): Maximum total tokens of the chunks.
+
+        Returns:
+            str: The chunks separated by blank lines.
+        """
+        ranked = [i for i, _ in self.search(query, len(self.chunks))] or list(range(len(self.chunks)))
+        selected, used = [], 0
+        for i in ranked:
+            tokens = count_tokens(self.chunks[i])
+            if used + tokens > token_budget:
+                continue
+            selected.append(i)
+            used += tokens
+            if len(selected) == top_k:
+                break
+        return "\n\n".join(self.chunks[i] for i in sorted(selected))
+
+    def to_dict(self) -> dict:
+        """Returns the JSON-serializable form of the index.
+
+        Returns:
+            dict: Chunks and their term frequencies.
+        """
+        return {"version": INDEX_FORMAT_VERSION, "chunks": self.chunks, "term_frequencies": self.term_frequencies}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BM25Index":
+        """Restores an index saved with to_dict.
+
+        Args:
+            data (dict): The saved index.
+
+        Returns:
+            BM25Index: The index.
+
+        Raises:
+            ValueError: If the data has another format version.
+        """
+        if data.get("version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"unsupported index format version {data.get('version')}")
+        return cls(data["chunks"], data["term_frequencies"])
+
+
+class HelperDocIndex:
+    """Two-tier (memory + disk) store of the BM25 indexes of helper documents."""
+
+    def __init__(self, cache_dir: str, max_entries: int = 8):
+        """Initialize a HelperDocIndex instance.
+
+        Args:
+            cache_dir (str): Directory where the indexes are stored.
+            max_entries (int): Maximum number of indexes kept in memory.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._memory = {}  # key -> BM25Index, in insertion order
+        self._lock = threading.Lock()
+
+    def get(self, text: str, chunk_tokens: int = 150, overlap_tokens: int = 30) -> BM25Index:
+        """Returns the index of a document text, building and saving it on first use.
+
+        Args:
+            text (str): The document text.
+            chunk_tokens (int): Maximum tokens of a chunk.
+            overlap_tokens (int): Overlap of consecutive chunks in tokens.
+
+        Returns:
+            BM25Index: The index.
+        """
+        digest = hashlib.sha256(f"{INDEX_FORMAT_VERSION}\0{chunk_tokens}\0{overlap_tokens}\0{text}".encode("utf-8"))
+        key = digest.hexdigest()
+        with self._lock:
+            index = self._memory.get(key)
+            if index is not None:
+                return index
+
+            index = self._read_disk(key)
+            if index is None:
+                with file_lock(f"{self._path(key)}.lock"):
+                    index = self._read_disk(key)
+                    if index is None:
+                        index = BM25Index(chunk_text(text, chunk_tokens, overlap_tokens))
+                        self._write_disk(key, index)
+            if len(self._memory) >= self.max_entries:
+                self._memory.pop(next(iter(self._memory)))
+            self._memory[key] = index
+            return index
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.bm25.json")
+
+    def _read_disk(self, key: str) -> BM25Index | None:
+        try:
+            with open(self._path(key), encoding="utf-8") as file:
+                return BM25Index.from_dict(json.load(file))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key: str, index: BM25Index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(index.to_dict(), file, ensure_ascii=False)
+        os.replace(tmp_path, self._path(key))
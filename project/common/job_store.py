@@ -0,0 +1,264 @@
+"""This module provides storage backends for analysis jobs.
+
+A job is a dict with "job_id", "status" ("queued", "running", "done", "failed"), per-stage "progress",
+"result", "error", "callback_url" and "created"/"updated" timestamps. The job inputs are stored separately,
+so they are not returned with the job status.
+
+The sqlite store can be shared by several server worker processes. Each job is owned by the worker which runs it;
+jobs of a worker which exited (e.g. recycled) are taken over by the next worker starting its job queue.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+JOB_STAGES = ("A1", "A2", "B", "C")
+
+_PROCESS_INSTANCE_ID = uuid.uuid4().hex
+
+
+def worker_id() -> str:
+    """Returns the id of this worker process: the server launch (SERVER_INSTANCE_ID, set by main.py) and the pid.
+
+    Returns:
+        str: The worker id.
+    """
+    return f"{os.getenv('SERVER_INSTANCE_ID') or _PROCESS_INSTANCE_ID}:{os.getpid()}"
+
+
+def is_worker_alive(owner: str | None) -> bool:
+    """Checks whether the worker owning a job is still running.
+
+    Workers of a previous server launch are never alive, even if their pid was reused.
+
+    Args:
+        owner (str | None): Worker id of the owner.
+
+    Returns:
+        bool: True if the owner is a running process of the current server launch.
+    """
+    instance, _, pid = (owner or "").rpartition(":")
+    if instance != worker_id().rpartition(":")[0] or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def new_job(job_id: str, callback_url: str | None = None) -> dict:
+    """Creates the initial record of a queued job.
+
+    Args:
+        job_id (str): The unique identifier of the job.
+        callback_url (str | None): Optional URL notified when the job finishes.
+
+    Returns:
+        dict: The job record.
+    """
+    now = time.time()
+    return {"job_id": job_id, "status": "queued", "progress": {stage: "pending" for stage in JOB_STAGES},
+            "result": None, "error": None, "callback_url": callback_url, "created": now, "updated": now}
+
+
+class InMemoryJobStore:
+    """Job store kept in the process memory; jobs are lost on restart."""
+
+    def __init__(self, ttl: float = 3600.0):
+        """Initialize an InMemoryJobStore instance.
+
+        Args:
+            ttl (float): Seconds after which finished jobs are removed.
+        """
+        self.ttl = ttl
+        self._jobs = {}
+        self._inputs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: dict, advert_image: bytes, advert_heatmap_image: bytes):
+        """Stores a new job and its inputs.
+
+        Args:
+            job (dict): The job record.
+            advert_image (bytes): Advert image of the job.
+            advert_heatmap_image (bytes): Heatmap image of the job.
+        """
+        with self._lock:
+            expired_before = time.time() - self.ttl
+            for job_id in [job_id for job_id, stored in self._jobs.items()
+                           if stored["status"] in ("done", "failed") and stored["updated"] < expired_before]:
+                del self._jobs[job_id]
+            self._jobs[job["job_id"]] = job
+            self._inputs[job["job_id"]] = (advert_image, advert_heatmap_image)
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns a copy of the job record.
+
+        Args:
+            job_id (str): The unique identifier of the job.
+
+        Returns:
+            dict | None: The job record, or None if the job is unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def get_inputs(self, job_id: str) -> tuple[bytes, bytes] | None:
+        """Returns the images of the job.
+
+        Args:
+            job_id (str): The unique identifier of the job.
+
+        Returns:
+            tuple[bytes, bytes] | None: The advert and heatmap images, or None if they are not stored.
+        """
+        with self._lock:
+            return self._inputs.get(job_id)
+
+    def update(self, job_id: str, progress: dict | None = None, **fields):
+        """Updates fields of the job record; inputs of finished jobs are dropped.
+
+        Args:
+            job_id (str): The unique identifier of the job.
+            progress (dict | None): Stage statuses to merge into the job progress.
+            **fields: Fields of the job record to set.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields, updated=time.time())
+            if progress:
+                job["progress"].update(progress)
+            if job["status"] in ("done", "failed"):
+                self._inputs.pop(job_id, None)
+
+    def claim_unfinished(self) -> list[str]:
+        """Returns the ids of the jobs which are not finished; jobs in memory always belong to this process.
+
+        Returns:
+            list[str]: Ids of queued or running jobs, oldest first.
+        """
+        with self._lock:
+            return [job_id for job_id, job in sorted(self._jobs.items(), key=lambda item: item[1]["created"])
+                    if job["status"] in ("queued", "running")]
+
+
+class SqliteJobStore:
+    """Job store kept in a sqlite database, so queued jobs survive a restart."""
+
+    def __init__(self, path: str, ttl: float = 3600.0):
+        """Initialize a SqliteJobStore instance.
+
+        Args:
+            path (str): Path to the sqlite database file.
+            ttl (float): Seconds after which finished jobs are removed.
+        """
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, job TEXT, status TEXT, "
+                               "created REAL, updated REAL, advert_image BLOB, advert_heatmap_image BLOB, "
+                               "owner TEXT)")
+            if "owner" not in [column[1] for column in connection.execute("PRAGMA table_info(jobs)")]:
+                connection.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")  # stores of earlier versions
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def create(self, job: dict, advert_image: bytes, advert_heatmap_image: bytes):
+        """Stores a new job and its inputs.
+
+        Args:
+            job (dict): The job record.
+            advert_image (bytes): Advert image of the job.
+            advert_heatmap_image (bytes): Heatmap image of the job.
+        """
+        with self._lock, self._connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                               (time.time() - self.ttl,))
+            connection.execute("INSERT INTO jobs (job_id, job, status, created, updated, advert_image, "
+                               "advert_heatmap_image, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (job["job_id"], json.dumps(job, ensure_ascii=False), job["status"], job["created"],
+                                job["updated"], advert_image, advert_heatmap_image, worker_id()))
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns the job record.
+
+        Args:
+            job_id (str): The unique identifier of the job.
+
+        Returns:
+            dict | None: The job record, or None if the job is unknown.
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT job FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_inputs(self, job_id: str) -> tuple[bytes, bytes] | None:
+        """Returns the images of the job.
+
+        Args:
+            job_id (str): The unique identifier of the job.
+
+        Returns:
+            tuple[bytes, bytes] | None: The advert and heatmap images, or None if they are not stored.
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT advert_image, advert_heatmap_image FROM jobs WHERE job_id = ?",
+                                     (job_id,)).fetchone()
+        return (row[0], row[1]) if row and row[0] is not None else None
+
+    def update(self, job_id: str, progress: dict | None = None, **fields):
+        """Updates fields of the job record; inputs of finished jobs are dropped.
+
+        Args:
+            job_id (str): The unique identifier of the job.
+            progress (dict | None): Stage statuses to merge into the job progress.
+            **fields: Fields of the job record to set.
+        """
+        with self._lock, self._connect() as connection:
+            row = connection.execute("SELECT job FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            job = json.loads(row[0])
+            job.update(fields, updated=time.time())
+            if progress:
+                job["progress"].update(progress)
+            finished = job["status"] in ("done", "failed")
+            connection.execute("UPDATE jobs SET job = ?, status = ?, updated = ? WHERE job_id = ?",
+                               (json.dumps(job, ensure_ascii=False), job["status"], job["updated"], job_id))
+            if finished:
+                connection.execute("UPDATE jobs SET advert_image = NULL, advert_heatmap_image = NULL "
+                                   "WHERE job_id = ?", (job_id,))
+
+    def claim_unfinished(self) -> list[str]:
+        """Takes over the unfinished jobs whose owner is not running, e.g. after a restart or a recycled worker.
+
+        Returns:
+            list[str]: Ids of the claimed queued or running jobs, oldest first.
+        """
+        me = worker_id()
+        claimed = []
+        with self._lock, self._connect() as connection:
+            rows = connection.execute("SELECT job_id, owner FROM jobs WHERE status IN ('queued', 'running') "
+                                      "ORDER BY created").fetchall()
+            for job_id, owner in rows:
+                if owner == me or is_worker_alive(owner):
+                    continue
+                # another starting worker may claim the same job; only one update matches the old owner
+                cursor = connection.execute("UPDATE jobs SET owner = ? WHERE job_id = ? AND owner IS ?",
+                                            (me, job_id, owner))
+                if cursor.rowcount:
+                    claimed.append(job_id)
+        return claimed
@@ -0,0 +1,419 @@
+"""This module provides a resilient client layer around the chat model.
+
+It adds token-bucket rate limiting of requests and tokens per minute, jittered exponential retries of
+retryable errors, a concurrency limit and single-flight coalescing of identical in-flight prompts.
+Request time, errors, token usage and estimated cost are recorded in common.metrics per pipeline stage.
+The wrapped model can be any LangChain chat model, e.g. ChatOpenAI or a local fake chat model in tests.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import random
+import threading
+import time
+from typing import AsyncIterator
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from common import metrics
+from common.result_cache import make_key
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+                         "TimeoutError", "ConnectionError"}
+IMAGE_TOKENS_ESTIMATE = 765  # tokens of a 1024x1024 high detail image
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at a rate of capacity per minute."""
+
+    def __init__(self, per_minute: float):
+        """Initialize a TokenBucket instance.
+
+        Args:
+            per_minute (float): Capacity of the bucket and its refill rate per minute. If 0, there is no limit.
+        """
+        self.capacity = per_minute
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes tokens from the bucket, allowing it to go into debt.
+
+        Args:
+            amount (float): Number of tokens to take; negative values return tokens.
+
+        Returns:
+            float: Seconds to wait until the taken tokens are actually available.
+        """
+        if self.capacity <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.capacity / 60)
+            self._updated = now
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens * 60 / self.capacity)
+
+
+class ConcurrencyLimit:
+    """Limit of concurrent calls shared by threads and event loops, so sync and async calls count together.
+
+    Used as a context manager by threads and as an async context manager by coroutines; a released slot is handed
+    to the longest waiting caller.
+    """
+
+    def __init__(self, limit: int):
+        """Initialize a ConcurrencyLimit instance.
+
+        Args:
+            limit (int): Maximum number of calls in progress.
+        """
+        self.limit = limit
+        self.active = 0
+        self._waiters = collections.deque()  # threading.Event or (event loop, asyncio.Future)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            if self.active < self.limit:
+                self.active += 1
+                return self
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()  # the slot is handed over by release
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.limit:
+                self.active += 1
+                return self
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()  # the slot was handed over before the cancellation; otherwise _wake releases it
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        """Releases a slot, handing it to the longest waiting caller if there is one."""
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:  # the loop is closed
+                self.release()
+
+    def _wake(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+def estimate_tokens(messages: list) -> int:
+    """Roughly estimates the prompt tokens of chat messages.
+
+    Args:
+        messages (list): LangChain messages.
+
+    Returns:
+        int: Estimated number of tokens, 4 characters per token plus a fixed cost per image and detail level.
+    """
+    tokens = 0
+    for message in messages:
+        if isinstance(message.content, str):
+            tokens += len(message.content) // 4
+            continue
+        for part in message.content:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                detail = part["image_url"].get("detail") if isinstance(part.get("image_url"), dict) else None
+                tokens += LOW_DETAIL_IMAGE_TOKENS if detail == "low" else IMAGE_TOKENS_ESTIMATE
+            else:
+                tokens += len(part.get("text", "") if isinstance(part, dict) else str(part)) // 4
+    return tokens
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an error of the model provider is worth retrying.
+
+    Args:
+        error (Exception): The raised error.
+
+    Returns:
+        bool: True for rate limits, timeouts, connection errors and 5xx responses.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+def retry_after(error: Exception) -> float | None:
+    """Returns the delay requested by the provider in the Retry-After header.
+
+    Args:
+        error (Exception): The raised error.
+
+    Returns:
+        float | None: Seconds to wait, or None if the header is missing.
+    """
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class ResilientChatModel(Runnable):
+    """Runnable wrapping a chat model with rate limiting, retries, a concurrency limit and request coalescing."""
+
+    def __init__(self, model: Runnable, requests_per_minute: float = 500, tokens_per_minute: float = 30000,
+                 max_concurrency: int = 16, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 30.0,
+                 prompt_token_price: float = 0.0, completion_token_price: float = 0.0):
+        """Initialize a ResilientChatModel instance.
+
+        Args:
+            model (Runnable): The wrapped chat model.
+            requests_per_minute (float): Limit of requests per minute; 0 disables the limit.
+            tokens_per_minute (float): Limit of estimated prompt and completion tokens per minute; 0 disables it.
+            max_concurrency (int): Maximum number of concurrent requests, sync and async calls together.
+            max_retries (int): Maximum number of retries of a retryable error.
+            base_delay (float): Delay in seconds before the first retry, doubled on every next retry.
+            max_delay (float): Maximum delay in seconds between retries.
+            prompt_token_price (float): Price in USD of a million prompt tokens, used for the cost metric.
+            completion_token_price (float): Price in USD of a million completion tokens.
+        """
+        self.model = model
+        self.model_name = getattr(model, "model_name", None) or type(model).__name__
+        self.prompt_token_price = prompt_token_price
+        self.completion_token_price = completion_token_price
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limit = ConcurrencyLimit(max_concurrency)
+        self._in_flight = {}  # prompt key -> concurrent.futures.Future
+        self._async_in_flight = {}  # (event loop, prompt key) -> [asyncio.Task, number of waiting callers]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _messages(input) -> list:
+        if isinstance(input, PromptValue):
+            return input.to_messages()
+        if isinstance(input, list):
+            return input
+        return [input]
+
+    def _key(self, messages: list, kwargs: dict) -> str:
+        return make_key(json.dumps([(message.type, message.content) for message in messages], ensure_ascii=False,
+                                   sort_keys=True, default=str), json.dumps(kwargs, sort_keys=True, default=str))
+
+    def _delay(self, attempt: int, error: Exception) -> float:
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))  # full jitter
+        return delay
+
+    def _settle_tokens(self, estimated: int, result):
+        usage = getattr(result, "usage_metadata", None) if isinstance(result, AIMessage) else None
+        if usage:
+            self.tokens.reserve(usage.get("total_tokens", estimated) - estimated)
+
+    def _record(self, start: float, result=None, error: Exception | None = None):
+        stage = metrics.stage_var.get()
+        metrics.llm_seconds.observe(time.perf_counter() - start, stage=stage, model=self.model_name)
+        if error is not None:
+            metrics.llm_errors.inc(stage=stage, model=self.model_name, error=type(error).__name__)
+            return
+        usage = getattr(result, "usage_metadata", None) if isinstance(result, AIMessage) else None
+        if not usage:
+            return
+        prompt_tokens, completion_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+        metrics.llm_tokens.observe(prompt_tokens, stage=stage, model=self.model_name, type="prompt")
+        metrics.llm_tokens.observe(completion_tokens, stage=stage, model=self.model_name, type="completion")
+        metrics.llm_cost.inc((prompt_tokens * self.prompt_token_price
+                              + completion_tokens * self.completion_token_price) / 1e6,
+                             stage=stage, model=self.model_name)
+
+    def invoke(self, input, config: RunnableConfig | None = None, **kwargs) -> AIMessage:
+        """Calls the wrapped model, coalescing identical in-flight prompts.
+
+        Args:
+            input (PromptValue | list): The prompt.
+            config (RunnableConfig | None): Runnable config passed to the wrapped model.
+            **kwargs: Additional arguments passed to the wrapped model.
+
+        Returns:
+            AIMessage: The model response.
+        """
+        messages = self._messages(input)
+        key = self._key(messages, kwargs)
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = concurrent.futures.Future()
+        if not owner:
+            return future.result()
+
+        try:
+            result = self._invoke(messages, config, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _invoke(self, messages: list, config: RunnableConfig | None, **kwargs):
+        estimated = estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(max(self.requests.reserve(1), self.tokens.reserve(estimated)))
+            with self._limit:
+                start = time.perf_counter()
+                try:
+                    result = self.model.invoke(messages, config, **kwargs)
+                except Exception as e:
+                    self._record(start, error=e)
+                    if attempt == self.max_retries or not is_retryable(e):
+                        raise
+                    error = e
+                else:
+                    self._record(start, result)
+                    self._settle_tokens(estimated, result)
+                    return result
+            time.sleep(self._delay(attempt, error))
+
+    async def ainvoke(self, input, config: RunnableConfig | None = None, **kwargs) -> AIMessage:
+        """Asynchronous version of invoke.
+
+        Args:
+            input (PromptValue | list): The prompt.
+            config (RunnableConfig | None): Runnable config passed to the wrapped model.
+            **kwargs: Additional arguments passed to the wrapped model.
+
+        Returns:
+            AIMessage: The model response.
+        """
+        messages = self._messages(input)
+        key = (asyncio.get_running_loop(), self._key(messages, kwargs))
+        entry = self._async_in_flight.get(key)
+        if entry is None:
+            # the call runs in its own task, so a cancelled caller does not cancel it for the other callers
+            task = asyncio.create_task(self._ainvoke(messages, config, **kwargs))
+            entry = self._async_in_flight[key] = [task, 0]
+            task.add_done_callback(lambda done: self._forget_async(key, entry, done))
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():  # every caller was cancelled
+                task.cancel()
+                self._forget_async(key, entry, None)
+
+    def _forget_async(self, key: tuple, entry: list, task: asyncio.Task | None):
+        if self._async_in_flight.get(key) is entry:
+            del self._async_in_flight[key]
+        if task is not None and not task.cancelled():
+            task.exception()  # mark the exception as retrieved if every caller was cancelled
+
+    async def _ainvoke(self, messages: list, config: RunnableConfig | None, **kwargs):
+        estimated = estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(max(self.requests.reserve(1), self.tokens.reserve(estimated)))
+            async with self._limit:
+                start = time.perf_counter()
+                try:
+                    result = await self.model.ainvoke(messages, config, **kwargs)
+                except Exception as e:
+                    self._record(start, error=e)
+                    if attempt == self.max_retries or not is_retryable(e):
+                        raise
+                    error = e
+                else:
+                    self._record(start, result)
+                    self._settle_tokens(estimated, result)
+                    return result
+            await asyncio.sleep(self._delay(attempt, error))
+
+    async def astream(self, input, config: RunnableConfig | None = None, **kwargs) -> AsyncIterator[AIMessageChunk]:
+        """Streams the response of the wrapped model.
+
+        Streams are rate limited and retried like invoke, but a request is only retried if it fails before its
+        first chunk; identical prompts are not coalesced.
+
+        Args:
+            input (PromptValue | list): The prompt.
+            config (RunnableConfig | None): Runnable config passed to the wrapped model.
+            **kwargs: Additional arguments passed to the wrapped model.
+
+        Yields:
+            AIMessageChunk: The response chunks.
+        """
+        messages = self._messages(input)
+        estimated = estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(max(self.requests.reserve(1), self.tokens.reserve(estimated)))
+            async with self._limit:
+                start = time.perf_counter()
+                stream = self.model.astream(messages, config, **kwargs)
+                try:
+                    response = await anext(stream)
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    self._record(start, error=e)
+                    if attempt == self.max_retries or not is_retryable(e):
+                        raise
+                    error = e
+                else:
+                    yield response
+                    try:
+                        async for chunk in stream:
+                            response = response + chunk
+                            yield chunk
+                    except Exception as e:
+                        self._record(start, error=e)
+                        raise
+                    self._record(start, response)
+                    self._settle_tokens(estimated, response)
+                    return
+                finally:
+                    await stream.aclose()  # also when the consumer stops early or the request is retried
+            await asyncio.sleep(self._delay(attempt, error))
@@ -1,35 +1,162 @@
+"""This module provides the application logger.
+
+Records are put on a queue by the logging thread and written to stdout and a rotating log file by a background
+listener thread, so logging does not block the request path on disk writes. Records are formatted as JSON lines
+(or as text) carrying the request id and the stage of the trace context. Long messages are truncated, and DEBUG and
+INFO records can be sampled per request.
+"""
+
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import sys
-from datetime import datetime
+import zlib
+from datetime import datetime, timezone
+
+from common.metrics import request_id_var, stage_var
+
+TEXT_FORMAT = ('%(asctime)s - %(name)s - [%(processName)s] - [%(threadName)s] - [%(request_id)s] - [%(stage)s] - '
+               '%(levelname)s - %(message)s ')
+
+_listeners = {}  # logger name -> QueueListener
+
+
+class TraceFilter(logging.Filter):
+    """Adds the request id and the pipeline stage of the trace context to log records."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.stage = stage_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of the DEBUG and INFO records; all records of a request are either kept or dropped.
+
+    Records without a request id and records of level WARNING and above are always kept.
+    """
+
+    def __init__(self, sample_rate: float):
+        """Initialize a SamplingFilter instance.
+
+        Args:
+            sample_rate (float): Share of the requests whose DEBUG and INFO records are kept, from 0 to 1.
+        """
+        super().__init__()
+        self.sample_rate = sample_rate
 
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.sample_rate >= 1 or record.levelno >= logging.WARNING or record.request_id == "-":
+            return True
+        return zlib.crc32(record.request_id.encode("utf-8")) / 0xFFFFFFFF < self.sample_rate
 
-def get_logger(file_path: str, name: str) -> logging.Logger:
-    """Creates and configures a logger with both file and console handlers.
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler which renders the message in the logging thread, truncated to a maximum length."""
+
+    def __init__(self, log_queue: queue.Queue, max_message_length: int):
+        """Initialize a TruncatingQueueHandler instance.
+
+        Args:
+            log_queue (queue.Queue): Queue read by the listener.
+            max_message_length (int): Maximum number of characters of a message; 0 disables truncation.
+        """
+        super().__init__(log_queue)
+        self.max_message_length = max_message_length
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if self.max_message_length and len(message) > self.max_message_length:
+            # the traceback of an exception is kept whole
+            record = copy.copy(record)
+            record.msg = (f"{message[:self.max_message_length]}... "
+                          f"[{len(message) - self.max_message_length} characters truncated]")
+            record.args = None
+        return super().prepare(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass  # the writer is behind; dropping a record is better than blocking the request
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "process": record.processName,
+                 "thread": record.threadName,
+                 "request_id": getattr(record, "request_id", "-"),
+                 "stage": getattr(record, "stage", "-"),
+                 "message": record.getMessage()}
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _stop_listener(name: str):
+    listener = _listeners.pop(name, None)
+    if listener is not None:
+        listener.stop()  # writes the queued records
+
+
+def get_logger(file_path: str, name: str, level: str | int = logging.DEBUG, json_format: bool = True,
+               max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5, rotate_when: str | None = None,
+               max_message_length: int = 4000, sample_rate: float = 1.0, queue_size: int = 10000) -> logging.Logger:
+    """Creates and configures a logger writing to stdout and a rotating file through a background thread.
 
     Args:
         file_path (str): The path to save logger file.
         name (str): The name of the logger.
+        level (str | int): The logging level, e.g. "INFO".
+        json_format (bool): Whether records are written as JSON lines or as text.
+        max_bytes (int): Size of the log file after which it is rotated, if rotate_when is not set.
+        backup_count (int): Number of rotated files kept.
+        rotate_when (str | None): Rotate the file by time instead of size, e.g. "midnight" or "H"
+                                  (see logging.handlers.TimedRotatingFileHandler).
+        max_message_length (int): Maximum number of characters of a message; 0 disables truncation.
+        sample_rate (float): Share of the requests whose DEBUG and INFO records are kept.
+        queue_size (int): Maximum number of records waiting to be written; further records are dropped.
 
     Returns:
         logging.Logger: A configured logger instance.
     """
+    _stop_listener(name)
     logger = logging.getLogger(name)
-    logger.setLevel(level=logging.DEBUG)
+    logger.setLevel(level=level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
     logger.handlers.clear()
+    logger.filters.clear()
+    logger.addFilter(TraceFilter())
+    logger.addFilter(SamplingFilter(sample_rate))
 
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - [%(processName)s] - [%(threadName)s] - %(levelname)s - %(message)s ',
-        datefmt='"%Y-%m-%d %H:%M:%S"')
-
-    file_handler = logging.FileHandler(
-        filename=os.path.join(file_path, f'{name}_{datetime.now().strftime("%Y_%m_%d_%H_%M")}.log'),
-        mode='a')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT, datefmt='"%Y-%m-%d %H:%M:%S"')
 
+    # several server worker processes must not rotate the same file
+    suffix = f".{os.getpid()}" if int(os.getenv("WEB_WORKERS", 1)) > 1 else ""
+    filename = os.path.join(file_path, f'{name}{suffix}.log')
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(filename, when=rotate_when,
+                                                                 backupCount=backup_count, delay=True)
+    else:
+        # the file is opened on the first record
+        file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                            delay=True)
     stdout_handler = logging.StreamHandler(stream=sys.stdout)
-    stdout_handler.setFormatter(formatter)
-    logger.addHandler(stdout_handler)
+    for handler in (file_handler, stdout_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    logger.addHandler(TruncatingQueueHandler(log_queue, max_message_length))
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stdout_handler)
+    listener.start()
+    _listeners[name] = listener
+    atexit.register(_stop_listener, name)
 
     return logger
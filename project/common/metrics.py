@@ -0,0 +1,250 @@
+"""This module provides in-process metrics exposed in the Prometheus text format, and the trace context.
+
+Histograms and counters are kept per label values in memory, so every server worker reports its own numbers.
+The trace context holds the id of the current request and the name of the current pipeline stage in context
+variables; they are attached to log records and used as labels of the model metrics.
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+stage_var = contextvars.ContextVar("stage", default="-")
+
+
+@contextlib.contextmanager
+def trace_scope(request_id: str | None = None, stage: str | None = None):
+    """Sets the request id and/or the stage of the trace context within the block.
+
+    Args:
+        request_id (str | None): Id of the current request; unchanged if None.
+        stage (str | None): Name of the current pipeline stage; unchanged if None.
+    """
+    tokens = []
+    if request_id is not None:
+        tokens.append((request_id_var, request_id_var.set(request_id)))
+    if stage is not None:
+        tokens.append((stage_var, stage_var.set(stage)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        """Initialize a Counter instance.
+
+        Args:
+            name (str): Metric name, including the "_total" suffix.
+            documentation (str): Help text of the metric.
+            labelnames (tuple): Names of the labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        """Increases the counter.
+
+        Args:
+            amount (float): Non-negative increment.
+            **labels: Label values, one for each label name.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        """Returns the sample lines of the metric.
+
+        Returns:
+            list[str]: Lines in the Prometheus text format.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values]
+
+
+class Histogram:
+    """Histogram with cumulative buckets and labels."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """Initialize a Histogram instance.
+
+        Args:
+            name (str): Metric name.
+            documentation (str): Help text of the metric.
+            labelnames (tuple): Names of the labels.
+            buckets (tuple): Sorted upper bounds of the buckets; the +Inf bucket is added automatically.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """Records an observation.
+
+        Args:
+            value (float): The observed value.
+            **labels: Label values, one for each label name.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the wall time of the block in seconds, also when it raises.
+
+        Args:
+            **labels: Label values, one for each label name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        """Returns the sample lines of the metric.
+
+        Returns:
+            list[str]: Lines in the Prometheus text format.
+        """
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in values:
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(counts[-1])}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        """Initialize a MetricsRegistry instance."""
+        self._metrics = {}
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        """Creates and registers a counter.
+
+        Args:
+            name (str): Metric name, without the "_total" suffix.
+            documentation (str): Help text of the metric.
+            labelnames (tuple): Names of the labels.
+
+        Returns:
+            Counter: The registered counter.
+        """
+        return self._register(Counter(name + "_total", documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """Creates and registers a histogram.
+
+        Args:
+            name (str): Metric name.
+            documentation (str): Help text of the metric.
+            labelnames (tuple): Names of the labels.
+            buckets (tuple): Sorted upper bounds of the buckets.
+
+        Returns:
+            Histogram: The registered histogram.
+        """
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Renders all metrics.
+
+        Returns:
+            str: The metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+analysis_seconds = metrics_registry.histogram(
+    "analysis_seconds", "Wall time of analyses which were not served from the result cache.")
+stage_seconds = metrics_registry.histogram(
+    "analysis_stage_seconds", "Wall time of an executed pipeline stage attempt.", ("stage",))
+stage_failures = metrics_registry.counter(
+    "analysis_stage_failures", "Failed pipeline stage attempts.", ("stage",))
+local_seconds = metrics_registry.histogram(
+    "analysis_local_seconds", "Wall time of local preprocessing (resize, base64, helper document).",
+    ("operation",))
+cache_lookups = metrics_registry.counter(
+    "analysis_cache_lookups", "Lookups of the result cache and of the stage outputs.", ("cache", "result"))
+llm_seconds = metrics_registry.histogram(
+    "llm_request_seconds", "Wall time of a model request attempt.", ("stage", "model"))
+llm_errors = metrics_registry.counter(
+    "llm_request_errors", "Failed model request attempts.", ("stage", "model", "error"))
+llm_tokens = metrics_registry.histogram(
+    "llm_tokens", "Prompt and completion tokens of a model response.", ("stage", "model", "type"), TOKEN_BUCKETS)
+llm_cost = metrics_registry.counter(
+    "llm_cost_usd", "Estimated cost of the model responses in USD.", ("stage", "model"))
+llm_stage_models = metrics_registry.counter(
+    "llm_stage_model", "Stage attempts per model; escalated stages count an attempt of every model tried.",
+    ("stage", "model"))
+llm_escalations = metrics_registry.counter(
+    "llm_escalations", "Stage outputs which could not be parsed and were escalated to the next model.",
+    ("stage", "model"))
+http_seconds = metrics_registry.histogram(
+    "http_request_seconds", "Wall time of HTTP requests.", ("method", "path", "status"))
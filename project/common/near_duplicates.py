@@ -0,0 +1,151 @@
+"""This module provides an index of the perceptual hashes of analysed advert/heatmap pairs.
+
+Lookups within a Hamming distance use multi-index hashing: the 64-bit advert hash is split into max_distance + 1
+chunks, so a hash within the distance equals the query in at least one chunk (pigeonhole principle), and only the
+entries sharing a chunk with the query are compared. Entries are kept in memory and optionally in a sqlite database
+shared by the server workers; entries added by other workers are read at most every SYNC_INTERVAL seconds.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+HASH_BITS = 64
+SYNC_INTERVAL = 1.0  # seconds between reads of the entries added by other workers
+
+
+@dataclass(frozen=True)
+class NearDuplicate:
+    """An indexed pair within the distance of a query."""
+
+    key: str
+    distance: int  # the larger of the advert and the heatmap distance; the advert distance for advert lookups
+    value: dict
+
+
+class NearDuplicateIndex:
+    """Multi-index hashing index of (advert hash, heatmap hash) pairs, with a value stored per pair."""
+
+    def __init__(self, max_distance: int, kind: str = "phash", db_path: str | None = None,
+                 max_entries: int = 200000):
+        """Initialize a NearDuplicateIndex instance and load the stored entries.
+
+        Args:
+            max_distance (int): Maximum Hamming distance of a match, from 0 to 63.
+            kind (str): Name of the hash; stored entries of another kind are ignored.
+            db_path (str | None): Path to the sqlite database. If None, the index is kept in memory only.
+            max_entries (int): Maximum number of entries; the oldest entries are removed first.
+
+        Raises:
+            ValueError: If max_distance is out of range.
+        """
+        if not 0 <= max_distance < HASH_BITS:
+            raise ValueError(f"max_distance must be from 0 to {HASH_BITS - 1}")
+        self.max_distance = max_distance
+        self.kind = kind
+        self.db_path = db_path
+        self.max_entries = max_entries
+        chunks = max_distance + 1
+        bounds = [HASH_BITS * index // chunks for index in range(chunks + 1)]
+        self._chunks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]  # shift, mask
+        self._entries = {}  # key -> (advert hash, heatmap hash, value), oldest first
+        self._buckets = [{} for _ in self._chunks]  # per chunk: chunk value -> keys
+        self._last_rowid = 0
+        self._synced = 0.0
+        self._writes = 0
+        self._lock = threading.Lock()
+        if db_path:
+            with self._connect() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS near_duplicates (key TEXT PRIMARY KEY, kind TEXT, "
+                                   "advert_hash TEXT, heatmap_hash TEXT, value TEXT, created REAL)")
+            self._sync()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _chunk_values(self, advert_hash: int):
+        return [(advert_hash >> shift) & mask for shift, mask in self._chunks]
+
+    def _insert(self, key: str, advert_hash: int, heatmap_hash: int, value: dict):
+        self._remove(key)
+        self._entries[key] = (advert_hash, heatmap_hash, value)
+        for buckets, chunk in zip(self._buckets, self._chunk_values(advert_hash)):
+            buckets.setdefault(chunk, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for buckets, chunk in zip(self._buckets, self._chunk_values(entry[0])):
+            bucket = buckets[chunk]
+            bucket.discard(key)
+            if not bucket:
+                del buckets[chunk]
+
+    def _sync(self):
+        self._synced = time.monotonic()
+        with self._connect() as connection:
+            rows = connection.execute("SELECT rowid, key, advert_hash, heatmap_hash, value FROM near_duplicates "
+                                      "WHERE rowid > ? AND kind = ? ORDER BY rowid",
+                                      (self._last_rowid, self.kind)).fetchall()
+        for rowid, key, advert_hash, heatmap_hash, value in rows:
+            self._insert(key, int(advert_hash, 16), int(heatmap_hash, 16), json.loads(value))
+            self._last_rowid = max(self._last_rowid, rowid)
+
+    def add(self, key: str, advert_hash: int, heatmap_hash: int, value: dict):
+        """Adds a pair, replacing the pair stored with the same key.
+
+        Args:
+            key (str): Key of the pair, e.g. the cache key of its result.
+            advert_hash (int): Perceptual hash of the advert.
+            heatmap_hash (int): Perceptual hash of the heatmap.
+            value (dict): JSON-serializable value returned with the matches of the pair.
+        """
+        with self._lock:
+            self._insert(key, advert_hash, heatmap_hash, value)
+            if not self.db_path:
+                return
+            with self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO near_duplicates VALUES (?, ?, ?, ?, ?, ?)",
+                                   (key, self.kind, f"{advert_hash:016x}", f"{heatmap_hash:016x}",
+                                    json.dumps(value, ensure_ascii=False), time.time()))
+                self._writes += 1
+                if self._writes % 100 == 1:
+                    connection.execute("DELETE FROM near_duplicates WHERE key IN (SELECT key FROM near_duplicates "
+                                       "ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def search(self, advert_hash: int, heatmap_hash: int | None = None) -> list[NearDuplicate]:
+        """Finds the indexed pairs within max_distance of the query.
+
+        Args:
+            advert_hash (int): Perceptual hash of the advert.
+            heatmap_hash (int | None): Perceptual hash of the heatmap. If None, only the adverts are compared.
+
+        Returns:
+            list[NearDuplicate]: The matches, nearest first.
+        """
+        with self._lock:
+            if self.db_path and time.monotonic() - self._synced >= SYNC_INTERVAL:
+                self._sync()
+            candidates = set()
+            for buckets, chunk in zip(self._buckets, self._chunk_values(advert_hash)):
+                candidates.update(buckets.get(chunk, ()))
+            matches = []
+            for key in candidates:
+                entry_advert_hash, entry_heatmap_hash, value = self._entries[key]
+                distance = (advert_hash ^ entry_advert_hash).bit_count()
+                if heatmap_hash is not None:
+                    distance = max(distance, (heatmap_hash ^ entry_heatmap_hash).bit_count())
+                if distance <= self.max_distance:
+                    matches.append(NearDuplicate(key, distance, value))
+        matches.sort(key=lambda match: match.distance)
+        return matches
@@ -0,0 +1,227 @@
+"""This module provides caches for analysis results.
+
+Results are stored as JSON in an in-memory LRU tier and, optionally, in an on-disk sqlite tier,
+so they can be shared between restarts and between server processes.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(*parts) -> str:
+    """Builds a cache key from bytes, strings or JSON-serializable parts.
+
+    Args:
+        *parts: Parts of the key. Dicts and lists are serialized with sorted keys.
+
+    Returns:
+        str: The sha256 hex digest of the parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, (bytes, bytearray, memoryview)):
+            part = part if isinstance(part, str) else json.dumps(part, sort_keys=True, ensure_ascii=False)
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with optional time-to-live."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float | None = None):
+        """Initialize an LRUCache instance.
+
+        Args:
+            max_entries (int): Maximum number of entries. If 0, nothing is stored.
+            ttl (float | None): Seconds after which an entry expires. If None, entries never expire.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, created_at)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value stored for the key.
+
+        Args:
+            key (Hashable): The cache key.
+            default (Any): Value returned if the key is missing or expired.
+
+        Returns:
+            Any: The cached value or default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Stores the value for the key, evicting the least recently used entries if needed.
+
+        Args:
+            key (Hashable): The cache key.
+            value (Any): The value to store.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SqliteCache:
+    """On-disk cache tier stored in a sqlite database, safe to share between processes."""
+
+    def __init__(self, path: str, max_entries: int = 100000, ttl: float | None = None):
+        """Initialize a SqliteCache instance.
+
+        Args:
+            path (str): Path to the sqlite database file.
+            max_entries (int): Maximum number of entries; the oldest entries are removed first.
+            ttl (float | None): Seconds after which an entry expires. If None, entries never expire.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def get(self, key: str) -> str | None:
+        """Returns the value stored for the key.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str | None: The stored value, or None if it is missing or expired.
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return None
+        return row[0]
+
+    def set(self, key: str, value: str):
+        """Stores the value for the key and periodically removes expired and surplus entries.
+
+        Args:
+            key (str): The cache key.
+            value (str): The value to store.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)", (key, value, now))
+            self._writes += 1
+            if self._writes % 100 == 1:
+                if self.ttl is not None:
+                    connection.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+                connection.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+
+
+class ResultCache:
+    """Cache of JSON-serializable analysis results with per-namespace hit/miss counters.
+
+    Namespaces separate the cached objects, e.g. the final result of process_main.run and the outputs of
+    the individual processes, so that a changed heatmap still reuses the process B output.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float | None = None, db_path: str | None = None,
+                 db_max_entries: int = 100000):
+        """Initialize a ResultCache instance.
+
+        Args:
+            max_entries (int): Maximum number of entries of the in-memory tier. If 0, the memory tier is disabled.
+            ttl (float | None): Seconds after which an entry expires. If None, entries never expire.
+            db_path (str | None): Path to the sqlite database of the on-disk tier. If None, the tier is disabled.
+            db_max_entries (int): Maximum number of entries of the on-disk tier.
+        """
+        self.memory = LRUCache(max_entries, ttl)
+        self.disk = SqliteCache(db_path, db_max_entries, ttl) if db_path else None
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any cache tier is enabled."""
+        return self.memory.max_entries > 0 or self.disk is not None
+
+    @property
+    def stats(self) -> dict:
+        """Returns hit/miss counters and hit ratios per namespace.
+
+        Returns:
+            dict: Mapping of namespace to its "hits", "misses" and "hit_ratio".
+        """
+        with self._lock:
+            return {namespace: {"hits": hits, "misses": misses,
+                                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0}
+                    for namespace, (hits, misses) in self._counters.items()}
+
+    def get(self, namespace: str, key: str):
+        """Returns the result stored for the key.
+
+        Args:
+            namespace (str): Namespace of the result.
+            key (str): The cache key.
+
+        Returns:
+            Any: A fresh copy of the cached result, or None if it is missing.
+        """
+        if not self.enabled:
+            return None
+        full_key = f"{namespace}:{key}"
+        value = self.memory.get(full_key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(full_key)
+            if value is not None:
+                self.memory.set(full_key, value)
+        self._count(namespace, value is not None)
+        return None if value is None else json.loads(value)
+
+    def set(self, namespace: str, key: str, result):
+        """Stores the result for the key in all enabled tiers.
+
+        Args:
+            namespace (str): Namespace of the result.
+            key (str): The cache key.
+            result (Any): JSON-serializable result.
+        """
+        if not self.enabled:
+            return
+        full_key = f"{namespace}:{key}"
+        value = json.dumps(result, ensure_ascii=False)
+        self.memory.set(full_key, value)
+        if self.disk is not None:
+            self.disk.set(full_key, value)
+
+    def _count(self, namespace: str, hit: bool):
+        with self._lock:
+            hits, misses = self._counters.get(namespace, (0, 0))
+            self._counters[namespace] = (hits + 1, misses) if hit else (hits, misses + 1)
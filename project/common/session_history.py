@@ -0,0 +1,82 @@
+"""This module provides a thread-safe store of chat histories scoped to a single analysis request."""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
+
+
+class SessionHistoryManager:
+    """Bounded store of chat message histories keyed by unique session ids.
+
+    Sessions are removed when the request that opened them finishes. Abandoned sessions are evicted
+    after ttl seconds of inactivity, and the least recently used session is evicted when the store is full.
+    """
+
+    def __init__(self, max_sessions: int = 1024, ttl: float = 600.0):
+        """Initialize a SessionHistoryManager instance.
+
+        Args:
+            max_sessions (int): Maximum number of sessions kept in memory.
+            ttl (float): Seconds of inactivity after which a session is evicted.
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # session_id -> (history, last_access)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    @contextmanager
+    def session(self):
+        """Opens a new session and removes it on exit.
+
+        Yields:
+            str: The unique identifier of the session.
+        """
+        session_id = uuid.uuid4().hex
+        try:
+            yield session_id
+        finally:
+            self.clear(session_id)
+
+    def get_session_history(self, session_id: str) -> BaseChatMessageHistory:
+        """Retrieves the chat message history for a given session.
+
+        If the session does not exist, a new session history is created and added to the store.
+
+        Args:
+            session_id (str): The unique identifier for the session.
+
+        Returns:
+            BaseChatMessageHistory: The chat message history associated with the session_id.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if session_id in self._sessions:
+                history = self._sessions.pop(session_id)[0]
+            else:
+                history = InMemoryChatMessageHistory()
+            self._sessions[session_id] = (history, now)
+            return history
+
+    def clear(self, session_id: str):
+        """Removes the history of a session.
+
+        Args:
+            session_id (str): The unique identifier for the session.
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _evict(self, now: float):
+        while self._sessions:
+            session_id, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access < self.ttl and len(self._sessions) < self.max_sessions:
+                break
+            del self._sessions[session_id]
@@ -0,0 +1,105 @@
+"""This module provides deferred imports and a profile of the server start.
+
+Heavy modules (langchain, the OpenAI client, PIL) are imported on first use through LazyModule, so the server can
+bind its port quickly, and are loaded by an explicit warm-up afterwards. Every import and initialisation step of
+the warm-up is timed in the startup profile.
+"""
+
+import contextlib
+import importlib
+import threading
+import time
+from types import ModuleType
+
+
+class StartupProfile:
+    """Durations of the import and initialisation steps of the server start, in the order they ran."""
+
+    def __init__(self):
+        """Initialize a StartupProfile instance."""
+        self.started = time.perf_counter()
+        self.steps = {}  # name -> seconds
+        self.ready_after = None  # seconds from the profile creation until the warm-up finished
+        self.error = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        """Times a step; the step is recorded even if it fails.
+
+        Args:
+            name (str): Name of the step, e.g. "import analysis.processA" or "init model".
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.steps[name] = self.steps.get(name, 0.0) + time.perf_counter() - start
+
+    def import_module(self, name: str) -> ModuleType:
+        """Imports a module and records the time of the import.
+
+        Modules imported earlier are not timed again, so when modules are imported in dependency order,
+        each one is reported with the time of its own import only.
+
+        Args:
+            name (str): Full name of the module.
+
+        Returns:
+            ModuleType: The module.
+        """
+        with self.step(f"import {name}"):
+            return importlib.import_module(name)
+
+    def mark_ready(self, error: Exception | None = None):
+        """Marks the end of the warm-up.
+
+        Args:
+            error (Exception | None): The error which made the warm-up fail, if any.
+        """
+        with self._lock:
+            self.ready_after = time.perf_counter() - self.started
+            self.error = f"{type(error).__name__}: {error}" if error else None
+
+    @property
+    def ready(self) -> bool:
+        """Returns whether the warm-up finished without an error.
+
+        Returns:
+            bool: True if the server is warm.
+        """
+        return self.ready_after is not None and self.error is None
+
+    def to_dict(self) -> dict:
+        """Returns the profile in a JSON-serializable form.
+
+        Returns:
+            dict: Readiness, the warm-up error and the seconds of each step.
+        """
+        with self._lock:
+            return {"ready": self.ready_after is not None and self.error is None,
+                    "ready_after_seconds": None if self.ready_after is None else round(self.ready_after, 4),
+                    "error": self.error,
+                    "steps": {name: round(seconds, 4) for name, seconds in self.steps.items()}}
+
+
+startup_profile = StartupProfile()
+
+
+class LazyModule:
+    """Proxy of a module which is imported on first attribute access."""
+
+    def __init__(self, name: str):
+        """Initialize a LazyModule instance.
+
+        Args:
+            name (str): Full name of the module.
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute: str):
+        if self._module is None:
+            self._module = startup_profile.import_module(self._name)
+        return getattr(self._module, attribute)
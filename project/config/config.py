@@ -1,25 +1,39 @@
 import os
+import threading
 
-import yaml
 from common import logger
+from common.doc_cache import HelperDocCache
+from common.doc_index import HelperDocIndex
+from common.near_duplicates import NearDuplicateIndex
+from common.result_cache import ResultCache
+from common.startup import startup_profile
+from config.prompts_config import PromptsConfigFile
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
+
+MODEL_PARAMS = ("temperature", "max_tokens", "timeout")  # request settings of a stage model, see prompts_config
+# USD per million prompt and completion tokens, for the llm_cost_usd metric
+MODEL_PRICES = {"gpt-4o": (2.5, 10.0), "gpt-4o-mini": (0.15, 0.6)}
 
 
 class AppConfig:
     """Singleton class to handle application configuration.
 
     This class initializes the logger and loads environment variables from a .env file.
-    It also sets up the OpenAI model to be used in the application.
+    It also keeps the pool of the OpenAI model clients used by the processing stages. The model clients and the
+    session histories are created on first use, so creating the configuration does not import langchain.
     """
     _instance = None
 
-    def __new__(cls, env_path="./envs/.env", logger_save_path=".", prompts_config_path="", *args, **kwargs):
+    def __new__(cls, env_path=None, logger_save_path=None, prompts_config_path=None, *args, **kwargs):
         """Create or return the singleton instance of AppConfig.
 
+        Paths which are not given are taken from the APP_ENV_PATH, APP_LOGGER_SAVE_PATH and APP_PROMPTS_CONFIG_PATH
+        environment variables, which main.py sets for the server worker processes.
+
         Args:
-            env_path (str): Path to the .env file. Defaults to './envs/.env'.
-            logger_save_path (str): Path to the logger file. Defaults is main.py folder.
+            env_path (str | None): Path to the .env file. Defaults to './envs/.env'.
+            logger_save_path (str | None): Path to the logger file. Defaults is main.py folder.
+            prompts_config_path (str | None): Path to .yaml prompts config.
             *args: Additional positional arguments to pass to the parent class's __new__ method.
             **kwargs: Additional keyword arguments to pass to the parent class's __new__ method.
 
@@ -28,7 +42,9 @@ class AppConfig:
         """
         if not cls._instance:
             cls._instance = super().__new__(cls, *args, **kwargs)
-            cls._instance.__initialize(env_path, logger_save_path, prompts_config_path)
+            cls._instance.__initialize(env_path or os.getenv("APP_ENV_PATH", "./envs/.env"),
+                                       logger_save_path or os.getenv("APP_LOGGER_SAVE_PATH", "."),
+                                       prompts_config_path or os.getenv("APP_PROMPTS_CONFIG_PATH", ""))
         return cls._instance
 
     def __initialize(self, env_path: str, logger_save_path: str, prompts_config_path: str):
@@ -41,20 +57,178 @@ class AppConfig:
 
         Raises:
             FileNotFoundError: If the specified .env file is not found.
-            Exception: For any errors that occur during model initialization.
+            ValueError: If the prompts config is invalid.
         """
         self.port = int(os.getenv("PORT", 8000))
         self.max_size = 30000  # max image size in bytes; used to ensure the image size does not exceed the context window limit of the model
+        self.max_upload_size = int(os.getenv("MAX_UPLOAD_SIZE", 20 * 1024 * 1024))  # uploads above it are rejected
+        self.max_concurrent_analyses = int(os.getenv("MAX_CONCURRENT_ANALYSES", 32))  # in-flight analyses per worker
+        self.batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", 8))  # pairs analysed at once per batch
+        self.max_batch_pairs = int(os.getenv("MAX_BATCH_PAIRS", 50))  # pairs of one batch request
+        self.max_batch_upload_size = int(os.getenv("MAX_BATCH_UPLOAD_SIZE", 200 * 1024 * 1024))  # body of a batch
+        self.job_workers = int(os.getenv("JOB_WORKERS", 4))
+        self.job_queue_size = int(os.getenv("JOB_QUEUE_SIZE", 100))
+        self.job_store_path = os.getenv("JOB_STORE_PATH") or None  # sqlite file; jobs are kept in memory if not set
+        self.job_ttl = float(os.getenv("JOB_TTL", 3600))  # seconds finished jobs are kept
+        # hosts job callbacks may be sent to; any public host is allowed if empty
+        self.job_callback_hosts = [host.strip().lower() for host in os.getenv("JOB_CALLBACK_HOSTS", "").split(",")
+                                   if host.strip()]
 
-        with open(prompts_config_path) as file:
-            self.prompts_config = yaml.safe_load(file)
-
-        self.process_logger = logger.get_logger(logger_save_path, 'Logger for process')
+        # records are written by a background thread, see common.logger
+        self.log_level = os.getenv("LOG_LEVEL", "DEBUG").upper()
+        self.process_logger = logger.get_logger(logger_save_path, 'Logger for process', level=self.log_level,
+                                                json_format=os.getenv("LOG_FORMAT", "json") == "json",
+                                                max_bytes=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+                                                backup_count=int(os.getenv("LOG_BACKUP_COUNT", 5)),
+                                                rotate_when=os.getenv("LOG_ROTATE_WHEN") or None,
+                                                max_message_length=int(os.getenv("LOG_MAX_MESSAGE_LENGTH", 4000)),
+                                                sample_rate=float(os.getenv("LOG_SAMPLE_RATE", 1.0)))
         load_dotenv(env_path)
 
+        # validated up front and reloaded when the file changes, see prompts_config
+        self.prompts_file = PromptsConfigFile(prompts_config_path, self.process_logger,
+                                              float(os.getenv("PROMPTS_RELOAD_INTERVAL", 2)))
+
+        # results of the pipeline and of its stages, keyed by image bytes, model name and prompts config
+        self.result_cache = ResultCache(max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 1024)),
+                                        ttl=float(os.getenv("RESULT_CACHE_TTL", 86400)),
+                                        db_path=os.getenv("RESULT_CACHE_DB_PATH") or None,
+                                        db_max_entries=int(os.getenv("RESULT_CACHE_DB_MAX_ENTRIES", 100000)))
+
+        # outputs of processes A and B kept for a short time, so a retry after a failed stage resumes from them
+        self.checkpoints = ResultCache(max_entries=int(os.getenv("CHECKPOINT_MAX_ENTRIES", 256)),
+                                       ttl=float(os.getenv("CHECKPOINT_TTL", 3600)),
+                                       db_path=os.getenv("CHECKPOINT_DB_PATH") or None)
+        self.stage_retries = int(os.getenv("STAGE_RETRIES", 1))  # re-attempts of a stage failed with LLMException
+
+        # perceptual hashes of the analysed images, so resized or re-encoded creatives reuse stored outputs;
+        # opt-in, as a near match returns another pair's analysis: a negative distance (the default) disables the reuse
+        near_duplicate_distance = int(os.getenv("NEAR_DUPLICATE_DISTANCE", -1))
+        self.near_duplicates = None
+        if near_duplicate_distance >= 0:
+            self.near_duplicates = NearDuplicateIndex(near_duplicate_distance,
+                                                      kind=os.getenv("NEAR_DUPLICATE_HASH", "phash"),
+                                                      db_path=os.getenv("NEAR_DUPLICATE_DB_PATH") or None,
+                                                      max_entries=int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES",
+                                                                                200000)))
+
+        # extracted helper documents are cached in memory and on disk; warmed only if process B is configured
+        self.helper_doc_cache = HelperDocCache(os.getenv("HELPER_DOC_CACHE_DIR", "./.cache/helper_docs"))
+        # BM25 indexes of the helper documents, built once per document version
+        self.helper_doc_index = HelperDocIndex(os.path.join(self.helper_doc_cache.cache_dir, "index"))
+
+        # the server binds its port first and warms up afterwards, see /readyz; otherwise it warms up before binding
+        self.fast_start = os.getenv("FAST_START", "true").lower() in ("1", "true", "yes")
+        # model of the processes without a "model" section in the prompts config
+        self.model_name = os.getenv("LLM_MODEL", "gpt-4o")
+        self._clients = {}  # model name -> ResilientChatModel, shared by the stages using the model
+        self._models = {}  # model name and request settings -> client bound to the settings
+        self._model = None  # replaces the clients of all models if set, e.g. with a fake model
+        self._session_histories = None
+        self._lazy_lock = threading.Lock()
+
+    def set_log_level(self, level: str):
+        """Changes the level of the application logger at runtime.
+
+        Args:
+            level (str): The logging level, e.g. "INFO".
+        """
+        self.log_level = level.upper()
+        self.process_logger.setLevel(self.log_level)
+
+    @property
+    def model(self):
+        """Returns the client of the default model, creating it on first use.
+
+        Returns:
+            ResilientChatModel: The OpenAI model wrapped with retries and rate and concurrency limits.
+
+        Raises:
+            Exception: For any errors that occur during model initialization.
+        """
+        return self.get_model()
+
+    @model.setter
+    def model(self, model):
+        with self._lazy_lock:
+            self._model = model
+            self._models.clear()
+
+    def get_model(self, settings: dict | None = None):
+        """Returns the pooled client for the model settings of a stage, creating it on first use.
+
+        One client is created per model name, so the stages using a model share its connections and its rate and
+        concurrency limits; the temperature, max_tokens and timeout are bound to the requests of the stage.
+
+        Args:
+            settings (dict | None): The "model" section of a process in the prompts config with the "name" of the
+                                    model and optionally the MODEL_PARAMS. Defaults to the default model.
+
+        Returns:
+            Runnable: The model client.
+
+        Raises:
+            Exception: For any errors that occur during model initialization.
+        """
+        settings = settings or {}
+        name = settings.get("name", self.model_name)
+        params = {param: settings[param] for param in MODEL_PARAMS if settings.get(param) is not None}
+        key = (name, tuple(sorted(params.items())))
+        model = self._models.get(key)
+        if model is None:
+            with self._lazy_lock:
+                model = self._models.get(key)
+                if model is None:
+                    client = self._model or self._clients.get(name)
+                    if client is None:
+                        with startup_profile.step(f"init model {name}"):
+                            client = self._clients[name] = self._create_model(name)
+                    model = self._models[key] = client.bind(**params) if params else client
+        return model
+
+    def _create_model(self, name: str):
+        from common.llm_client import ResilientChatModel
+        from langchain_openai import ChatOpenAI
+
+        prompt_token_price, completion_token_price = MODEL_PRICES.get(name, (0.0, 0.0))
+        if name == self.model_name:
+            prompt_token_price = float(os.getenv("LLM_PROMPT_TOKEN_PRICE", prompt_token_price))
+            completion_token_price = float(os.getenv("LLM_COMPLETION_TOKEN_PRICE", completion_token_price))
         try:
-            # self.model = ChatOpenAI(model="gpt-4o-mini")
-            self.model = ChatOpenAI(model="gpt-4o")
+            # retries are done by ResilientChatModel, which also limits the request rate and concurrency
+            return ResilientChatModel(ChatOpenAI(model=name, max_retries=0, stream_usage=True),
+                                      requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", 500)),
+                                      tokens_per_minute=float(os.getenv("LLM_TOKENS_PER_MINUTE", 30000)),
+                                      max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 16)),
+                                      max_retries=int(os.getenv("LLM_MAX_RETRIES", 5)),
+                                      prompt_token_price=prompt_token_price,
+                                      completion_token_price=completion_token_price)
         except Exception as e:
-            self.process_logger.error(f"Error initializing ChatOpenAI model: {e}")
+            self.process_logger.error(f"Error initializing ChatOpenAI model {name}: {e}")
             raise
+
+    @property
+    def session_histories(self):
+        """Returns the chat histories of the process A sessions, creating the manager on first use.
+
+        Returns:
+            SessionHistoryManager: The session history manager.
+        """
+        if self._session_histories is None:
+            from common.session_history import SessionHistoryManager
+
+            with self._lazy_lock:
+                if self._session_histories is None:
+                    self._session_histories = SessionHistoryManager(
+                        int(os.getenv("SESSION_HISTORY_MAX_SESSIONS", 1024)),
+                        float(os.getenv("SESSION_HISTORY_TTL", 600)))
+        return self._session_histories
+
+    @property
+    def prompts_config(self) -> dict:
+        """Returns the current prompts configuration, reloaded if the .yaml file has changed.
+
+        Returns:
+            dict: The prompts configuration. It must not be modified.
+        """
+        return self.prompts_file.config
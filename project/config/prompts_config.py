@@ -0,0 +1,171 @@
+"""This module provides loading, validation and hot-reload of the .yaml prompts configuration."""
+
+import os
+import threading
+import time
+
+import yaml
+
+A_PROCESS_MODES = ("sequential", "combined")
+HEATMAP_MODES = ("image", "summary", "skip")
+FEATURES_MODES = ("off", "grounded", "features_only")
+IMAGE_DETAILS = ("low", "high", "auto")
+IMAGE_POLICY_STAGES = {"a_process": ("a1", "a2"), "b_process": ("b",)}
+MODEL_FIELDS = {"name": str, "temperature": (int, float), "max_tokens": int, "timeout": (int, float)}
+HELPER_DOC_RETRIEVAL_FIELDS = ("chunk_tokens", "chunk_overlap", "top_k", "token_budget")
+PROCESS_INSTRUCTIONS = {"a_process": ("a1_instructions", "a2_instructions"),
+                        "b_process": ("b_instructions",),
+                        "c_process": ("c_instructions",)}
+
+
+def validate_prompts_config(config: dict):
+    """Checks that a prompts configuration has all processes and well-formed instructions.
+
+    Args:
+        config (dict): The loaded prompts configuration.
+
+    Raises:
+        ValueError: If a process, an instruction or one of their fields is missing or malformed.
+    """
+    if not isinstance(config, dict):
+        raise ValueError("prompts config must be a mapping")
+    for process, instructions_names in PROCESS_INSTRUCTIONS.items():
+        if not isinstance(config.get(process), dict):
+            raise ValueError(f"prompts config has no '{process}' section")
+        for name in instructions_names:
+            instructions = config[process].get(name)
+            if not isinstance(instructions, dict):
+                raise ValueError(f"'{process}' has no '{name}' section")
+            for field in ("role", "input_overview", "task"):
+                if not isinstance(instructions.get(field), str):
+                    raise ValueError(f"'{process}.{name}.{field}' must be a string")
+            schemas = instructions.get("response_schemas")
+            if not schemas or not all(isinstance(schema, dict) and isinstance(schema.get("name"), str)
+                                      and isinstance(schema.get("description"), str) for schema in schemas):
+                raise ValueError(f"'{process}.{name}.response_schemas' must be a list of names and descriptions")
+    if config["a_process"].get("mode", "sequential") not in A_PROCESS_MODES:
+        raise ValueError(f"'a_process.mode' must be one of {A_PROCESS_MODES}")
+    heatmap_mode = config["a_process"].get("heatmap_mode", "image")
+    if heatmap_mode not in HEATMAP_MODES:
+        raise ValueError(f"'a_process.heatmap_mode' must be one of {HEATMAP_MODES}")
+    if heatmap_mode != "image" and config["a_process"].get("mode") == "combined":
+        raise ValueError("'a_process.heatmap_mode' must be 'image' in the 'combined' mode")
+    heatmap_summary = config["a_process"].get("heatmap_summary", {})
+    if (not isinstance(heatmap_summary, dict) or set(heatmap_summary) - {"max_regions", "min_share", "crops"}
+            or not isinstance(heatmap_summary.get("max_regions", 1), int) or heatmap_summary.get("max_regions", 1) < 1
+            or not isinstance(heatmap_summary.get("min_share", 0), (int, float))
+            or not 0 <= heatmap_summary.get("min_share", 0) <= 1
+            or not isinstance(heatmap_summary.get("crops", False), bool)):
+        raise ValueError("'a_process.heatmap_summary' must have a positive integer max_regions, a min_share "
+                         "from 0 to 1 and a boolean crops")
+    for process, stages in IMAGE_POLICY_STAGES.items():
+        image_policy = config[process].get("image_policy", {})
+        if not isinstance(image_policy, dict) or set(image_policy) - set(stages):
+            raise ValueError(f"'{process}.image_policy' must be a mapping of the stages {stages}")
+        for stage, policy in image_policy.items():
+            if (not isinstance(policy, dict) or set(policy) - {"detail", "max_tiles"}
+                    or policy.get("detail", "auto") not in IMAGE_DETAILS
+                    or not isinstance(policy.get("max_tiles", 1), int) or policy.get("max_tiles", 1) < 1):
+                raise ValueError(f"'{process}.image_policy.{stage}' must have a detail of {IMAGE_DETAILS} "
+                                 f"and a positive integer max_tiles")
+    for process in PROCESS_INSTRUCTIONS:
+        validate_model_settings(process, config[process].get("model", {}))
+    if config["b_process"].get("features_mode", "off") not in FEATURES_MODES:
+        raise ValueError(f"'b_process.features_mode' must be one of {FEATURES_MODES}")
+    if not isinstance(config["b_process"].get("helper_doc_path"), str):
+        raise ValueError("'b_process.helper_doc_path' must be a string")
+    retrieval = config["b_process"].get("helper_doc_retrieval")
+    if retrieval is not None:
+        if not isinstance(retrieval, dict) or not all(isinstance(retrieval.get(field), int) and retrieval[field] >= 0
+                                                      for field in HELPER_DOC_RETRIEVAL_FIELDS):
+            raise ValueError(f"'b_process.helper_doc_retrieval' must have non-negative integer "
+                             f"{', '.join(HELPER_DOC_RETRIEVAL_FIELDS)}")
+        if retrieval["chunk_tokens"] == 0:
+            raise ValueError("'b_process.helper_doc_retrieval.chunk_tokens' must be positive")
+
+
+def validate_model_settings(process: str, settings: dict):
+    """Checks the "model" section of a process.
+
+    Args:
+        process (str): Name of the process.
+        settings (dict): The "model" section of the process.
+
+    Raises:
+        ValueError: If a field is unknown or malformed.
+    """
+    if not isinstance(settings, dict) or set(settings) - set(MODEL_FIELDS) - {"escalate_to", "structured_output"}:
+        raise ValueError(f"'{process}.model' must be a mapping of {list(MODEL_FIELDS)}, 'escalate_to' and "
+                         "'structured_output'")
+    if not isinstance(settings.get("structured_output", True), bool):
+        raise ValueError(f"'{process}.model.structured_output' must be a boolean")
+    for field, types in MODEL_FIELDS.items():
+        value = settings.get(field)
+        if value is not None and (not isinstance(value, types) or isinstance(value, bool)
+                                  or (field != "name" and value < 0)):
+            raise ValueError(f"'{process}.model.{field}' must be a "
+                             f"{'string' if field == 'name' else 'non-negative number'}")
+    escalate_to = settings.get("escalate_to", [])
+    if not isinstance(escalate_to, list) or not all(isinstance(name, str) for name in escalate_to):
+        raise ValueError(f"'{process}.model.escalate_to' must be a list of model names")
+
+
+class PromptsConfigFile:
+    """Validated prompts configuration, atomically reloaded when the file changes on disk.
+
+    A reloaded file which fails validation is logged and ignored, the previous configuration stays active.
+    """
+
+    def __init__(self, path: str, logger=None, check_interval: float = 2.0):
+        """Initialize a PromptsConfigFile instance and load the file.
+
+        Args:
+            path (str): Path to the .yaml prompts configuration.
+            logger (logging.Logger | None): Logger for reload messages.
+            check_interval (float): Minimal interval in seconds between checks of the file modification time.
+                                    If 0, the file is never reloaded.
+
+        Raises:
+            ValueError: If the configuration is invalid.
+        """
+        self.path = path
+        self.logger = logger
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._config = self._load()
+        self._checked = time.monotonic()
+
+    def _load(self) -> dict:
+        with open(self.path) as file:
+            config = yaml.safe_load(file)
+        validate_prompts_config(config)
+        return config
+
+    @property
+    def config(self) -> dict:
+        """Returns the current configuration, reloading it first if the file has changed.
+
+        Returns:
+            dict: The prompts configuration. It must not be modified.
+        """
+        if self.check_interval and time.monotonic() - self._checked >= self.check_interval:
+            self.reload()
+        return self._config
+
+    def reload(self):
+        """Reloads the configuration if the file modification time has changed."""
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime:
+                    return
+                config = self._load()
+            except (OSError, ValueError, yaml.YAMLError) as e:
+                if self.logger:
+                    self.logger.error(f"Prompts config {self.path} was not reloaded: {e}")
+                return
+            self._config, self._mtime = config, mtime
+        if self.logger:
+            self.logger.info(f"Prompts config {self.path} was reloaded")
@@ -1,17 +1,47 @@
 import argparse
+import os
+import uuid
 
 import uvicorn
+from dotenv import load_dotenv
 
-from api import api
 from config import AppConfig
 
+# sqlite files shared by the worker processes, set if the variables are not configured and more than one worker runs
+SHARED_STATE_FILES = {"RESULT_CACHE_DB_PATH": "result_cache.sqlite", "CHECKPOINT_DB_PATH": "checkpoints.sqlite",
+                      "NEAR_DUPLICATE_DB_PATH": "near_duplicates.sqlite", "JOB_STORE_PATH": "jobs.sqlite"}
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='Main')
     parser.add_argument('--env_path', type=str, default="./envs/.env")
     parser.add_argument('--logger_save_path', type=str, default=".")
     parser.add_argument('--prompts_config_path', type=str, default="./analysis/prompts/data.yaml")
+    parser.add_argument('--workers', type=int, default=int(os.getenv("WEB_WORKERS", 1)),
+                        help="number of server worker processes")
+    parser.add_argument('--limit_max_requests', type=int, default=int(os.getenv("WORKER_MAX_REQUESTS", 0)),
+                        help="requests after which a worker is gracefully restarted; 0 disables recycling")
 
     args = parser.parse_args()
+    # worker processes create their own AppConfig from these variables
+    os.environ["APP_ENV_PATH"] = args.env_path
+    os.environ["APP_LOGGER_SAVE_PATH"] = args.logger_save_path
+    os.environ["APP_PROMPTS_CONFIG_PATH"] = args.prompts_config_path
+    os.environ["SERVER_INSTANCE_ID"] = uuid.uuid4().hex
+    os.environ["WEB_WORKERS"] = str(args.workers)
+    if args.workers > 1:
+        load_dotenv(args.env_path)  # so the defaults below do not override the .env file
+        shared_state_dir = os.getenv("SHARED_STATE_DIR", "./.cache/shared")
+        os.makedirs(shared_state_dir, exist_ok=True)
+        for name, file_name in SHARED_STATE_FILES.items():
+            os.environ.setdefault(name, os.path.join(shared_state_dir, file_name))
     app_config = AppConfig(args.env_path, args.logger_save_path, args.prompts_config_path)
 
-    uvicorn.run(api.app, host="0.0.0.0", port=app_config.port)
+    if args.workers > 1:
+        uvicorn.run("api.api:app", host="0.0.0.0", port=app_config.port, workers=args.workers,
+                    limit_max_requests=args.limit_max_requests or None)
+    else:
+        if args.limit_max_requests:
+            app_config.process_logger.warning("Workers are recycled only with more than one worker, ignoring "
+                                              "limit_max_requests")
+        from api import api
+        uvicorn.run(api.app, host="0.0.0.0", port=app_config.port)
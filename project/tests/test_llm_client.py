@@ -0,0 +1,179 @@
+"""Tests of the resilient client layer against the local fake chat model."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+from langchain_core.messages import HumanMessage
+from langchain_core.pydantic_v1 import PrivateAttr
+
+from benchmarks.fake_model import FakeChatModel, FakeServerError
+from common.llm_client import ResilientChatModel, TokenBucket
+
+
+class ScriptedModel(FakeChatModel):
+    """Fake model failing as scripted and recording its calls and their peak concurrency."""
+
+    _script: list = PrivateAttr(default_factory=list)  # True fails with a retryable error, an exception is raised
+    _calls: int = PrivateAttr(default=0)
+    _active: int = PrivateAttr(default=0)
+    _peak: int = PrivateAttr(default=0)
+
+    def _draw(self):
+        with self._lock:
+            self._calls += 1
+            self._active += 1
+            self._peak = max(self._peak, self._active)
+            failure = self._script.pop(0) if self._script else False
+        return self.latency, failure
+
+    def _respond(self, messages, failed, response_format=None):
+        with self._lock:
+            self._active -= 1
+        if isinstance(failed, Exception):
+            raise failed
+        return super()._respond(messages, failed, response_format)
+
+
+def make_client(latency: float = 0.0, script: list | None = None, **kwargs) -> tuple[ResilientChatModel, ScriptedModel]:
+    model = ScriptedModel(latency=latency)
+    model._script = list(script or [])
+    kwargs = {"requests_per_minute": 0, "tokens_per_minute": 0, "base_delay": 0.0, **kwargs}
+    return ResilientChatModel(model, **kwargs), model
+
+
+def prompt(text: str = "hello") -> list:
+    return [HumanMessage(content=f'Answer as JSON:\n"answer": ...\n{text}')]
+
+
+def test_retries_retryable_errors():
+    client, model = make_client(script=[True, True])
+
+    assert "answer" in client.invoke(prompt()).content
+    assert model._calls == 3
+
+
+def test_gives_up_after_max_retries():
+    client, model = make_client(script=[True] * 3, max_retries=2)
+
+    with pytest.raises(FakeServerError):
+        asyncio.run(client.ainvoke(prompt()))
+    assert model._calls == 3
+
+
+def test_does_not_retry_other_errors():
+    client, model = make_client(script=[ValueError("invalid request")])
+
+    with pytest.raises(ValueError):
+        client.invoke(prompt())
+    assert model._calls == 1
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(60)  # one token per second
+
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(30) == pytest.approx(30, abs=0.1)
+    assert TokenBucket(0).reserve(1000) == 0
+
+
+def test_rate_limited_call_waits():
+    client, _ = make_client(requests_per_minute=600)  # one request per 0.1 s
+    client.requests.reserve(600)
+
+    start = time.perf_counter()
+    asyncio.run(client.ainvoke(prompt()))
+    assert time.perf_counter() - start >= 0.09
+
+
+def test_coalesces_identical_async_prompts():
+    client, model = make_client(latency=0.05)
+
+    async def run():
+        return await asyncio.gather(*(client.ainvoke(prompt()) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert model._calls == 1
+    assert len({result.content for result in results}) == 1
+
+
+def test_coalesces_identical_sync_prompts():
+    client, model = make_client(latency=0.05)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.invoke(prompt()))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert model._calls == 1
+    assert len(results) == 5
+
+
+def test_cancelled_first_caller_does_not_cancel_coalesced_callers():
+    client, model = make_client(latency=0.1)
+
+    async def run():
+        owner = asyncio.create_task(client.ainvoke(prompt()))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(client.ainvoke(prompt()))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        return await waiter
+
+    assert "answer" in asyncio.run(run()).content
+    assert model._calls == 1
+    assert client._async_in_flight == {}
+
+
+def test_call_cancelled_by_every_caller_is_not_reused():
+    client, model = make_client(latency=0.1)
+
+    async def run():
+        caller = asyncio.create_task(client.ainvoke(prompt()))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.sleep(0)
+        return await client.ainvoke(prompt())
+
+    assert "answer" in asyncio.run(run()).content
+    assert model._calls == 2
+
+
+def test_concurrency_cap_is_shared_by_sync_and_async_calls():
+    client, model = make_client(latency=0.05, max_concurrency=2)
+    threads = [threading.Thread(target=client.invoke, args=(prompt(f"sync {i}"),)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+
+    async def run():
+        await asyncio.gather(*(client.ainvoke(prompt(f"async {i}")) for i in range(4)))
+
+    asyncio.run(run())
+    for thread in threads:
+        thread.join()
+    assert model._calls == 8
+    assert model._peak == 2
+
+
+def test_stream_is_closed_when_consumer_stops():
+    client, _ = make_client()
+    closed = []
+
+    async def stream(*args, **kwargs):
+        try:
+            for piece in ("a", "b", "c"):
+                yield piece
+        finally:
+            closed.append(True)
+
+    client.model = type("StreamingModel", (), {"astream": staticmethod(stream)})()
+
+    async def run():
+        chunks = client.astream(prompt())
+        first = await anext(chunks)
+        await chunks.aclose()
+        return first, list(closed)
+
+    assert asyncio.run(run()) == ("a", [True])